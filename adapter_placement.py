@@ -0,0 +1,125 @@
+import glob, logging, os, re, threading, time
+
+logger = logging.getLogger('heating')
+
+class HciBackend(object):
+  '''Lists the HCI adapters present on this machine.'''
+  def adapters(self):
+    indices = []
+    for path in glob.glob('/sys/class/bluetooth/hci*'):
+      match = re.match(r'hci(\d+)$', os.path.basename(path))
+      if match:
+        indices.append(int(match.group(1)))
+    return sorted(indices)
+
+class FakeAdapterBackend(object):
+  '''Stand-in backend with a fixed set of adapters, for running without radios.'''
+  def __init__(self, count):
+    self.count = count
+
+  def adapters(self):
+    return list(range(self.count))
+
+class AdapterPlacement(object):
+  '''Spreads sensors across HCI adapters and moves them off degraded links.
+
+  Each adapter's load is the sum of the smoothed read latency of the sensors
+  placed on it, and new sensors go to the least loaded adapter. A sensor whose
+  latency or RSSI passes the degraded thresholds, or whose reads keep failing,
+  is moved to the least loaded of the other adapters, and then left where it
+  is for move_cooldown_seconds.
+
+  RSSI comes from the scanner, so it only says anything about the link of a
+  sensor placed on the scan adapter; it is ignored for sensors elsewhere.
+  '''
+  def __init__(self, backend, degraded_latency_seconds, degraded_rssi, max_failures, move_cooldown_seconds, \
+      scan_adapter = 0, smoothing = 0.3):
+    self.backend = backend
+    self.degraded_latency_seconds = degraded_latency_seconds
+    self.degraded_rssi = degraded_rssi
+    self.max_failures = max_failures
+    self.move_cooldown_seconds = move_cooldown_seconds
+    self.scan_adapter = scan_adapter
+    self.smoothing = smoothing
+    self.adapters = backend.adapters()
+    if not self.adapters:
+      raise Exception('No Bluetooth adapters found')
+    logger.info('Using Bluetooth adapters ' + str(['hci' + str(adapter) for adapter in self.adapters]))
+    #MAC -> adapter index, smoothed latency, consecutive failures and when it last moved
+    self._placements = {}
+    self._lock = threading.Lock()
+
+  def place(self, mac):
+    '''Returns the adapter a newly discovered sensor should use.'''
+    self._lock.acquire()
+    if mac not in self._placements:
+      adapter = self._least_loaded(self.adapters)
+      self._placements[mac] = {'adapter': adapter, 'latency': None, 'failures': 0, 'moved_at': None}
+      logger.info('Placing ' + mac + ' on hci' + str(adapter))
+    adapter = self._placements[mac]['adapter']
+    self._lock.release()
+    return adapter
+
+  def forget(self, mac):
+    self._lock.acquire()
+    self._placements.pop(mac, None)
+    self._lock.release()
+
+  def record_read(self, sensor, latency, ok, attempted = True):
+    '''Records the outcome of one read and moves the sensor if its link has degraded.
+
+    A read that wasn't attempted, because the connection was waiting out its
+    reconnect backoff, doesn't count as a failure.
+    '''
+    self._lock.acquire()
+    placement = self._placements.setdefault(sensor.mac, {'adapter': sensor.adapter, 'latency': None, 'failures': 0, 'moved_at': None})
+    if ok:
+      placement['failures'] = 0
+      if placement['latency'] is None:
+        placement['latency'] = latency
+      else:
+        placement['latency'] += self.smoothing * (latency - placement['latency'])
+    elif attempted:
+      placement['failures'] += 1
+
+    reason = None
+    if placement['failures'] >= self.max_failures:
+      reason = str(placement['failures']) + ' failed reads'
+    elif placement['latency'] is not None and placement['latency'] > self.degraded_latency_seconds:
+      reason = 'read latency ' + str(round(placement['latency'], 2)) + 's'
+    elif placement['adapter'] == self.scan_adapter and sensor.rssi is not None and sensor.rssi < self.degraded_rssi:
+      reason = 'RSSI ' + str(sensor.rssi)
+
+    cooling_down = placement['moved_at'] is not None and time.monotonic() - placement['moved_at'] < self.move_cooldown_seconds
+    new_adapter = None
+    others = [adapter for adapter in self.adapters if adapter != placement['adapter']]
+    if reason is not None and others and not cooling_down:
+      new_adapter = self._least_loaded(others)
+      logger.info('Moving ' + sensor.mac + ' from hci' + str(placement['adapter']) + ' to hci' + str(new_adapter) + ': ' + reason)
+      placement['adapter'] = new_adapter
+      placement['latency'] = None
+      placement['failures'] = 0
+      placement['moved_at'] = time.monotonic()
+    self._lock.release()
+
+    if new_adapter is not None:
+      sensor.move_to_adapter(new_adapter)
+
+  def loads(self):
+    '''Returns adapter index -> (sensor count, total smoothed latency).'''
+    self._lock.acquire()
+    loads = dict((adapter, (0, 0.0)) for adapter in self.adapters)
+    for placement in self._placements.values():
+      count, latency = loads.get(placement['adapter'], (0, 0.0))
+      loads[placement['adapter']] = (count + 1, latency + (placement['latency'] or 0.0))
+    self._lock.release()
+    return loads
+
+  def _least_loaded(self, candidates):
+    totals = dict((adapter, [0, 0.0]) for adapter in candidates)
+    for placement in self._placements.values():
+      if placement['adapter'] in totals:
+        totals[placement['adapter']][0] += 1
+        totals[placement['adapter']][1] += placement['latency'] or 0.0
+    #Lowest latency first, then fewest sensors for adapters we have no timings for yet
+    return min(candidates, key = lambda adapter: (totals[adapter][1], totals[adapter][0]))
@@ -0,0 +1,128 @@
+import logging, random, threading, time
+
+from bluepy.btle import Peripheral, BTLEException
+
+from metrics import BLE_DISCONNECTS
+
+logger = logging.getLogger('heating')
+
+class BLEConnection(object):
+  '''Owns the Peripheral for one sensor and reconnects it in place.
+
+  After a dropout the same Peripheral object is reconnected, so anything that
+  refers to it (cached characteristics, the notification delegate) stays valid.
+  Reconnects back off exponentially with jitter and the connection gives up
+  once it has been down for longer than give_up_seconds.
+  '''
+  #Set from config
+  initial_backoff_seconds = 1
+  max_backoff_seconds = 60
+  give_up_seconds = 600
+
+  def __init__(self, addr, addr_type, iface, on_connect = None):
+    self.addr = addr
+    self.addr_type = addr_type
+    self.iface = iface
+    self.on_connect = on_connect
+    self.connected = False
+    self.failures = 0
+    self.disconnected_since = None
+    self.next_attempt = None
+    self._peripheral = None
+    self._lock = threading.RLock()
+
+  def get(self):
+    '''Returns the connected Peripheral, connecting first if needed.
+
+    Raises DisconnectedException if the device cannot be reached or is still
+    waiting out its backoff.
+    '''
+    self._lock.acquire()
+    try:
+      if self.connected:
+        return self._peripheral
+
+      if self.next_attempt is not None and time.monotonic() < self.next_attempt:
+        raise DisconnectedException('Waiting ' + str(round(self.next_attempt - time.monotonic(), 1)) + \
+          's before reconnecting to ' + self.addr)
+
+      try:
+        if self._peripheral is None:
+          self._peripheral = Peripheral(self.addr, self.addr_type, self.iface)
+        else:
+          logger.info('Reconnecting to ' + self.addr)
+          self._peripheral.connect(self.addr, self.addr_type, self.iface)
+      except BTLEException as e:
+        self._schedule_retry()
+        raise DisconnectedException('Could not connect to ' + self.addr + ': ' + str(e))
+
+      if self.disconnected_since is not None:
+        logger.info('Reconnected to ' + self.addr + ' after ' + str(round(time.monotonic() - self.disconnected_since, 1)) + 's')
+      self.connected = True
+      self.failures = 0
+      self.disconnected_since = None
+      self.next_attempt = None
+      if self.on_connect is not None:
+        self.on_connect()
+      return self._peripheral
+    finally:
+      self._lock.release()
+
+  def lost(self):
+    '''Marks the link as dropped after a failed GATT operation.'''
+    self._lock.acquire()
+    if self.connected:
+      logger.warn(self.addr + ' disconnected, will reconnect')
+      BLE_DISCONNECTS.inc()
+      self.connected = False
+      self._close_quietly()
+      self._schedule_retry()
+    self._lock.release()
+
+  def close(self):
+    self._lock.acquire()
+    self.connected = False
+    self._close_quietly()
+    self._lock.release()
+
+  def move_to(self, iface):
+    '''Drops the link and makes the next connection go through another adapter.'''
+    self._lock.acquire()
+    self.connected = False
+    self._close_quietly()
+    #bluepy ties a Peripheral's helper process to one adapter, so start afresh
+    self._peripheral = None
+    self.iface = iface
+    self.next_attempt = None
+    self._lock.release()
+
+  @property
+  def waiting(self):
+    '''Whether the link is down and still waiting out its backoff.'''
+    return not self.connected and self.next_attempt is not None and time.monotonic() < self.next_attempt
+
+  @property
+  def gave_up(self):
+    return self.disconnected_since is not None and \
+      time.monotonic() - self.disconnected_since > BLEConnection.give_up_seconds
+
+  def _schedule_retry(self):
+    now = time.monotonic()
+    if self.disconnected_since is None:
+      self.disconnected_since = now
+    delay = min(BLEConnection.max_backoff_seconds, BLEConnection.initial_backoff_seconds * (2 ** self.failures))
+    delay = delay * random.uniform(0.5, 1.0)
+    self.failures += 1
+    self.next_attempt = now + delay
+    logger.debug('Next connection attempt to ' + self.addr + ' in ' + str(round(delay, 1)) + 's')
+
+  def _close_quietly(self):
+    if self._peripheral is None:
+      return
+    try:
+      self._peripheral.disconnect()
+    except Exception as e:
+      pass
+
+class DisconnectedException(Exception):
+  pass
@@ -0,0 +1,147 @@
+import datetime, json, logging, os, threading, httplib2, pytz
+
+from dateutil import parser
+from googleapiclient import discovery
+from googleapiclient.discovery_cache.base import Cache
+from googleapiclient.errors import HttpError
+
+logger = logging.getLogger('heating')
+
+class FileDiscoveryCache(Cache):
+  '''Keeps discovery documents in a JSON file so the client can be built offline.'''
+  def __init__(self, path):
+    self.path = path
+    self._lock = threading.Lock()
+    self._documents = {}
+    if os.path.exists(self.path):
+      try:
+        with open(self.path) as json_data:
+          self._documents = json.load(json_data)
+      except (IOError, ValueError) as e:
+        logger.warn('Ignoring unreadable discovery cache ' + self.path + ': ' + str(e))
+
+  def get(self, url):
+    self._lock.acquire()
+    document = self._documents.get(url)
+    self._lock.release()
+    return document
+
+  def set(self, url, content):
+    self._lock.acquire()
+    try:
+      self._documents[url] = content
+      temp_path = self.path + '.tmp'
+      with open(temp_path, 'w') as json_data:
+        json.dump(self._documents, json_data)
+      os.replace(temp_path, self.path)
+    except (IOError, OSError) as e:
+      logger.warn('Could not write discovery cache ' + self.path + ': ' + str(e))
+    finally:
+      self._lock.release()
+
+class CalendarSync(object):
+  '''Local copy of the calendar's upcoming events, kept up to date incrementally.
+
+  The API client is built once, from a cached discovery document, and its
+  authorized Http (which keeps its connections open) is reused for every
+  call. A full sync lists the events from now until window_days ahead;
+  after that only the changes since the last sync token are fetched.
+
+  The sync token only covers the window the full sync asked for, so changes
+  to events beyond it are ignored, and once a caller wants events past the
+  end of the window the copy is synced in full again from the current time.
+  If Google has expired the token (410 Gone) the same happens.
+
+  Not thread safe; callers hold the calendar lock.
+  '''
+  PAGE_SIZE = 250
+
+  def __init__(self, credentials, calendar_id, timeout_seconds, discovery_cache_file, window_days):
+    self.credentials = credentials
+    self.calendar_id = calendar_id
+    self.timeout_seconds = timeout_seconds
+    self.discovery_cache = FileDiscoveryCache(discovery_cache_file)
+    self.window = datetime.timedelta(days = window_days)
+    self._service = None
+    self._sync_token = None
+    self._window_end = None
+    #Event ID -> (start, end, event)
+    self._events = {}
+
+  def service(self):
+    if self._service is None:
+      logger.debug('Building calendar client')
+      http = self.credentials.authorize(httplib2.Http(timeout = self.timeout_seconds))
+      self._service = discovery.build('calendar', 'v3', http = http, cache = self.discovery_cache)
+    return self._service
+
+  def sync(self, until = None):
+    '''Brings the local copy up to date, returning the number of events that changed.
+
+    until is the latest time the caller wants events for; if it is past the
+    end of the synced window the window is moved forward with a full sync.
+    '''
+    if self._sync_token is not None and until is not None and until > self._window_end:
+      logger.info('Calendar wanted to ' + str(until) + ', past the synced window, doing a full sync')
+      self._sync_token = None
+    try:
+      return self._fetch(self._sync_token)
+    except HttpError as e:
+      if e.resp.status != 410 or self._sync_token is None:
+        raise
+      logger.info('Calendar sync token expired, doing a full sync')
+      self._sync_token = None
+      return self._fetch(None)
+
+  def upcoming(self, until):
+    '''Returns the events that haven't ended and start before until, soonest first.'''
+    now = pytz.utc.localize(datetime.datetime.utcnow())
+    for event_id, (start, end, event) in list(self._events.items()):
+      if end < now:
+        del self._events[event_id]
+    return [event for start, end, event in sorted(self._events.values(), key = lambda entry: entry[0]) if start < until]
+
+  def _fetch(self, sync_token):
+    if sync_token is None:
+      events = {}
+      now = pytz.utc.localize(datetime.datetime.utcnow())
+      window_end = now + self.window
+      arguments = {'timeMin': now.isoformat(), 'timeMax': window_end.isoformat()}
+    else:
+      events = self._events
+      window_end = self._window_end
+      arguments = {'syncToken': sync_token}
+
+    changed = 0
+    page_token = None
+    while True:
+      result = self.service().events().list(calendarId = self.calendar_id, singleEvents = True, \
+        maxResults = CalendarSync.PAGE_SIZE, pageToken = page_token, **arguments).execute()
+      for event in result.get('items', []):
+        changed += 1
+        if event.get('status') == 'cancelled':
+          events.pop(event['id'], None)
+          continue
+        start = self.event_time(event['start'])
+        if start >= window_end:
+          #Instances past the window aren't covered by the token, the next full sync picks them up
+          events.pop(event['id'], None)
+        else:
+          events[event['id']] = (start, self.event_time(event['end']), event)
+      page_token = result.get('nextPageToken')
+      if page_token is None:
+        break
+
+    #Only replace the copy once a full sync has finished
+    self._events = events
+    self._sync_token = result.get('nextSyncToken')
+    self._window_end = window_end
+    logger.debug(('Full' if sync_token is None else 'Incremental') + ' calendar sync: ' + str(changed) + ' events changed')
+    return changed
+
+  def event_time(self, time):
+    parsed = parser.parse(time.get('dateTime', time.get('date')))
+    if parsed.tzinfo is None:
+      #All-day events are in local time
+      parsed = parsed.astimezone(pytz.utc)
+    return parsed
@@ -0,0 +1,111 @@
+import datetime, json, logging, os, socketserver, threading, pytz
+
+from dateutil import parser
+
+logger = logging.getLogger('heating')
+
+class ControlHandler(socketserver.StreamRequestHandler):
+  '''Answers one JSON command per line with one JSON reply per line.'''
+  def handle(self):
+    for line in self.rfile:
+      if not line.strip():
+        continue
+      try:
+        reply = self.server.control.command(json.loads(line.decode('UTF-8')))
+      except ControlException as e:
+        reply = {'ok': False, 'error': str(e)}
+      except (ValueError, TypeError, AttributeError) as e:
+        reply = {'ok': False, 'error': 'Bad request: ' + str(e)}
+      except Exception as e:
+        logger.exception('Error handling control command')
+        reply = {'ok': False, 'error': str(e)}
+      self.wfile.write(bytes(json.dumps(reply) + '\n', 'UTF-8'))
+
+class ControlServer(object):
+  '''Local control channel on a Unix domain socket.
+
+  Commands:
+    {"command": "boost", "temperature": 21.5, "minutes": 60}
+    {"command": "off", "until": "2026-01-01T07:00:00+00:00"}
+    {"command": "hold", "minutes": 120} or {"command": "hold", "until": ...}
+    {"command": "cancel"}
+    {"command": "status"}
+  '''
+  def __init__(self, path, heating):
+    self.path = path
+    self.heating = heating
+    self.settings = heating.config['control_settings']
+    self._server = None
+    self._thread = None
+
+  def start(self):
+    directory = os.path.dirname(self.path)
+    if directory:
+      os.makedirs(directory, exist_ok = True)
+    if os.path.exists(self.path):
+      #Left over from a previous run
+      os.unlink(self.path)
+    self._server = socketserver.ThreadingUnixStreamServer(self.path, ControlHandler)
+    self._server.daemon_threads = True
+    self._server.control = self
+    os.chmod(self.path, 0o660)
+    self._thread = threading.Thread(target = self._server.serve_forever, name = 'ControlServer')
+    self._thread.daemon = True
+    self._thread.start()
+    logger.info('Listening for control commands on ' + self.path)
+
+  def stop(self):
+    if self._server is None:
+      return
+    self._server.shutdown()
+    self._server.server_close()
+    self._server = None
+    try:
+      os.unlink(self.path)
+    except OSError:
+      pass
+
+  def command(self, request):
+    command = request.get('command')
+    logger.info('Control command ' + str(request))
+    if command == 'boost':
+      temperature = float(request['temperature']) if 'temperature' in request else None
+      if temperature is None or temperature > self.settings['max_boost_temperature'] or \
+          temperature < self.heating.config['heating_settings']['minimum_temperature']:
+        raise ControlException('Boost temperature must be between ' + \
+          str(self.heating.config['heating_settings']['minimum_temperature']) + ' and ' + str(self.settings['max_boost_temperature']))
+      override = self.heating.set_override('boost', temperature, self._end_date(request, self.settings['boost_default_minutes']))
+    elif command == 'off':
+      override = self.heating.set_override('off', 'Off', self._end_date(request, None))
+    elif command == 'hold':
+      if self.heating.current_temp is None:
+        raise ControlException('No current temperature to hold')
+      override = self.heating.set_override('hold', round(self.heating.current_temp, 1), \
+        self._end_date(request, self.settings['hold_default_minutes']))
+    elif command == 'cancel':
+      self.heating.clear_override()
+      override = None
+    elif command == 'status':
+      override = self.heating.overrides.active(pytz.utc.localize(datetime.datetime.utcnow()))
+    else:
+      raise ControlException('Unknown command ' + str(command))
+    return {'ok': True, 'override': self.heating.overrides.as_dict(override), \
+      'desired_temp': self.heating.desired_temp, 'current_temp': self.heating.current_temp}
+
+  def _end_date(self, request, default_minutes):
+    now = pytz.utc.localize(datetime.datetime.utcnow())
+    if 'until' in request:
+      end_date = parser.parse(request['until'])
+      if end_date.tzinfo is None:
+        #Naive times are local
+        end_date = end_date.astimezone(pytz.utc)
+    elif 'minutes' in request or default_minutes is not None:
+      end_date = now + datetime.timedelta(minutes = float(request.get('minutes', default_minutes)))
+    else:
+      raise ControlException('An end time is needed')
+    if end_date <= now:
+      raise ControlException('End time ' + str(end_date) + ' is in the past')
+    return end_date
+
+class ControlException(Exception):
+  pass
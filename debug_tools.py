@@ -0,0 +1,77 @@
+import collections, logging, os, sys, threading, time, traceback, tracemalloc
+
+logger = logging.getLogger('heating')
+
+def profile(seconds, interval_seconds):
+  '''Samples every thread's stack for a while and returns collapsed stacks.
+
+  The result has one "thread;outer;...;inner count" line per distinct stack,
+  the format flamegraph.pl and speedscope read.
+  '''
+  me = threading.get_ident()
+  counts = collections.Counter()
+  deadline = time.monotonic() + seconds
+  while time.monotonic() < deadline:
+    names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+    for ident, frame in sys._current_frames().items():
+      if ident == me:
+        continue
+      stack = []
+      while frame is not None:
+        code = frame.f_code
+        stack.append(code.co_name + ' (' + os.path.basename(code.co_filename) + ':' + str(frame.f_lineno) + ')')
+        frame = frame.f_back
+      stack.append(names.get(ident, str(ident)))
+      counts[';'.join(reversed(stack))] += 1
+    time.sleep(interval_seconds)
+  return ''.join(stack + ' ' + str(count) + '\n' for stack, count in counts.most_common())
+
+def dump_threads():
+  '''Returns the current stack of every thread.'''
+  names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+  output = ''
+  for ident, frame in sys._current_frames().items():
+    output += 'Thread ' + names.get(ident, str(ident)) + ' (' + str(ident) + '):\n'
+    output += ''.join(traceback.format_stack(frame)) + '\n'
+  return output
+
+class MemorySnapshots(object):
+  '''Takes tracemalloc snapshots and compares each with the one before.
+
+  Tracing is only started by the first snapshot, so it costs nothing until
+  someone asks.
+  '''
+  def __init__(self, frames):
+    self.frames = frames
+    self._previous = None
+    self._lock = threading.Lock()
+
+  def snapshot(self, limit):
+    self._lock.acquire()
+    try:
+      if not tracemalloc.is_tracing():
+        logger.info('Starting tracemalloc with ' + str(self.frames) + ' frames')
+        tracemalloc.start(self.frames)
+      snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>')))
+      current, peak = tracemalloc.get_traced_memory()
+      output = 'Traced memory: current ' + str(current) + ' bytes, peak ' + str(peak) + ' bytes\n\n'
+      if self._previous is None:
+        output += 'Top allocations:\n'
+        stats = snapshot.statistics('lineno')
+      else:
+        output += 'Changes since the previous snapshot:\n'
+        stats = snapshot.compare_to(self._previous, 'lineno')
+      output += ''.join(str(stat) + '\n' for stat in stats[:limit])
+      self._previous = snapshot
+      return output
+    finally:
+      self._lock.release()
+
+  def stop(self):
+    self._lock.acquire()
+    self._previous = None
+    if tracemalloc.is_tracing():
+      tracemalloc.stop()
+    self._lock.release()
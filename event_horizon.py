@@ -0,0 +1,94 @@
+import bisect, datetime, json, logging, os, threading, pytz
+
+from dateutil import parser
+
+logger = logging.getLogger('heating')
+
+class EventIndex(object):
+  '''Immutable list of events sorted by start, with interval lookups by time.
+
+  Alongside the start times it keeps the running maximum of the end times,
+  which never decreases, so the first event that could still be going at a
+  given time is found by binary search too.
+  '''
+  def __init__(self, events):
+    self.events = sorted(events, key = lambda event: event['start_date'])
+    self._starts = [event['start_date'] for event in self.events]
+    self._max_ends = []
+    for event in self.events:
+      if self._max_ends and self._max_ends[-1] > event['end_date']:
+        self._max_ends.append(self._max_ends[-1])
+      else:
+        self._max_ends.append(event['end_date'])
+
+  def __len__(self):
+    return len(self.events)
+
+  def __iter__(self):
+    return iter(self.events)
+
+  def __getitem__(self, index):
+    return self.events[index]
+
+  def active(self, now):
+    '''Returns the events that started before now and haven't ended, by start.'''
+    first = bisect.bisect_left(self._max_ends, now)
+    last = bisect.bisect_left(self._starts, now)
+    return [event for event in self.events[first:last] if event['end_date'] >= now]
+
+  def first_unfinished(self, now, predicate):
+    '''Returns the earliest starting event that hasn't ended and matches predicate, or None.'''
+    for index in range(bisect.bisect_left(self._max_ends, now), len(self.events)):
+      event = self.events[index]
+      if event['end_date'] >= now and predicate(event):
+        return event
+    return None
+
+  def starting_after(self, now):
+    return self.events[bisect.bisect_right(self._starts, now):]
+
+class EventHorizon(object):
+  '''The calendar's events for the next few days, saved to disk.
+
+  index is replaced whole on each update so readers never need a lock. The
+  saved copy means a restart with no network still has a schedule to follow.
+  '''
+  def __init__(self, path):
+    self.path = path
+    self._lock = threading.Lock()
+    events = []
+    if os.path.exists(self.path):
+      try:
+        with open(self.path) as json_data:
+          stored = json.load(json_data)
+        now = pytz.utc.localize(datetime.datetime.utcnow())
+        for event in stored:
+          event = {'start_date': parser.parse(event['start_date']), 'end_date': parser.parse(event['end_date']), \
+            'desired_temp': event['desired_temp']}
+          if event['end_date'] >= now:
+            events.append(event)
+        logger.info('Loaded ' + str(len(events)) + ' cached events from ' + self.path)
+      except (IOError, ValueError, KeyError, TypeError) as e:
+        logger.warn('Ignoring unreadable event cache ' + self.path + ': ' + str(e))
+        events = []
+    self.index = EventIndex(events)
+
+  def replace(self, events):
+    self._lock.acquire()
+    try:
+      self.index = EventIndex(events)
+      self._save()
+    finally:
+      self._lock.release()
+
+  def _save(self):
+    temp_path = self.path + '.tmp'
+    try:
+      with open(temp_path, 'w') as json_data:
+        json.dump([{'start_date': event['start_date'].isoformat(), 'end_date': event['end_date'].isoformat(), \
+          'desired_temp': event['desired_temp']} for event in self.index], json_data)
+        json_data.flush()
+        os.fsync(json_data.fileno())
+      os.replace(temp_path, self.path)
+    except (IOError, OSError) as e:
+      logger.warn('Could not write event cache ' + self.path + ': ' + str(e))
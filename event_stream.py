@@ -0,0 +1,84 @@
+import collections, json, logging, queue, threading
+
+logger = logging.getLogger('heating')
+
+class Subscriber(object):
+  def __init__(self, queue_size):
+    self.queue = queue.Queue(maxsize = queue_size)
+    self.dropped = False
+    #Called after each message is queued and when the subscriber is dropped
+    self.wakeup = None
+
+class EventBroadcaster(object):
+  '''Fans Server-Sent Events out to any number of subscribers.
+
+  Each subscriber has a bounded queue; one that falls a whole queue behind
+  is dropped rather than holding anyone else up. The last replay_size
+  messages are kept so a client reconnecting with Last-Event-ID gets what it
+  missed.
+  '''
+  def __init__(self, max_subscribers, queue_size, replay_size):
+    self.max_subscribers = max_subscribers
+    self.queue_size = queue_size
+    self._subscribers = set()
+    self._replay = collections.deque(maxlen = replay_size)
+    self._next_id = 1
+    self._lock = threading.Lock()
+
+  def publish(self, event_type, data):
+    self._lock.acquire()
+    try:
+      event_id = self._next_id
+      self._next_id += 1
+      message = self._format(event_id, event_type, data)
+      self._replay.append((event_id, message))
+      for subscriber in list(self._subscribers):
+        try:
+          subscriber.queue.put_nowait(message)
+        except queue.Full:
+          logger.info('Dropping slow event stream subscriber')
+          subscriber.dropped = True
+          self._subscribers.discard(subscriber)
+        if subscriber.wakeup is not None:
+          subscriber.wakeup()
+      return event_id
+    finally:
+      self._lock.release()
+
+  def subscribe(self, last_event_id = None, initial = None):
+    '''Returns a new Subscriber, or None if there are already too many.
+
+    Messages after last_event_id are queued first if they are still held;
+    otherwise initial, a (type, data) pair, is queued to bring the client up
+    to date. An ID that hasn't been used yet, from before a restart, counts
+    as unknown.
+    '''
+    self._lock.acquire()
+    try:
+      if len(self._subscribers) >= self.max_subscribers:
+        return None
+      subscriber = Subscriber(self.queue_size)
+      missed = None
+      if last_event_id is not None and last_event_id < self._next_id and self._replay and \
+          self._replay[0][0] <= last_event_id + 1:
+        missed = [message for event_id, message in self._replay if event_id > last_event_id]
+      if missed is not None:
+        for message in missed[-self.queue_size:]:
+          subscriber.queue.put_nowait(message)
+      elif initial is not None:
+        subscriber.queue.put_nowait(self._format(self._next_id - 1, initial[0], initial[1]))
+      self._subscribers.add(subscriber)
+      return subscriber
+    finally:
+      self._lock.release()
+
+  def unsubscribe(self, subscriber):
+    self._lock.acquire()
+    self._subscribers.discard(subscriber)
+    self._lock.release()
+
+  def subscriber_count(self):
+    return len(self._subscribers)
+
+  def _format(self, event_id, event_type, data):
+    return ('id: ' + str(event_id) + '\nevent: ' + event_type + '\ndata: ' + json.dumps(data, sort_keys = True) + '\n\n').encode('UTF-8')
@@ -0,0 +1,60 @@
+import json, logging, os, threading
+
+logger = logging.getLogger('heating')
+
+class HandleCache(object):
+  '''UUID to attribute handle map for each device, persisted as JSON.
+
+  Entries are keyed by MAC and remember the firmware revision they were
+  discovered against, so a device that has been reflashed is rediscovered.
+  '''
+  def __init__(self, path):
+    self.path = path
+    self._lock = threading.Lock()
+    self._devices = {}
+    if os.path.exists(self.path):
+      try:
+        with open(self.path) as json_data:
+          self._devices = json.load(json_data)
+        logger.debug('Loaded GATT handles for ' + str(list(self._devices.keys())) + ' from ' + self.path)
+      except (IOError, ValueError) as e:
+        logger.warn('Ignoring unreadable GATT handle cache ' + self.path + ': ' + str(e))
+
+  def get(self, mac):
+    self._lock.acquire()
+    device = self._devices.get(mac)
+    if device is not None:
+      device = {'firmware': device['firmware'], 'firmware_handle': device['firmware_handle'], 'handles': dict(device['handles'])}
+    self._lock.release()
+    return device
+
+  def reset(self, mac, firmware, firmware_handle):
+    '''Starts a fresh entry for a device running the given firmware.'''
+    self._lock.acquire()
+    self._devices[mac] = {'firmware': firmware, 'firmware_handle': firmware_handle, 'handles': {}}
+    self._save()
+    self._lock.release()
+
+  def store(self, mac, uuid, handle):
+    self._lock.acquire()
+    if mac in self._devices:
+      self._devices[mac]['handles'][uuid] = handle
+      self._save()
+    self._lock.release()
+
+  def invalidate(self, mac):
+    self._lock.acquire()
+    if mac in self._devices:
+      logger.info('Discarding cached GATT handles for ' + mac)
+      del self._devices[mac]
+      self._save()
+    self._lock.release()
+
+  def _save(self):
+    temp_path = self.path + '.tmp'
+    try:
+      with open(temp_path, 'w') as json_data:
+        json.dump(self._devices, json_data)
+      os.replace(temp_path, self.path)
+    except (IOError, OSError) as e:
+      logger.warn('Could not write GATT handle cache ' + self.path + ': ' + str(e))
@@ -1,14 +1,33 @@
 #!/usr/bin/python
-import datetime, sys, threading, os, time, inspect, pytz, argparse, smtplib, uuid, urllib.request, urllib.parse, urllib.error, json
+import datetime, sys, threading, os, time, inspect, pytz, argparse, smtplib, json
 import logging, logging.config, logging.handlers
-from temp_sensor import TempSensor, DisconnectedException, NoTagsFoundException, NoTemperatureException
+from temp_sensor import TempSensor, SensorTag, MetaWear, SensorScanner, DisconnectedException, NoTemperatureException
 from relay import Relay
+from ble_connection import BLEConnection
+from sensor_poller import SensorPoller
+from gatt_cache import HandleCache
+from polling_policy import PollingPolicy
+from adapter_placement import AdapterPlacement, HciBackend
+from history import History
+from debug_tools import MemorySnapshots
+from state import StatePublisher
+from event_stream import EventBroadcaster
+from overrides import Overrides
+from status_export import StatusExport
+from push_sources import PushSources
+from calendar_sync import CalendarSync
+from watch_channels import WatchChannels, CalendarWatchBackend
+from refresh_queue import RefreshQueue
+from event_horizon import EventHorizon
+from schedule_source import GoogleCalendarSource, IcsSource
+from weather import Weather, CachedHttpClient, OpenMeteoProvider, FileWeatherProvider
+from control_socket import ControlServer
+from tracing import TRACER
+from metrics import REGISTRY, Gauge, acquire, PROCESS_SECONDS, FETCH_SECONDS, SCHEDULER_MISFIRES
 #from btrelay import BTRelay
 from usbmultiplerelays import USBMultipleRelays
 from httpserver import *
 
-from dateutil import parser
-from apiclient import discovery
 from googleapiclient.errors import HttpError
 from email.mime.text import MIMEText
 from apscheduler.schedulers.blocking import BlockingScheduler
@@ -40,41 +59,122 @@ class Heating(object):
     self.heating_trigger = None
     self.preheat_trigger = None
     self.event_trigger = None
+    self.override_trigger = None
+    self.watch_trigger = None
     #Sensible defaults
-    self.events = None
+    self.horizon = None
     self.desired_temp = self.config['heating_settings']['minimum_temperature']
     self.current_temp = None
+    self.current_sensor = None
     self.proportional_time = 0
     self.time_on = None
     self.time_off = None
-    self.event_sync_id = None
+    self.calendar = None
+    self.schedule_source = None
+    self.watch_channels = None
+    self.refresh_queue = None
 
     self.relays = None
     self.relays_heating = None
     self.relays_preheat = None
 
     self.http_server = None
+    self.control_server = None
+    self.overrides = None
+    self.status_export = None
+    self.history = None
+    self.memory_snapshots = None
+    self.state = StatePublisher()
+    self.event_stream = EventBroadcaster(self.config['stream_settings']['max_subscribers'], \
+      self.config['stream_settings']['queue_size'], self.config['stream_settings']['replay_size'])
     self.temp_sensors = {}
+    self.push_sources = None
+    self.sensor_poller = None
+    self.sensor_scanner = None
+    self.polling_policy = None
+    self.adapter_placement = None
     self.sched = None
 
+    self.weather = None
     self.outside_temp = None
     self.outside_apparent_temp = None
 
   def start(self):
     logger.info('Starting')
-    self.credentials = self.get_credentials()
-
-    self.darksky_details = self.get_darksky_details()
+    if self.config['schedule_settings']['source'] == 'ics':
+      logger.info('Reading the schedule from ' + self.config['schedule_settings']['ics_file'])
+      self.schedule_source = IcsSource(self.config['schedule_settings']['ics_file'])
+    else:
+      self.credentials = self.get_credentials()
+      self.calendar = CalendarSync(self.credentials, self.config['calendar_settings']['calendar_id'], \
+          self.config['calendar_settings']['calendar_timeout_seconds'], self.config['calendar_settings']['discovery_cache_file'], \
+          self.config['calendar_settings']['horizon_days'] + self.config['calendar_settings']['sync_margin_days'])
+      self.schedule_source = GoogleCalendarSource(self.calendar)
+      self.watch_channels = WatchChannels(CalendarWatchBackend(self.calendar), self.config['calendar_settings']['calendar_id'], \
+          self.config['calendar_settings']['webhook_address'], \
+          self.config['calendar_settings']['watch_ttl_hours'] * 60 * 60, \
+          self.config['calendar_settings']['watch_renew_before_minutes'] * 60, \
+          self.config['calendar_settings']['watch_retry_minutes'] * 60, \
+          self.config['calendar_settings']['watch_state_file'])
+    self.refresh_queue = RefreshQueue(self.get_next_event, \
+        self.config['calendar_settings']['refresh_debounce_seconds'], \
+        self.config['calendar_settings']['refresh_max_delay_seconds'])
+    self.refresh_queue.start()
+    self.history = History(self.config['history_settings']['directory'])
+    self.overrides = Overrides(self.config['control_settings']['overrides_file'])
+    #Carry on with the cached schedule until the calendar can be reached
+    self.horizon = EventHorizon(self.config['calendar_settings']['horizon_file'])
+    if self.config['status_settings']['file']:
+      self.status_export = StatusExport(self.config['status_settings']['file'])
+    if self.config['debug_settings']['enabled']:
+      logger.warn('Debug endpoints are enabled')
+      self.memory_snapshots = MemorySnapshots(self.config['debug_settings']['tracemalloc_frames'])
+
+    self.weather = self.get_weather()
 
     logger.debug('Setting up scheduler and error handler')
     self.sched = BlockingScheduler()
     self.sched.add_listener(self.scheduler_listener, EVENT_JOB_ERROR)
-
-    logger.debug('Searching for temperature sensors')
-    try:
-      self.find_temp_sensors()
-    except NoTagsFoundException as e:
-      pass
+    self.sched.add_listener(self.misfire_listener, EVENT_JOB_MISSED)
+    self.register_metrics()
+    TRACER.configure(self.config['trace_settings']['buffer_size'], self.config['trace_settings']['file'])
+
+    self.sensor_poller = SensorPoller(self.config['sensor_settings']['max_concurrent_reads'], \
+        self.config['sensor_settings']['read_timeout_seconds'])
+    self.polling_policy = PollingPolicy(self.config['heating_settings'], self.config['sensor_settings'])
+    self.push_sources = PushSources(self.config['push_settings']['sources'], \
+        self.config['sensor_settings']['sample_buffer_size'], \
+        self.config['sensor_settings']['sample_window_seconds'], \
+        self.config['push_settings']['max_future_seconds'])
+
+    BLEConnection.initial_backoff_seconds = self.config['sensor_settings']['reconnect_initial_backoff_seconds']
+    BLEConnection.max_backoff_seconds = self.config['sensor_settings']['reconnect_max_backoff_seconds']
+    BLEConnection.give_up_seconds = self.config['sensor_settings']['reconnect_give_up_seconds']
+    TempSensor.handle_cache = HandleCache(self.config['sensor_settings']['gatt_cache_file'])
+    TempSensor.sample_buffer_size = self.config['sensor_settings']['sample_buffer_size']
+    TempSensor.sample_window_seconds = self.config['sensor_settings']['sample_window_seconds']
+    TempSensor.max_sample_age_seconds = self.config['sensor_settings']['max_sample_age_seconds']
+    SensorTag.use_notifications = self.config['sensor_settings']['sensortag_notifications']
+    SensorTag.notification_period_ms = self.config['sensor_settings']['sensortag_notification_period_ms']
+    MetaWear.use_logging = self.config['sensor_settings']['metawear_logging']
+    MetaWear.log_period_seconds = self.config['sensor_settings']['metawear_log_period_seconds']
+    MetaWear.download_interval_seconds = self.config['sensor_settings']['metawear_download_interval_seconds']
+
+    self.adapter_placement = AdapterPlacement(HciBackend(), \
+        self.config['sensor_settings']['degraded_read_seconds'], \
+        self.config['sensor_settings']['degraded_rssi'], \
+        self.config['sensor_settings']['degraded_failed_reads'], \
+        self.config['sensor_settings']['adapter_move_cooldown_seconds'], \
+        self.config['sensor_settings']['scan_adapter'])
+
+    logger.debug('Starting background scan for temperature sensors')
+    self.sensor_scanner = SensorScanner(self.temp_sensors, \
+        self.config['sensor_settings']['scan_window_seconds'], \
+        self.config['sensor_settings']['scan_interval_seconds'], \
+        self.config['sensor_settings']['scan_passive'], \
+        self.config['sensor_settings']['scan_adapter'], \
+        self.adapter_placement)
+    self.sensor_scanner.start()
 
     logger.debug('Searching for relay')
     #self.relay = BTRelay.find_relay()
@@ -94,89 +194,127 @@ class Heating(object):
     #Get new events every X minutes
     self.sched.add_job(self.get_next_event, trigger = 'cron', \
         next_run_time = pytz.utc.localize(datetime.datetime.utcnow()), hour = '*/' + str(self.config['calendar_settings']['update_calendar_interval_hours']), minute = 0)
+    if self.watch_channels is not None:
+      self.watch_trigger = self.sched.add_job(self.renew_watch_channel, trigger = 'date', \
+          run_date = pytz.utc.localize(datetime.datetime.utcnow()), name = 'Calendar watch channel')
+    else:
+      #Pick up edits to the schedule file without waiting for the next refresh
+      self.sched.add_job(self.check_schedule_source, trigger = 'interval', \
+          seconds = self.config['schedule_settings']['ics_check_seconds'], name = 'Schedule file check', coalesce = True)
 
     self.sched.add_job(self.update_outside_temperature, trigger = 'cron', \
         next_run_time = pytz.utc.localize(datetime.datetime.utcnow()), hour = '*', minute = '*/15')
 
-    #Scan for new devices every minute
-    self.sched.add_job(self.find_temp_sensors, trigger = 'cron', \
-        next_run_time = pytz.utc.localize(datetime.datetime.utcnow()), hour = '*', minute = '*')
+    #Read whichever sensors are due, checking as often as the shortest poll interval
+    self.sched.add_job(self.poll_temperatures, trigger = 'interval', \
+        start_date = datetime.datetime.now(), seconds = self.config['sensor_settings']['min_poll_interval_seconds'], \
+        name = 'Temperature poll', max_instances = 1, coalesce = True)
 
     HttpHandler.heating = self
     logger.debug('Starting HTTP server')
-    self.http_server = ThreadedHTTPServer(('localhost', 8080), HttpHandler)
-    http_server_thread = threading.Thread(target=self.http_server.serve_forever)
+    http_settings = self.config['http_settings']
+    self.http_server = AsyncHTTPServer((http_settings['host'], http_settings['port']), HttpHandler, \
+        max_connections = http_settings['max_connections'], max_workers = http_settings['max_workers'], \
+        keepalive_seconds = http_settings['keepalive_seconds'])
+    http_server_thread = threading.Thread(target=self.http_server.serve_forever, name = 'HttpServer')
     http_server_thread.setDaemon(True) # don't hang on exit
     http_server_thread.start()
 
+    self.set_override_trigger()
+    self.control_server = ControlServer(self.config['control_settings']['socket_path'], self)
+    try:
+      self.control_server.start()
+    except OSError as e:
+      logger.error('Could not open control socket ' + self.config['control_settings']['socket_path'] + \
+        ', running without it: ' + str(e))
+
     logger.debug('Starting scheduler')
     try:
       self.sched.start()
     except Exception as e:
       logger.error('Error in scheduler: ' + str(e))
       self.http_server.shutdown()
+      self.control_server.stop()
+      self.refresh_queue.stop()
       self.sched.shutdown(wait = False)
 
   def scheduler_listener(self, event):
     if event.exception is not None or event.code == EVENT_JOB_MAX_INSTANCES:
       logger.error('Error in scheduled event: ' + str(event))
       logger.debug(type(event.exception))
-      if not isinstance(event.exception, NoTemperatureException) and not isinstance(event.exception, NoTagsFoundException):
+      if not isinstance(event.exception, NoTemperatureException):
         logger.error('Killing all the things')
         raise Exception(str(event))
         #self.http_server.shutdown()
         #self.sched.shutdown(wait = False)
         #exit(1)
 
-  def find_temp_sensors(self):
-    self.temp_sensors = TempSensor.find_temp_sensors(self.temp_sensors)
-    for sensor in list(self.temp_sensors.values()):
-      if sensor.temp_job_id is None:
-        logger.info('Setting scheduler job for ' + sensor.mac)
-        #Get a new temperature every minute
-        sensor.temp_job_id = self.sched.add_job(self.get_temperature, trigger = 'interval', \
-          start_date = datetime.datetime.now(), seconds = self.config['heating_settings']['update_temperature_interval_seconds'], \
-          name = sensor.mac + ' temperature job', args = (sensor,))
+  def misfire_listener(self, event):
+    logger.warn('Scheduled job missed its run time: ' + str(event))
+    SCHEDULER_MISFIRES.inc()
+
+  def register_metrics(self):
+    REGISTRY.register(Gauge('heating_current_temperature', 'Overall indoor temperature', lambda: self.current_temp))
+    REGISTRY.register(Gauge('heating_desired_temperature', 'Desired temperature', lambda: self.desired_temp))
+    REGISTRY.register(Gauge('heating_proportional_minutes', 'Minutes per interval the heating is on for', lambda: self.proportional_time))
+    REGISTRY.register(Gauge('heating_relay_on', 'Whether the heating relay is on', \
+      lambda: self.relays_heating._status if self.relays_heating else None))
+    REGISTRY.register(Gauge('heating_preheat_relay_on', 'Whether the preheat relay is on', \
+      lambda: self.relays_preheat._status if self.relays_preheat else None))
+    REGISTRY.register(Gauge('heating_sensors', 'Temperature sensors known', lambda: len(self.temp_sensors)))
+    REGISTRY.register(Gauge('heating_outside_temperature', 'Outside temperature', lambda: self.outside_temp))
+    REGISTRY.register(Gauge('heating_weather_age_seconds', 'Time since the weather was last fetched', lambda: self.weather.age()))
+    REGISTRY.register(Gauge('heating_weather_latency_seconds', 'Time taken by the last weather fetch', lambda: self.weather.latency_seconds))
 
   def heating_on(self, proportion):
     self.time_on = pytz.utc.localize(datetime.datetime.utcnow())
     self.time_off = None
     self.proportional_time = proportion
-    logger.debug('Getting relay lock')
-    self.relay_lock.acquire()
-    logger.debug('Got relay lock')
-    self.relays_heating.on()
-    logger.debug('Releasing relay lock')
-    self.relay_lock.release()
+    with TRACER.span('heating_on'):
+      logger.debug('Getting relay lock')
+      acquire(self.relay_lock, 'relay')
+      logger.debug('Got relay lock')
+      self.relays_heating.on()
+      logger.debug('Releasing relay lock')
+      self.relay_lock.release()
+    self.history.record('heating', 1)
+    self.history.record('proportion', proportion)
     self.set_heating_trigger(proportion, True)
 
   def heating_off(self, proportion):
     self.time_off = pytz.utc.localize(datetime.datetime.utcnow())
     self.time_on = None
-    logger.debug('Getting relay lock')
-    self.relay_lock.acquire()
-    logger.debug('Got relay lock')
-    self.relays_heating.off()
-    logger.debug('Releasing relay lock')
-    self.relay_lock.release()
+    with TRACER.span('heating_off'):
+      logger.debug('Getting relay lock')
+      acquire(self.relay_lock, 'relay')
+      logger.debug('Got relay lock')
+      self.relays_heating.off()
+      logger.debug('Releasing relay lock')
+      self.relay_lock.release()
+    self.history.record('heating', 0)
+    self.history.record('proportion', proportion)
     self.set_heating_trigger(proportion, False)
 
   def preheat_on(self, time_off):
-    logger.debug('Getting relay lock')
-    self.relay_lock.acquire()
-    logger.debug('Got relay lock')
-    self.relays_preheat.on()
-    logger.debug('Releasing relay lock')
-    self.relay_lock.release()
+    with TRACER.span('preheat_on'):
+      logger.debug('Getting relay lock')
+      acquire(self.relay_lock, 'relay')
+      logger.debug('Got relay lock')
+      self.relays_preheat.on()
+      logger.debug('Releasing relay lock')
+      self.relay_lock.release()
+    self.history.record('preheat', 1)
     self.set_preheat_trigger(time_off)
 
   def preheat_off(self):
-    logger.debug('Getting relay lock')
-    self.relay_lock.acquire()
-    logger.debug('Got relay lock')
-    self.relays_preheat.off()
-    logger.debug('Releasing relay lock')
-    self.relay_lock.release()
+    with TRACER.span('preheat_off'):
+      logger.debug('Getting relay lock')
+      acquire(self.relay_lock, 'relay')
+      logger.debug('Got relay lock')
+      self.relays_preheat.off()
+      logger.debug('Releasing relay lock')
+      self.relay_lock.release()
+    self.history.record('preheat', 0)
 
   def check_relay_states(self):
     logger.debug('Checking states ' + str(self.relays.all_status()))
@@ -225,60 +363,136 @@ class Heating(object):
     self.preheat_trigger = self.sched.add_job(\
       self.process, trigger='date', run_date=time_off, name='Preheat off at ' + str(time_off.astimezone(get_localzone())))
 
+  def set_override(self, kind, desired_temp, end_date):
+    '''Overrides the calendar until end_date and acts on it straight away.'''
+    override = self.overrides.set(kind, desired_temp, end_date)
+    #Start the proportion again as for a new event
+    self.time_off = None
+    self.set_override_trigger()
+    self.process()
+    return override
+
+  def clear_override(self):
+    override = self.overrides.clear()
+    if override is not None:
+      self.time_off = None
+      self.set_override_trigger()
+      self.process()
+    return override
+
+  def end_override(self):
+    now = pytz.utc.localize(datetime.datetime.utcnow())
+    if self.overrides.active(now) is None:
+      self.time_off = None
+    self.set_override_trigger()
+    self.process()
 
-  def get_temperature(self, sensor):
-    try:
-      sensor.get_ambient_temp()
-    except NoTemperatureException as e:
-      logger.warn('Removing sensor ' + sensor.mac + ' from sensors list due to disconnection')
+  def set_override_trigger(self):
+    if self.override_trigger is not None:
       try:
-        sensor.temp_job_id.remove()
+        self.override_trigger.remove()
       except JobLookupError as e:
         pass
-      del self.temp_sensors[sensor.mac]
+      self.override_trigger = None
+    override = self.overrides.active(pytz.utc.localize(datetime.datetime.utcnow()))
+    if override is not None:
+      end_date = override['end_date']
+      logger.info('Override ends at ' + str(end_date.astimezone(get_localzone())))
+      self.override_trigger = self.sched.add_job(\
+        self.end_override, trigger='date', run_date=end_date, name='Override end at ' + str(end_date.astimezone(get_localzone())))
+
+
+  def poll_temperatures(self):
+    now = time.time()
+    sensors = [sensor for sensor in list(self.temp_sensors.values()) if sensor.next_read <= now]
+    #Pushed readings don't wait for a BLE sensor to be due
+    if not self.push_sources.take_updated() and not sensors:
+      return
+
+    with TRACER.span('control_cycle', sensors = len(sensors)):
+      self.read_sensors(sensors, now)
 
-    self.update_current_temp()
+  def read_sensors(self, sensors, now):
+    #Keep the scanner off the adapter while the sensors are read
+    #Reads of sensors still backing off fail without trying the link
+    waiting = set(sensor.mac for sensor in sensors if sensor.connection.waiting)
+    acquire(TempSensor._scanning_lock, 'scanning')
+    try:
+      readings, failures = self.sensor_poller.poll(sensors)
+    finally:
+      TempSensor._scanning_lock.release()
+    for mac, e in failures.items():
+      sensor = self.temp_sensors.get(mac)
+      if sensor is None or not sensor.connection.gave_up:
+        #Keep the sensor while it reconnects in the background
+        continue
+      logger.warn('Removing sensor ' + mac + ' from sensors list after ' + \
+        str(self.config['sensor_settings']['reconnect_give_up_seconds']) + 's disconnected')
+      sensor.disconnect()
+      self.temp_sensors.pop(mac, None)
+      self.adapter_placement.forget(mac)
+
+    for sensor in sensors:
+      if sensor.mac in self.temp_sensors and sensor.last_read_seconds is not None:
+        self.adapter_placement.record_read(sensor, sensor.last_read_seconds, sensor.mac in readings, \
+          attempted = sensor.mac not in waiting)
+      sensor.last_read = now
+      if sensor.mac in readings:
+        sensor.previous_amb_temp = sensor.amb_temp_at_last_poll
+        sensor.amb_temp_at_last_poll = readings[sensor.mac]
+        #Every measurement since the last read, stamped with when it was measured so a
+        #repeated old value still ages out; logged sensors bring back many at a time
+        for measured, value in sensor.take_samples():
+          if sensor.samples.last_timestamp is None or measured > sensor.samples.last_timestamp:
+            sensor.samples.append(measured, value)
+            self.history.record(self.sensor_series(sensor.mac), value, measured)
+
+    #Every sensor counts with its recent samples, whether or not it was due this cycle
+    aggregates = {}
+    for mac, sensor in list(self.temp_sensors.items()):
+      value = sensor.samples.aggregate(self.config['sensor_settings']['sample_aggregate'], now)
+      if value is not None:
+        aggregates[mac] = value
+    aggregates.update(self.push_sources.aggregates(self.config['sensor_settings']['sample_aggregate'], now))
+
+    try:
+      self.update_current_temp(aggregates)
+    finally:
+      self.polling_policy.schedule(list(self.temp_sensors.values()), self)
+
+  def sensor_series(self, mac):
+    '''History series name for one sensor's own readings.'''
+    return 'sensor_' + mac.replace(':', '').lower()
+
+  def update_current_temp(self, readings):
+    with TRACER.span('update_current_temp'):
+      self.set_current_temp(readings)
+    self.process()
+
+    try:
+      self.history.record('desired_temp', float(self.desired_temp))
+    except ValueError:
+      pass
 
-  def update_current_temp(self):
-    temps = []
-    for mac, sensor in self.temp_sensors.items():
-      if sensor.amb_temp is not None:
-        temps.append(sensor.amb_temp)
+  def set_current_temp(self, readings):
+    temps = list(readings.values())
 
     if not temps:
       raise NoTemperatureException()
     #self.current_temp = sum(temps) / float(len(temps))
     self.current_temp = min(temps)
+    self.current_sensor = min(readings, key = readings.get)
     logger.info('Overall temperature is now ' + str(self.current_temp) + ' from ' + str(temps))
-
-    self.process()
+    self.history.record('temperature', self.current_temp)
 
   def get_next_event(self):
-    self.calendar_lock.acquire()
-    http = self.credentials.authorize(httplib2.Http(timeout=self.config['calendar_settings']['calendar_timeout_seconds']))
-    service = discovery.build('calendar', 'v3', http=http)
+    acquire(self.calendar_lock, 'calendar')
 
-    now = datetime.datetime.utcnow().isoformat() + 'Z'
     logger.debug('Getting the next event')
     try:
-      eventsResult = service.events().list(
-        calendarId=self.config['calendar_settings']['calendar_id'], timeMin=now, maxResults=3, singleEvents=True, orderBy='startTime').execute()
-      events = eventsResult.get('items', [])
-      self.event_sync_id = str(uuid.uuid4())
-      logger.debug('Sending request: ' + str({'id':self.event_sync_id, \
-              'type':'web_hook', \
-              'address':'https://www.steev.me.uk/heating/events', \
-              'expiration':(int(time.time())+(self.config['calendar_settings']['update_calendar_interval_hours']*60*60))*1000 \
-             }))
-      hook_response = service.events().watch(calendarId=self.config['calendar_settings']['calendar_id'], \
-        body={'id':self.event_sync_id, \
-              'type':'web_hook', \
-              'address':'https://www.steev.me.uk/heating/events', \
-              'expiration':(int(time.time())+(self.config['calendar_settings']['update_calendar_interval_hours']*60*60))*1000 \
-             })\
-        .execute()
-      if hook_response is not None:
-        logger.debug('Got response' + str(hook_response) + ' from web_hook call')
+      with FETCH_SECONDS.time(self.schedule_source.name):
+        events = self.schedule_source.events(pytz.utc.localize(datetime.datetime.utcnow()) + \
+          datetime.timedelta(days = self.config['calendar_settings']['horizon_days']))
     except HttpError as e:
       logger.error('HttpError, resp = ' + str(e.resp) + '; content = ' + str(e.content))
       logger.exception(e)
@@ -294,18 +508,9 @@ class Heating(object):
       counter = 0
       for event in events:
         counter += 1
-        start = event['start'].get('dateTime', event['start'].get('date'))
-        start_date = parser.parse(start)
-        end = event['end'].get('dateTime', event['end'].get('date'))
-        end_date = parser.parse(end)
-
-        try:
-          desired_temp = float(event['summary'])
-        except ValueError:
-          if event['summary'].lower() == 'on':
-            desired_temp = 'On'
-          if event['summary'].lower() == 'preheat':
-            desired_temp = 'Preheat'
+        start_date = event['start_date']
+        end_date = event['end_date']
+        desired_temp = event['desired_temp']
 
         logger.info('Event ' + str(counter) + ' is ' + str(start_date.astimezone(get_localzone())) + \
           ' to ' + str(end_date.astimezone(get_localzone())) + ': ' + str(desired_temp))
@@ -323,47 +528,150 @@ class Heating(object):
             trigger='date', run_date=end_date, name='Event end at ' + str(end_date.astimezone(get_localzone())))
 
           #Tell the processing that this is a new event so it resets the proportion to start again
-          if self.events is None or start_date != self.events[0]['start_date'] or end_date != self.events[0]['end_date'] or desired_temp != self.events[0]['desired_temp']:
+          previous = self.horizon.index
+          if not previous or start_date != previous[0]['start_date'] or end_date != previous[0]['end_date'] or desired_temp != previous[0]['desired_temp']:
             logger.info('New event starting, resetting time off.')
             self.time_off = None
 
-      self.events = parsed_events
-    else:
-      self.events = None
+    self.horizon.replace(parsed_events)
 
     self.calendar_lock.release()
     self.process()
 
-  def update_outside_temperature(self):
+  def check_schedule_source(self):
+    if self.schedule_source.changed():
+      logger.info('Schedule source has changed, refreshing')
+      self.refresh_queue.request()
+
+  def renew_watch_channel(self):
+    '''Makes sure the calendar watch channel is open and sets a trigger to renew it.'''
+    renew_at = time.time() + self.watch_channels.retry_seconds
+    acquire(self.calendar_lock, 'calendar')
     try:
-      logger.info('Getting new outside temperature')
-      with urllib.request.urlopen('https://api.darksky.net/forecast/' + self.darksky_details['api_key'] + '/' + self.darksky_details['latlong'] + '?exclude=[minutely,hourly,daily]&units=si') as darksky_url:
-        data = json.loads(darksky_url.read().decode())
-      logger.debug(str(data))
-
-      if data['currently']:
-        if data['currently']['apparentTemperature']:
-          self.outside_apparent_temp = data['currently']['apparentTemperature']
-          logger.info('Got outside apparent temperature: ' + str(self.outside_apparent_temp))
-        if data['currently']['temperature']:
-          self.outside_temp = data['currently']['temperature']
-          logger.info('Got outside temperature: ' + str(self.outside_temp))
+      with FETCH_SECONDS.time('calendar_watch'):
+        renew_at = self.watch_channels.ensure()
     except Exception as e:
-      pass
+      #Whatever went wrong, the next check still has to be scheduled
+      logger.exception(e)
+    finally:
+      self.calendar_lock.release()
+
+    run_date = pytz.utc.localize(datetime.datetime.utcfromtimestamp(renew_at))
+    logger.debug('Checking calendar watch channel again at ' + str(run_date.astimezone(get_localzone())))
+    self.watch_trigger = self.sched.add_job(self.renew_watch_channel, trigger = 'date', \
+        run_date = run_date, name = 'Calendar watch channel at ' + str(run_date.astimezone(get_localzone())))
+
+  def stop_stray_watch_channel(self, channel_id, resource_id):
+    acquire(self.calendar_lock, 'calendar')
+    try:
+      self.watch_channels.stop_stray(channel_id, resource_id)
+    finally:
+      self.calendar_lock.release()
+
+  def update_outside_temperature(self):
+    logger.info('Getting new outside temperature')
+    with FETCH_SECONDS.time('weather'):
+      self.weather.update()
+
+    #Keep using the last reading while it's fresh enough, then admit we don't know
+    age = self.weather.age()
+    if age is not None and age <= self.config['weather_settings']['max_age_seconds']:
+      self.outside_temp = self.weather.temperature
+      self.outside_apparent_temp = self.weather.apparent_temperature
+    else:
+      self.outside_temp = None
+      self.outside_apparent_temp = None
+    self.publish_state()
 
   def process(self):
+    with TRACER.span('process'):
+      self._process()
+    self.publish_state()
+
+  def publish_state(self):
+    '''Publishes an immutable snapshot of the current state for /state.'''
+    now = pytz.utc.localize(datetime.datetime.utcnow())
+    sensors = {}
+    for mac, sensor in list(self.temp_sensors.items()):
+      sensors[mac] = {'temperature': sensor.amb_temp, 'rssi': sensor.rssi}
+
+    next_switch = None
+    if self.heating_trigger is not None and self.heating_trigger.next_run_time is not None and \
+        self.heating_trigger.next_run_time > now:
+      next_switch = self.heating_trigger.next_run_time.isoformat()
+
+    current_events = []
+    for event in self.overrides.apply(self.horizon.index, now).active(now):
+      if event['start_date'] <= now < event['end_date']:
+        current_events.append({'start': event['start_date'].isoformat(), 'end': event['end_date'].isoformat(), \
+          'desired_temp': event['desired_temp']})
+
+    override = self.overrides.active(now)
+    if self.status_export is not None:
+      self.export_status(override)
+
+    #Only tell stream clients about changes to what drives the heating
+    watched = ('current_temp', 'desired_temp', 'proportional_time', 'heating_on', 'preheat_on', 'current_events', 'override')
+    return self.state.publish({
+      'sensors': sensors,
+      'current_temp': self.current_temp,
+      'current_sensor': self.current_sensor,
+      'desired_temp': self.desired_temp,
+      'proportional_time': self.proportional_time,
+      'heating_on': bool(self.relays_heating._status) if self.relays_heating else None,
+      'preheat_on': bool(self.relays_preheat._status) if self.relays_preheat else None,
+      'next_switch': next_switch,
+      'current_events': current_events,
+      'override': self.overrides.as_dict(override),
+      'outside_temp': self.outside_temp,
+      'outside_apparent_temp': self.outside_apparent_temp
+    }, watched, lambda snapshot: self.event_stream.publish('state', {'changed': snapshot.changed, 'state': snapshot.data}))
+
+  def export_status(self, override):
+    '''Rewrites the shared memory status record.'''
+    flags = 0
+    if self.relays_heating and self.relays_heating._status:
+      flags |= StatusExport.HEATING_ON
+    if self.relays_preheat and self.relays_preheat._status:
+      flags |= StatusExport.PREHEAT_ON
+    if override is not None:
+      flags |= StatusExport.OVERRIDE
+    try:
+      desired_temp = float(self.desired_temp)
+      desired_mode = 0
+    except ValueError:
+      desired_temp = None
+      desired_mode = StatusExport.MODES.index(self.desired_temp) if self.desired_temp in StatusExport.MODES else 0
+
+    self.status_export.write({
+      'current_temp': self.current_temp,
+      'desired_temp': desired_temp,
+      'proportional_time': self.proportional_time,
+      'time_on': self.time_on.timestamp() if self.time_on else None,
+      'time_off': self.time_off.timestamp() if self.time_off else None,
+      'outside_temp': self.outside_temp,
+      'outside_apparent_temp': self.outside_apparent_temp,
+      'flags': flags,
+      'desired_mode': desired_mode
+    }, [(mac, sensor.amb_temp, sensor.last_seen) for mac, sensor in list(self.temp_sensors.items())])
+
+  def _process(self):
     logger.debug('Processing')
     #Main calculations. Figure out whether the heating needs to be on or not.
     if self.current_temp is None:
       return
 
-    self.processing_lock.acquire()
+    acquire(self.processing_lock, 'processing')
+    started = time.monotonic()
 
     current_time = pytz.utc.localize(datetime.datetime.utcnow())
     current_temp = self.current_temp
+    #Any override comes first and hides the calendar while it lasts
+    events = self.overrides.apply(self.horizon.index, current_time)
     time_due_on  = None
     have_temp_event = False
     forced_on = False
+    forced_off = False
     have_preheat = False
 
     if current_temp < self.config['heating_settings']['minimum_temperature']:
@@ -372,52 +680,41 @@ class Heating(object):
       self.desired_temp = str(self.config['heating_settings']['minimum_temperature'])
       self.heating_on(self.config['heating_settings']['proportional_heating_interval_minutes'])
 
-    elif self.events is not None:
-      #Find preheat events
-      index = -1
-      while index < 3:
-        index += 1
+    elif events:
+      active_events = events.active(current_time)
 
-        if index >= len(self.events):
+      #Find preheat events
+      for event in active_events:
+        if event['desired_temp'] == 'Preheat':
+          have_preheat = True
+          if not(self.relays_preheat._status):
+            logger.info('Preheat on')
+            self.preheat_on(event['end_date'])
           break
 
-        if self.events[index]['desired_temp'] == 'Preheat':
-          if self.events[index]['start_date'] < current_time and not self.events[index]['end_date'] < current_time:
-            have_preheat = True
-            if not(self.relays_preheat._status):
-              logger.info('Preheat on')
-              self.preheat_on(self.events[index]['end_date'])
-            break
-
       if (not have_preheat) and self.relays_preheat._status:
         self.preheat_off()
 
-      #Find normal events
-      index = -1
-      next_time = None
+      #Find events forcing the heating on or off
+      for event in active_events:
+        if event['desired_temp'] == 'Off':
+          forced_off = True
+        elif event['desired_temp'] == 'On':
+          forced_on = True
 
-      while index < 3:
-        index += 1
+      if forced_on and not forced_off and not(self.relays_heating._status):
+        logger.info('Heating forced on')
+        self.heating_on(self.config['heating_settings']['proportional_heating_interval_minutes'])
 
-        if index >= len(self.events):
-          break
-
-        if self.events[index]['desired_temp'] == 'Preheat':
-          continue
-        elif self.events[index]['desired_temp'] == 'On':
-          if self.events[index]['start_date'] < current_time and not self.events[index]['end_date'] < current_time:
-            forced_on = True
-            if not(self.relays_heating._status):
-              logger.info('Heating forced on')
-              self.heating_on(self.config['heating_settings']['proportional_heating_interval_minutes'])
-        else:
-          have_temp_event = True
-          break
+      #Find the next normal event
+      temp_event = events.first_unfinished(current_time, \
+        lambda event: event['desired_temp'] not in ('On', 'Preheat', 'Off'))
+      have_temp_event = temp_event is not None and not forced_off
 
     if have_temp_event:
-      next_time =     self.events[index]['start_date']
-      next_time_end = self.events[index]['end_date']
-      next_temp =     self.events[index]['desired_temp']
+      next_time =     temp_event['start_date']
+      next_time_end = temp_event['end_date']
+      next_temp =     temp_event['desired_temp']
 
       logger.debug('Processing data: ' + str(next_time.astimezone(get_localzone())) + \
         ' to ' + str(next_time_end.astimezone(get_localzone())) + ', ' + str(next_temp))
@@ -437,9 +734,9 @@ class Heating(object):
           logger.info('Currently in an event starting at ' + str(next_time.astimezone(get_localzone())) + \
             ' ending at ' + str(next_time_end.astimezone(get_localzone())) + ' temp diff is ' + str(temp_diff))
 
-        #Check all events for warm-up temperature
-        for event in self.events:
-          if event['desired_temp'] == 'On' or event['desired_temp'] == 'Preheat':
+        #Check all future events for warm-up temperature
+        for event in events.starting_after(current_time):
+          if event['desired_temp'] == 'On' or event['desired_temp'] == 'Preheat' or event['desired_temp'] == 'Off':
             continue
 
           event_next_time = event['start_date']
@@ -527,6 +824,12 @@ class Heating(object):
                   logger.info('Heating was on, due off at ' + str(time_due_off.astimezone(get_localzone())) +\
                                '. Now due off at ' + str(new_time_due_off.astimezone(get_localzone())))
 
+    elif forced_off:
+      self.desired_temp = 'Off'
+      if self.relays_heating._status:
+        logger.info('Heating forced off')
+        self.heating_off(0)
+
     else:
       self.desired_temp = str(self.config['heating_settings']['minimum_temperature'])
       #If we don't have an event yet, warn and ensure relay is off
@@ -542,6 +845,7 @@ class Heating(object):
           self.preheat_off()
 
     self.check_relay_states()
+    PROCESS_SECONDS.observe(time.monotonic() - started)
     self.processing_lock.release()
 
   def get_credentials(self):
@@ -571,12 +875,15 @@ class Heating(object):
       logger.info('Storing credentials to ' + credential_path)
     return credentials
 
-  def get_darksky_details(self):
-    with open('darksky_details.json') as json_data:
-      details = json.load(json_data)
-      json_data.close()
-    logger.debug('DarkSky details: ' + str(details))
-    return details
+  def get_weather(self):
+    settings = self.config['weather_settings']
+    client = CachedHttpClient(settings['timeout_seconds'])
+    if settings['provider'] == 'file':
+      provider = FileWeatherProvider(client, settings['file'])
+    else:
+      provider = OpenMeteoProvider(client, settings['latitude'], settings['longitude'], settings['forecast_hours'])
+    logger.debug('Weather provider: ' + provider.name)
+    return Weather(provider, settings['cache_file'])
 
 if __name__ == '__main__':
   btle.Debugging = True
@@ -598,21 +905,31 @@ if __name__ == '__main__':
     if heating.temp_sensors:
       for mac, sensor in heating.temp_sensors.items():
         try:
-          sensor.tag._backend.stop()
+          sensor.disconnect()
         except Exception as e1:
           pass
 
+    if heating.sensor_scanner:
+      heating.sensor_scanner.stop()
+
+    if heating.sensor_poller:
+      heating.sensor_poller.shutdown()
+
     if heating.relays:
       heating.relays.all_off()
 
     if heating.http_server:
         heating.http_server.shutdown()
 
+    if heating.control_server:
+        heating.control_server.stop()
+
+    if heating.refresh_queue:
+        heating.refresh_queue.stop()
+
     if heating.sched:
         heating.sched.shutdown(wait = False)
 
-    if isinstance(e, NoTagsFoundException):
-      sys.exit(3)
     if isinstance(e, NoTemperatureException):
       sys.exit(2)
     if isinstance(e, KeyboardInterrupt):
@@ -0,0 +1,86 @@
+#!/usr/bin/python
+'''Command line client for the heating control socket.
+
+  heatingctl.py boost 21.5 --minutes 60
+  heatingctl.py off --until 07:00
+  heatingctl.py hold --minutes 120
+  heatingctl.py cancel
+  heatingctl.py status
+'''
+import argparse, datetime, json, socket, sys
+
+from dateutil import parser
+
+def end_time(until):
+  '''Reads a local time or date and time, moving a bare time that has passed to tomorrow.'''
+  now = datetime.datetime.now()
+  end = parser.parse(until, default = now.replace(second = 0, microsecond = 0))
+  if end <= now and end.date() == now.date() and len(until) <= 5:
+    end += datetime.timedelta(days = 1)
+  if end.tzinfo is None:
+    end = end.astimezone()
+  return end.isoformat()
+
+def send(path, request):
+  client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  client.connect(path)
+  try:
+    client.sendall(bytes(json.dumps(request) + '\n', 'UTF-8'))
+    reply = b''
+    while not reply.endswith(b'\n'):
+      data = client.recv(4096)
+      if not data:
+        break
+      reply += data
+  finally:
+    client.close()
+  return json.loads(reply.decode('UTF-8'))
+
+def main():
+  with open('config.json') as json_data:
+    config = json.load(json_data)
+
+  argparser = argparse.ArgumentParser(description = 'Override the heating schedule')
+  argparser.add_argument('--socket', default = config['control_settings']['socket_path'])
+  commands = argparser.add_subparsers(dest = 'command')
+  commands.required = True
+  boost = commands.add_parser('boost', help = 'Heat to a temperature for a while')
+  boost.add_argument('temperature', type = float)
+  off = commands.add_parser('off', help = 'Keep the heating off until a time')
+  hold = commands.add_parser('hold', help = 'Hold the current temperature for a while')
+  for command in (boost, off, hold):
+    ending = command.add_mutually_exclusive_group(required = command is off)
+    if command is not off:
+      ending.add_argument('--minutes', type = float)
+    ending.add_argument('--until', help = 'Local time, e.g. 07:30 or 2026-01-01 07:30')
+  commands.add_parser('cancel', help = 'Go back to the calendar')
+  commands.add_parser('status', help = 'Show the override in force')
+  args = argparser.parse_args()
+
+  request = {'command': args.command}
+  if args.command == 'boost':
+    request['temperature'] = args.temperature
+  if getattr(args, 'minutes', None) is not None:
+    request['minutes'] = args.minutes
+  if getattr(args, 'until', None) is not None:
+    request['until'] = end_time(args.until)
+
+  try:
+    reply = send(args.socket, request)
+  except (IOError, OSError) as e:
+    print('Could not connect to ' + args.socket + ': ' + str(e))
+    sys.exit(1)
+  if not reply['ok']:
+    print('Error: ' + reply['error'])
+    sys.exit(1)
+
+  override = reply['override']
+  if override is None:
+    print('Following the calendar')
+  else:
+    print(override['kind'] + ' (' + str(override['desired_temp']) + ') until ' + \
+      str(parser.parse(override['end_date']).astimezone()))
+  print('Desired temperature ' + str(reply['desired_temp']) + ', currently ' + str(reply['current_temp']))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,131 @@
+import bisect, logging, mmap, os, re, struct, sys, threading, time
+from array import array
+
+logger = logging.getLogger('heating')
+
+class TimeSeries(object):
+  '''Append-only binary file of (time, value) records for one series.
+
+  The header holds the time of the first record. Each record is 8 bytes: the
+  whole seconds since that time and the value in thousandths, so records can
+  be binary searched by time straight out of a read-only memory map.
+  '''
+  HEADER = struct.Struct('<4sQI')
+  RECORD = struct.Struct('<Ii')
+  MAGIC = b'HTS1'
+  SCALE = 1000
+
+  def __init__(self, path):
+    self.path = path
+    self.base_time = None
+    self._lock = threading.Lock()
+    if os.path.exists(self.path) and os.path.getsize(self.path) >= TimeSeries.HEADER.size:
+      with open(self.path, 'rb') as series_file:
+        magic, self.base_time, scale = TimeSeries.HEADER.unpack(series_file.read(TimeSeries.HEADER.size))
+      if magic != TimeSeries.MAGIC or scale != TimeSeries.SCALE:
+        raise Exception('Not a history file: ' + self.path)
+
+  def append(self, timestamp, value):
+    self._lock.acquire()
+    try:
+      with open(self.path, 'ab') as series_file:
+        if self.base_time is None:
+          self.base_time = int(timestamp)
+          series_file.write(TimeSeries.HEADER.pack(TimeSeries.MAGIC, self.base_time, TimeSeries.SCALE))
+        #Keep whole records even if a previous write was cut short
+        series_file.seek(0, os.SEEK_END)
+        misaligned = (series_file.tell() - TimeSeries.HEADER.size) % TimeSeries.RECORD.size
+        if misaligned:
+          series_file.truncate(series_file.tell() - misaligned)
+        series_file.write(TimeSeries.RECORD.pack(max(0, int(timestamp) - self.base_time), int(round(value * TimeSeries.SCALE))))
+    finally:
+      self._lock.release()
+
+  def query(self, start, end, points):
+    '''Returns up to points buckets of [time, min, max, mean] covering start to end.'''
+    if self.base_time is None or end <= start or points < 1:
+      return []
+
+    with open(self.path, 'rb') as series_file:
+      size = os.fstat(series_file.fileno()).st_size
+      count = (size - TimeSeries.HEADER.size) // TimeSeries.RECORD.size
+      if count <= 0:
+        return []
+      mapped = mmap.mmap(series_file.fileno(), 0, access = mmap.ACCESS_READ)
+      #Every view of the map has to be released before it can be closed
+      views = []
+      try:
+        views.append(memoryview(mapped))
+        records = views[-1][TimeSeries.HEADER.size:TimeSeries.HEADER.size + count * TimeSeries.RECORD.size]
+        views.append(records)
+        if sys.byteorder == 'little':
+          fields = records.cast('i')
+          views.append(fields)
+        else:
+          fields = array('i', records.tobytes())
+          fields.byteswap()
+        #Offsets are unsigned on disk but never exceed 2**31 seconds
+        offsets = fields[0::2]
+        values = fields[1::2]
+        views.extend(view for view in (offsets, values) if isinstance(view, memoryview))
+        buckets = self._downsample(offsets, values, start - self.base_time, end - self.base_time, points)
+      finally:
+        for view in reversed(views):
+          view.release()
+        mapped.close()
+    return buckets
+
+  def _downsample(self, offsets, values, start, end, points):
+    buckets = []
+    width = (end - start) / float(points)
+    first = bisect.bisect_left(offsets, start)
+    for bucket in range(points):
+      bucket_end = start + width * (bucket + 1)
+      last = bisect.bisect_left(offsets, bucket_end, first)
+      if last > first:
+        window = values[first:last]
+        buckets.append([self.base_time + start + width * bucket, min(window) / float(TimeSeries.SCALE), \
+          max(window) / float(TimeSeries.SCALE), sum(window) / float(TimeSeries.SCALE * (last - first))])
+      first = last
+    return buckets
+
+class History(object):
+  '''One TimeSeries file per named series in a directory.'''
+  NAME = re.compile(r'^[a-z0-9_]+$')
+
+  def __init__(self, directory):
+    self.directory = directory
+    self._series = {}
+    self._lock = threading.Lock()
+    if not os.path.exists(self.directory):
+      os.makedirs(self.directory)
+
+  def record(self, name, value, timestamp = None):
+    if timestamp is None:
+      timestamp = time.time()
+    try:
+      self._get(name).append(timestamp, float(value))
+    except (IOError, OSError) as e:
+      logger.warn('Could not record ' + name + ' history: ' + str(e))
+
+  def query(self, name, start, end, points):
+    if not os.path.exists(self._path(name)):
+      return None
+    return self._get(name).query(start, end, points)
+
+  def names(self):
+    return sorted(name[:-len('.hts')] for name in os.listdir(self.directory) if name.endswith('.hts'))
+
+  def _path(self, name):
+    if not History.NAME.match(name):
+      raise ValueError('Bad series name ' + name)
+    return os.path.join(self.directory, name + '.hts')
+
+  def _get(self, name):
+    self._lock.acquire()
+    try:
+      if name not in self._series:
+        self._series[name] = TimeSeries(self._path(name))
+      return self._series[name]
+    finally:
+      self._lock.release()
@@ -1,100 +1,492 @@
-import httplib2, logging, urllib.parse, pytz, datetime
+import asyncio, functools, http, logging, queue, socket, time, json, urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from socketserver import ThreadingMixIn
+from metrics import REGISTRY
+from tracing import TRACER
+import debug_tools
 
 logger = logging.getLogger('heating')
 
-class HttpHandler(BaseHTTPRequestHandler):
+class Request(object):
+  def __init__(self, method, target, version, headers, body):
+    parsed_path = urllib.parse.urlparse(target)
+    self.method = method
+    self.path = parsed_path.path
+    self.query = urllib.parse.parse_qs(parsed_path.query)
+    self.version = version
+    #Header names are lower case
+    self.headers = headers
+    self.body = body
+
+  def header(self, name):
+    return self.headers.get(name.lower())
+
+class Response(object):
+  def __init__(self, status, body = b'', content_type = None, headers = None):
+    self.status = status
+    self.body = body
+    self.headers = list(headers or [])
+    if content_type is not None:
+      self.headers.append(('Content-Type', content_type))
+
+  @staticmethod
+  def text(response):
+    return Response(200, bytes(response, 'UTF-8'))
+
+  @staticmethod
+  def json(data):
+    return Response(200, bytes(json.dumps(data), 'UTF-8'), 'application/json')
+
+  @staticmethod
+  def error(status):
+    return Response(status, bytes(str(status) + ' ' + http.HTTPStatus(status).phrase + '\n', 'UTF-8'), 'text/plain')
+
+class StreamResponse(object):
+  '''Response that stays open sending event stream messages from a subscriber.'''
+  def __init__(self, subscriber, keepalive_seconds, on_close):
+    self.subscriber = subscriber
+    self.keepalive_seconds = keepalive_seconds
+    self.on_close = on_close
+
+class Router(object):
+  '''Maps method and exact path to a handler.
+
+  Prefix routes match one extra path segment, which is passed to the handler,
+  so /current_temp and /current_temp/<mac> are separate routes.
+  '''
+  def __init__(self):
+    self._exact = {}
+    self._prefix = {}
+
+  def add(self, method, path, handler, blocking = False):
+    self._exact[(method, path)] = (handler, blocking)
+
+  def add_prefix(self, method, prefix, handler, blocking = False):
+    self._prefix[(method, prefix)] = (handler, blocking)
+
+  def match(self, method, path):
+    '''Returns (handler, blocking, argument), or (None, None, status) if nothing matches.'''
+    route = self._exact.get((method, path))
+    if route is not None:
+      return route[0], route[1], None
+    slash = path.rfind('/')
+    if slash > 0 and slash < len(path) - 1:
+      route = self._prefix.get((method, path[:slash + 1]))
+      if route is not None:
+        return route[0], route[1], path[slash + 1:]
+    if any(known_path == path for known_method, known_path in self._exact.keys()):
+      return None, None, 405
+    return None, None, 404
+
+class HttpHandler(object):
   heating = None
 
-  def do_GET(self):
-    parsed_path = urllib.parse.urlparse(self.path)
-    if '/current_temp/' in parsed_path.path:
-      address = parsed_path.path[parsed_path.path.rfind('/') + 1:]
-      if address in self.heating.temp_sensors:
-        response = str(self.heating.temp_sensors[address].amb_temp) + '\n'
-        logger.info('Web request for ' + parsed_path.path + ', sending ' + response)
-        self.send_response(200)
-        self.end_headers()
-        self.wfile.write(bytes(response, 'UTF-8'))
+  def __init__(self, router):
+    router.add('GET', '/current_temp', self.current_temp)
+    router.add_prefix('GET', '/current_temp/', self.sensor_temp)
+    router.add_prefix('GET', '/samples/', self.sensor_samples)
+    router.add('GET', '/poll_intervals', self.poll_intervals)
+    router.add('GET', '/adapters', self.adapters)
+    router.add('GET', '/debug/profile', self.debug_profile, blocking = True)
+    router.add('GET', '/debug/threads', self.debug_threads)
+    router.add('GET', '/debug/memory', self.debug_memory, blocking = True)
+    router.add('GET', '/debug/memory/stop', self.debug_memory_stop)
+    router.add('GET', '/traces', self.traces)
+    router.add_prefix('GET', '/traces/', self.trace)
+    router.add('GET', '/trace_latency', self.trace_latency)
+    router.add('GET', '/metrics', self.metrics)
+    router.add('GET', '/history', self.history, blocking = True)
+    router.add('GET', '/events/stream', self.event_stream)
+    router.add('GET', '/state', self.state)
+    router.add('GET', '/desired_temp', self.desired_temp)
+    router.add('GET', '/proportion', self.proportion)
+    router.add('GET', '/heating_status', self.heating_status)
+    router.add('GET', '/preheat_status', self.preheat_status)
+    router.add('GET', '/outside_temp', self.outside_temp)
+    router.add('GET', '/outside_apparent_temp', self.outside_apparent_temp)
+    router.add('GET', '/sources', self.sources)
+    router.add('GET', '/watch_channel', self.watch_channel)
+    router.add('GET', '/weather', self.weather)
+    router.add('POST', '/refresh/events', self.refresh_events, blocking = True)
+    router.add('POST', '/temperature', self.temperature)
+
+  def sensor_temp(self, request, address):
+    if address in self.heating.temp_sensors:
+      response = str(self.heating.temp_sensors[address].amb_temp) + '\n'
+      logger.info('Web request for ' + request.path + ', sending ' + response)
+      return Response.text(response)
+    logger.info('Web request for ' + request.path + ', sending 404')
+    return Response.error(404)
+
+  def sensor_samples(self, request, address):
+    sensor = self.heating.temp_sensors.get(address)
+    if sensor is None:
+      logger.info('Web request for ' + request.path + ', sending 404')
+      return Response.error(404)
+    response = ''
+    for timestamp, value in sensor.samples.recent():
+      response += str(timestamp) + '=' + str(value) + '\n'
+    logger.info('Web request for ' + request.path + ', sending ' + str(len(response.splitlines())) + ' samples')
+    return Response.text(response)
+
+  def current_temp(self, request):
+    response = ''
+    for mac, sensor in list(self.heating.temp_sensors.items()):
+      response += mac + '=' + str(sensor.amb_temp) + '\n'
+    logger.info('Web request for /current_temp, sending ' + response)
+    return Response.text(response)
+
+  def poll_intervals(self, request):
+    response = ''
+    for mac, sensor in list(self.heating.temp_sensors.items()):
+      response += mac + '=' + str(sensor.poll_interval) + ' ' + str(sensor.poll_reason) + '\n'
+    logger.info('Web request for /poll_intervals, sending ' + response)
+    return Response.text(response)
+
+  def adapters(self, request):
+    response = ''
+    for adapter, (count, latency) in sorted(self.heating.adapter_placement.loads().items()):
+      response += 'hci' + str(adapter) + '=' + str(count) + ' sensors ' + str(round(latency, 2)) + 's\n'
+    logger.info('Web request for /adapters, sending ' + response)
+    return Response.text(response)
+
+  def debug_enabled(self, request):
+    if not self.heating.config['debug_settings']['enabled']:
+      logger.info('Web request for ' + request.path + ' but debug endpoints are disabled, sending 404')
+      return False
+    return True
+
+  def debug_profile(self, request):
+    if not self.debug_enabled(request):
+      return Response.error(404)
+    settings = self.heating.config['debug_settings']
+    try:
+      seconds = min(float(request.query.get('seconds', ['10'])[0]), settings['max_profile_seconds'])
+    except ValueError as e:
+      logger.info('Bad web request for /debug/profile: ' + str(e))
+      return Response.error(400)
+    logger.info('Web request for /debug/profile, sampling for ' + str(seconds) + 's')
+    return Response(200, bytes(debug_tools.profile(seconds, settings['sample_interval_ms'] / 1000.0), 'UTF-8'), 'text/plain; charset=utf-8')
+
+  def debug_threads(self, request):
+    if not self.debug_enabled(request):
+      return Response.error(404)
+    logger.info('Web request for /debug/threads')
+    return Response(200, bytes(debug_tools.dump_threads(), 'UTF-8'), 'text/plain; charset=utf-8')
+
+  def debug_memory(self, request):
+    if not self.debug_enabled(request):
+      return Response.error(404)
+    try:
+      limit = int(request.query.get('limit', ['25'])[0])
+    except ValueError as e:
+      logger.info('Bad web request for /debug/memory: ' + str(e))
+      return Response.error(400)
+    logger.info('Web request for /debug/memory')
+    return Response(200, bytes(self.heating.memory_snapshots.snapshot(limit), 'UTF-8'), 'text/plain; charset=utf-8')
+
+  def debug_memory_stop(self, request):
+    if not self.debug_enabled(request):
+      return Response.error(404)
+    logger.info('Web request for /debug/memory/stop')
+    self.heating.memory_snapshots.stop()
+    return Response(200, b'tracemalloc stopped\n', 'text/plain; charset=utf-8')
+
+  def trace(self, request, trace_id):
+    trace = TRACER.get(trace_id)
+    if trace is None:
+      logger.info('Web request for ' + request.path + ', sending 404')
+      return Response.error(404)
+    logger.info('Web request for ' + request.path)
+    return Response.json(trace)
+
+  def traces(self, request):
+    try:
+      count = int(request.query.get('count', ['20'])[0])
+    except ValueError:
+      return Response.error(400)
+    logger.info('Web request for /traces')
+    return Response.json(TRACER.recent(count))
+
+  def trace_latency(self, request):
+    logger.info('Web request for /trace_latency')
+    return Response.json(TRACER.actuation_latency())
+
+  def metrics(self, request):
+    response = REGISTRY.exposition()
+    logger.debug('Web request for /metrics, sending ' + str(len(response)) + ' bytes')
+    return Response(200, bytes(response, 'UTF-8'), 'text/plain; version=0.0.4')
+
+  def history(self, request):
+    settings = self.heating.config['history_settings']
+    query = request.query
+    try:
+      if 'series' not in query:
+        response = self.heating.history.names()
       else:
-        logger.info('Web request for ' + parsed_path.path + ', sending 404')
-        self.send_error(404)
-    elif '/current_temp' in parsed_path.path:
-      response = ''
-      for mac, sensor in self.heating.temp_sensors.items():
-        response += mac + '=' + str(self.heating.temp_sensors[mac].amb_temp) + '\n'
-      logger.info('Web request for /current_temp, sending ' + response)
-      self.send_response(200)
-      self.end_headers()
-      self.wfile.write(bytes(response, 'UTF-8'))
-    elif parsed_path.path == '/desired_temp':
-      logger.info('Web request for /desired_temp, sending ' + str(self.heating.desired_temp))
-      self.send_response(200)
-      self.end_headers()
-      self.wfile.write(bytes(str(self.heating.desired_temp) + '\n', 'UTF-8'))
-    elif parsed_path.path == '/proportion':
-      logger.info('Web request for /proportion, sending ' + str(self.heating.proportional_time))
-      self.send_response(200)
-      self.end_headers()
-      self.wfile.write(bytes(str(self.heating.proportional_time) + '\n', 'UTF-8'))
-    elif parsed_path.path == '/heating_status':
-      status_num = '0'
-      if self.heating.relays_heating._status:
-        status_num = '1'
-      logger.info('Web request for /heating_status, sending ' + status_num)
-      self.send_response(200)
-      self.end_headers()
-      self.wfile.write(bytes(status_num + '\n', 'UTF-8'))
-    elif parsed_path.path == '/preheat_status':
-      status_num = '0'
-      if self.heating.relays_preheat._status:
-        status_num = '1'
-      logger.info('Web request for /preheat_status, sending ' + status_num)
-      self.send_response(200)
-      self.end_headers()
-      self.wfile.write(bytes(status_num + '\n', 'UTF-8'))
-    elif parsed_path.path == '/outside_temp':
-      logger.info('Web request for /outside_temp, sending ' + str(self.heating.outside_temp))
-      self.send_response(200)
-      self.end_headers()
-      self.wfile.write(bytes(str(self.heating.outside_temp) + '\n', 'UTF-8'))
-    elif parsed_path.path == '/outside_apparent_temp':
-      logger.info('Web request for /outside_apparent_temp, sending ' + str(self.heating.outside_apparent_temp))
-      self.send_response(200)
-      self.end_headers()
-      self.wfile.write(bytes(str(self.heating.outside_apparent_temp) + '\n', 'UTF-8'))
-    else:
-      logger.info('GET request for ' + parsed_path.path + ', ignoring')
-      self.send_error(404)
-    return
-
-  def do_POST(self):
-    parsed_path = urllib.parse.urlparse(self.path)
-    if parsed_path.path == '/refresh/events':
-      logger.info('Web request for /refresh/events')
-      logger.debug('Request data: ' + str(str(self.headers).splitlines()))
-      try:
-        if self.headers.get('X-Goog-Resource-State') != 'sync' and \
-            self.headers.get('X-Goog-Channel-ID') == self.heating.event_sync_id:
-          self.heating.get_next_event()
-        self.send_response(204)
-        self.end_headers()
-      except Exception as e:
-        self.send_response(500)
-        self.end_headers()
-        raise
-    else:
-      logger.info('POST request for ' + parsed_path.path + ', ignoring')
-      self.send_error(404)
-    return
-
-  def log_message(self, format, *args):
-    return
-
-class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
-  '''Handle requests in a separate thread.'''
+        end = float(query.get('to', [time.time()])[0])
+        start = float(query.get('from', [end - 24 * 60 * 60])[0])
+        points = min(int(query.get('points', [settings['default_points']])[0]), settings['max_points'])
+        buckets = self.heating.history.query(query['series'][0], start, end, points)
+        if buckets is None:
+          logger.info('Web request for unknown history series ' + query['series'][0] + ', sending 404')
+          return Response.error(404)
+        response = {'series': query['series'][0], 'columns': ['time', 'min', 'max', 'mean'], 'data': buckets}
+    except ValueError as e:
+      logger.info('Bad web request for /history: ' + str(e))
+      return Response.error(400)
+    logger.info('Web request for /history ' + str(query))
+    return Response.json(response)
+
+  def event_stream(self, request):
+    last_event_id = None
+    try:
+      if request.header('Last-Event-ID'):
+        last_event_id = int(request.header('Last-Event-ID'))
+    except ValueError:
+      pass
+    subscriber = self.heating.event_stream.subscribe(last_event_id, ('state', {'changed': [], 'state': self.heating.state.current.data}))
+    if subscriber is None:
+      logger.info('Web request for /events/stream, too many subscribers, sending 503')
+      return Response.error(503)
+
+    logger.info('Web request for /events/stream, resuming after ' + str(last_event_id))
+    def on_close():
+      self.heating.event_stream.unsubscribe(subscriber)
+      logger.info('Event stream client disconnected')
+    return StreamResponse(subscriber, self.heating.config['stream_settings']['keepalive_seconds'], on_close)
+
+  def state(self, request):
+    #One reference read; the snapshot is never modified after publishing
+    snapshot = self.heating.state.current
+    if request.header('If-None-Match') == snapshot.etag:
+      return Response(304, headers = [('ETag', snapshot.etag)])
+    return Response(200, snapshot.body, 'application/json', [('ETag', snapshot.etag)])
+
+  def desired_temp(self, request):
+    logger.info('Web request for /desired_temp, sending ' + str(self.heating.desired_temp))
+    return Response.text(str(self.heating.desired_temp) + '\n')
+
+  def proportion(self, request):
+    logger.info('Web request for /proportion, sending ' + str(self.heating.proportional_time))
+    return Response.text(str(self.heating.proportional_time) + '\n')
+
+  def heating_status(self, request):
+    status_num = '0'
+    if self.heating.relays_heating._status:
+      status_num = '1'
+    logger.info('Web request for /heating_status, sending ' + status_num)
+    return Response.text(status_num + '\n')
+
+  def preheat_status(self, request):
+    status_num = '0'
+    if self.heating.relays_preheat._status:
+      status_num = '1'
+    logger.info('Web request for /preheat_status, sending ' + status_num)
+    return Response.text(status_num + '\n')
+
+  def outside_temp(self, request):
+    logger.info('Web request for /outside_temp, sending ' + str(self.heating.outside_temp))
+    return Response.text(str(self.heating.outside_temp) + '\n')
+
+  def outside_apparent_temp(self, request):
+    logger.info('Web request for /outside_apparent_temp, sending ' + str(self.heating.outside_apparent_temp))
+    return Response.text(str(self.heating.outside_apparent_temp) + '\n')
+
+  def refresh_events(self, request):
+    logger.info('Web request for /refresh/events')
+    logger.debug('Request data: ' + str(request.headers))
+    channel_id = request.header('X-Goog-Channel-ID')
+    if self.heating.watch_channels is None:
+      logger.info('Not watching a calendar, ignoring')
+    elif not self.heating.watch_channels.is_current(channel_id):
+      if channel_id and request.header('X-Goog-Resource-ID'):
+        self.heating.stop_stray_watch_channel(channel_id, request.header('X-Goog-Resource-ID'))
+    elif request.header('X-Goog-Resource-State') != 'sync':
+      #Acknowledge straight away; bursts of notifications become one fetch
+      self.heating.refresh_queue.request()
+    return Response(204)
+
+  def weather(self, request):
+    logger.info('Web request for /weather')
+    return Response.json(self.heating.weather.status())
+
+  def watch_channel(self, request):
+    if self.heating.watch_channels is None:
+      logger.info('Web request for /watch_channel, not watching a calendar, sending 404')
+      return Response.error(404)
+    logger.info('Web request for /watch_channel')
+    return Response.json(self.heating.watch_channels.status())
+
+  def sources(self, request):
+    logger.info('Web request for /sources')
+    return Response.json(self.heating.push_sources.status(time.time()))
+
+  def temperature(self, request):
+    '''Takes a batch of readings, {"readings": [{"source": ..., "temperature": ..., "timestamp": ...}, ...]}.'''
+    try:
+      readings = json.loads(request.body.decode('UTF-8'))['readings']
+      if not isinstance(readings, list):
+        raise ValueError('readings is not a list')
+    except (ValueError, KeyError, TypeError) as e:
+      logger.info('Bad web request for /temperature: ' + str(e))
+      return Response.error(400)
+    if len(readings) > self.heating.config['push_settings']['max_batch_readings']:
+      logger.info('Web request for /temperature with ' + str(len(readings)) + ' readings, sending 413')
+      return Response.error(413)
+    accepted, rejected = self.heating.push_sources.ingest(readings)
+    return Response.json({'accepted': accepted, 'rejected': rejected})
+
+class AsyncHTTPServer(object):
+  '''HTTP/1.1 server running on its own asyncio event loop.
+
+  Connections are kept alive between requests until keepalive_seconds of
+  idleness, and at most max_connections are served at once. Handlers marked
+  as blocking run on a fixed pool of max_workers threads; the rest run on the
+  event loop itself.
+  '''
+  MAX_HEADERS = 100
+
+  def __init__(self, address, handler_class, max_connections = 50, max_workers = 4, keepalive_seconds = 15):
+    self.router = Router()
+    self.handler = handler_class(self.router)
+    self.max_connections = max_connections
+    self.keepalive_seconds = keepalive_seconds
+    self._executor = ThreadPoolExecutor(max_workers = max_workers, thread_name_prefix = 'HttpWorker')
+    #Bind now so a port clash shows up at startup
+    self._socket = socket.create_server(address, reuse_port = False)
+    self._loop = None
+
+  def serve_forever(self):
+    self._loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(self._loop)
+    self._connections = asyncio.Semaphore(self.max_connections)
+    server = self._loop.run_until_complete(asyncio.start_server(self._handle_connection, sock = self._socket))
+    try:
+      self._loop.run_forever()
+    finally:
+      server.close()
+      #Event streams and idle keep-alive connections would otherwise never finish
+      tasks = asyncio.all_tasks(self._loop)
+      for task in tasks:
+        task.cancel()
+      self._loop.run_until_complete(asyncio.gather(*tasks, return_exceptions = True))
+      self._loop.close()
+
   def shutdown(self):
-    self.socket.close()
-    HTTPServer.shutdown(self)
+    if self._loop is not None and not self._loop.is_closed():
+      self._loop.call_soon_threadsafe(self._loop.stop)
+    self._executor.shutdown(wait = False)
+
+  async def _handle_connection(self, reader, writer):
+    async with self._connections:
+      try:
+        while True:
+          request = await self._read_request(reader)
+          if request is None:
+            break
+          if isinstance(request, Response):
+            self._write_response(writer, request, 'HTTP/1.1', False)
+            await writer.drain()
+            break
+
+          connection = (request.header('Connection') or '').lower()
+          if request.version == 'HTTP/1.1':
+            keep_alive = connection != 'close'
+          else:
+            keep_alive = connection == 'keep-alive'
+
+          response = await self._dispatch(request)
+          if isinstance(response, StreamResponse):
+            await self._stream(reader, writer, response)
+            break
+          self._write_response(writer, response, request.version, keep_alive)
+          await writer.drain()
+          if not keep_alive:
+            break
+      except (ConnectionError, asyncio.IncompleteReadError) as e:
+        pass
+      finally:
+        writer.close()
+
+  async def _read_request(self, reader):
+    '''Returns the next Request, None if the client went away, or an error Response.'''
+    try:
+      request_line = await asyncio.wait_for(reader.readline(), self.keepalive_seconds)
+      if not request_line:
+        return None
+      parts = request_line.decode('latin-1').split()
+      if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+        return Response.error(400)
+
+      headers = {}
+      while True:
+        line = await asyncio.wait_for(reader.readline(), self.keepalive_seconds)
+        if line in (b'\r\n', b'\n', b''):
+          break
+        if len(headers) >= AsyncHTTPServer.MAX_HEADERS:
+          return Response.error(431)
+        name, separator, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+      length = int(headers.get('content-length', '0') or '0')
+      body = await reader.readexactly(length) if length > 0 else b''
+    except asyncio.TimeoutError:
+      return None
+    except ValueError:
+      #Bad Content-Length or a line longer than the stream limit
+      return Response.error(400)
+    return Request(parts[0], parts[1], parts[2], headers, body)
+
+  async def _dispatch(self, request):
+    handler, blocking, argument = self.router.match(request.method, request.path)
+    if handler is None:
+      logger.info(request.method + ' request for ' + request.path + ', ignoring')
+      return Response.error(argument)
+    call = functools.partial(handler, request) if argument is None else functools.partial(handler, request, argument)
+    try:
+      if blocking:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+      return call()
+    except Exception as e:
+      logger.exception('Error handling ' + request.method + ' ' + request.path)
+      return Response.error(500)
+
+  def _write_response(self, writer, response, version, keep_alive):
+    lines = [version + ' ' + str(response.status) + ' ' + http.HTTPStatus(response.status).phrase]
+    if response.status not in (204, 304):
+      lines.append('Content-Length: ' + str(len(response.body)))
+    lines.append('Connection: ' + ('keep-alive' if keep_alive else 'close'))
+    for name, value in response.headers:
+      lines.append(name + ': ' + value)
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+    if response.status not in (204, 304):
+      writer.write(response.body)
+
+  async def _stream(self, reader, writer, response):
+    subscriber = response.subscriber
+    wakeup = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    subscriber.wakeup = lambda: loop.call_soon_threadsafe(wakeup.set)
+    #Clients never send anything more, so a finished read means they have gone
+    closed = asyncio.ensure_future(reader.read())
+    try:
+      writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n')
+      while not subscriber.dropped and not closed.done():
+        while True:
+          try:
+            writer.write(subscriber.queue.get_nowait())
+          except queue.Empty:
+            break
+        await writer.drain()
+        wakeup.clear()
+        if not subscriber.queue.empty():
+          continue
+        woken = asyncio.ensure_future(wakeup.wait())
+        done, pending = await asyncio.wait((woken, closed), timeout = response.keepalive_seconds, return_when = asyncio.FIRST_COMPLETED)
+        woken.cancel()
+        if not done:
+          writer.write(b': keepalive\n\n')
+    finally:
+      closed.cancel()
+      response.on_close()
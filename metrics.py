@@ -0,0 +1,142 @@
+import bisect, threading, time
+
+class Metric(object):
+  '''Base for metrics with an optional fixed set of label names.'''
+  def __init__(self, name, help, labels = ()):
+    self.name = name
+    self.help = help
+    self.label_names = tuple(labels)
+    self._values = {}
+    self._lock = threading.Lock()
+
+  def _label_text(self, label_values, extra = ''):
+    pairs = ['%s="%s"' % (name, value) for name, value in zip(self.label_names, label_values)]
+    if extra:
+      pairs.append(extra)
+    if not pairs:
+      return ''
+    return '{' + ','.join(pairs) + '}'
+
+class Counter(Metric):
+  kind = 'counter'
+
+  def inc(self, *label_values, amount = 1):
+    self._lock.acquire()
+    self._values[label_values] = self._values.get(label_values, 0) + amount
+    self._lock.release()
+
+  def samples(self):
+    self._lock.acquire()
+    values = list(self._values.items())
+    self._lock.release()
+    return [self.name + self._label_text(labels) + ' ' + repr(float(value)) for labels, value in sorted(values)]
+
+class Histogram(Metric):
+  kind = 'histogram'
+  DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+  def __init__(self, name, help, labels = (), buckets = DEFAULT_BUCKETS):
+    Metric.__init__(self, name, help, labels)
+    self.buckets = tuple(buckets)
+
+  def observe(self, value, *label_values):
+    #Per-bucket counts here, cumulative counts are only worked out when scraped
+    index = bisect.bisect_left(self.buckets, value)
+    self._lock.acquire()
+    counts = self._values.get(label_values)
+    if counts is None:
+      counts = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+    counts[index] += 1
+    counts[-1] += value
+    self._lock.release()
+
+  def time(self, *label_values):
+    return Timer(self, label_values)
+
+  def samples(self):
+    self._lock.acquire()
+    values = [(labels, list(counts)) for labels, counts in self._values.items()]
+    self._lock.release()
+    lines = []
+    for labels, counts in sorted(values):
+      cumulative = 0
+      for bound, count in zip(self.buckets + ('+Inf',), counts):
+        cumulative += count
+        lines.append(self.name + '_bucket' + self._label_text(labels, 'le="' + str(bound) + '"') + ' ' + str(cumulative))
+      lines.append(self.name + '_count' + self._label_text(labels) + ' ' + str(cumulative))
+      lines.append(self.name + '_sum' + self._label_text(labels) + ' ' + repr(counts[-1]))
+    return lines
+
+class Gauge(Metric):
+  '''Gauge read from a callback when scraped, so keeping it current costs nothing.'''
+  kind = 'gauge'
+
+  def __init__(self, name, help, function):
+    Metric.__init__(self, name, help)
+    self.function = function
+
+  def samples(self):
+    try:
+      value = self.function()
+    except Exception as e:
+      return []
+    if value is None:
+      return []
+    try:
+      return [self.name + ' ' + repr(float(value))]
+    except (TypeError, ValueError):
+      return []
+
+class Timer(object):
+  def __init__(self, histogram, label_values):
+    self.histogram = histogram
+    self.label_values = label_values
+
+  def __enter__(self):
+    self.started = time.monotonic()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.histogram.observe(time.monotonic() - self.started, *self.label_values)
+    return False
+
+class Registry(object):
+  def __init__(self):
+    self._metrics = []
+    self._lock = threading.Lock()
+
+  def register(self, metric):
+    self._lock.acquire()
+    self._metrics = [existing for existing in self._metrics if existing.name != metric.name] + [metric]
+    self._lock.release()
+    return metric
+
+  def exposition(self):
+    '''Returns all metrics in the Prometheus text format.'''
+    lines = []
+    for metric in list(self._metrics):
+      lines.append('# HELP ' + metric.name + ' ' + metric.help)
+      lines.append('# TYPE ' + metric.name + ' ' + metric.kind)
+      lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
+
+def acquire(lock, name):
+  '''Acquires a lock, recording how long it took.'''
+  started = time.monotonic()
+  lock.acquire()
+  LOCK_WAIT_SECONDS.observe(time.monotonic() - started, name)
+
+REGISTRY = Registry()
+
+PROCESS_SECONDS = REGISTRY.register(Histogram('heating_process_seconds', 'Time spent in Heating.process'))
+SENSOR_READ_SECONDS = REGISTRY.register(Histogram('heating_sensor_read_seconds', 'Time taken by get_ambient_temp', ('type',)))
+RELAY_TRANSFER_SECONDS = REGISTRY.register(Histogram('heating_relay_transfer_seconds', 'Time taken by USB relay control transfers'))
+FETCH_SECONDS = REGISTRY.register(Histogram('heating_fetch_seconds', 'Time taken fetching from remote services', ('source',)))
+LOCK_WAIT_SECONDS = REGISTRY.register(Histogram('heating_lock_wait_seconds', 'Time spent waiting to acquire locks', ('lock',)))
+SCAN_SECONDS = REGISTRY.register(Histogram('heating_scan_seconds', 'Duration of BLE scan windows'))
+
+BLE_DISCONNECTS = REGISTRY.register(Counter('heating_ble_disconnects_total', 'BLE links lost'))
+RELAY_SWITCHES = REGISTRY.register(Counter('heating_relay_switches_total', 'Relay switch commands sent', ('port', 'state')))
+SCHEDULER_MISFIRES = REGISTRY.register(Counter('heating_scheduler_misfires_total', 'Scheduler jobs that missed their run time'))
+PUSH_READINGS = REGISTRY.register(Counter('heating_push_readings_total', 'Readings posted to /temperature', ('source', 'result')))
+WEBHOOK_NOTIFICATIONS = REGISTRY.register(Counter('heating_webhook_notifications_total', 'Calendar change notifications, by whether they caused a refresh or were merged into one', ('result',)))
@@ -0,0 +1,101 @@
+import datetime, json, logging, os, threading, pytz
+
+from dateutil import parser
+from event_horizon import EventIndex
+
+logger = logging.getLogger('heating')
+
+class Overrides(object):
+  '''The manual override in force, if any, persisted as JSON.
+
+  An override is a synthetic event that takes priority over the calendar
+  for its duration. There is at most one; setting another replaces it.
+  '''
+  def __init__(self, path):
+    self.path = path
+    self._lock = threading.Lock()
+    self.current = None
+    if os.path.exists(self.path):
+      try:
+        with open(self.path) as json_data:
+          stored = json.load(json_data)
+        if stored is not None:
+          self.current = {'kind': stored['kind'], 'desired_temp': stored['desired_temp'], \
+            'start_date': parser.parse(stored['start_date']), 'end_date': parser.parse(stored['end_date'])}
+          logger.info('Loaded override ' + self.describe(self.current) + ' from ' + self.path)
+      except (IOError, ValueError, KeyError) as e:
+        logger.warn('Ignoring unreadable override file ' + self.path + ': ' + str(e))
+
+  def set(self, kind, desired_temp, end_date):
+    self._lock.acquire()
+    try:
+      self.current = {'kind': kind, 'desired_temp': desired_temp, \
+        'start_date': pytz.utc.localize(datetime.datetime.utcnow()), 'end_date': end_date.astimezone(pytz.utc)}
+      logger.info('New override ' + self.describe(self.current))
+      self._save()
+      return dict(self.current)
+    finally:
+      self._lock.release()
+
+  def clear(self):
+    '''Removes the override and returns it, or None if there wasn't one.'''
+    self._lock.acquire()
+    try:
+      override = self.current
+      if override is not None:
+        logger.info('Clearing override ' + self.describe(override))
+        self.current = None
+        self._save()
+      return override
+    finally:
+      self._lock.release()
+
+  def active(self, now):
+    '''Returns the override in force at now, forgetting it once it has ended.'''
+    self._lock.acquire()
+    try:
+      if self.current is not None and self.current['end_date'] <= now:
+        logger.info('Override ' + self.describe(self.current) + ' has ended')
+        self.current = None
+        self._save()
+      return self.current
+    finally:
+      self._lock.release()
+
+  def apply(self, events, now):
+    '''Returns an EventIndex of events with the active override first.
+
+    Calendar events are cut back to start when the override ends, and dropped
+    if they end before it does.
+    '''
+    override = self.active(now)
+    if override is None:
+      return events
+    end_date = override['end_date']
+    applied = [{'start_date': override['start_date'], 'end_date': end_date, \
+      'desired_temp': override['desired_temp'], 'override': override['kind']}]
+    for event in events or []:
+      if event['end_date'] <= end_date:
+        continue
+      if event['start_date'] < end_date:
+        event = dict(event, start_date = end_date)
+      applied.append(event)
+    return EventIndex(applied)
+
+  def as_dict(self, override):
+    if override is None:
+      return None
+    return {'kind': override['kind'], 'desired_temp': override['desired_temp'], \
+      'start_date': override['start_date'].isoformat(), 'end_date': override['end_date'].isoformat()}
+
+  def describe(self, override):
+    return override['kind'] + ' (' + str(override['desired_temp']) + ') until ' + str(override['end_date'])
+
+  def _save(self):
+    temp_path = self.path + '.tmp'
+    try:
+      with open(temp_path, 'w') as json_data:
+        json.dump(self.as_dict(self.current), json_data)
+      os.replace(temp_path, self.path)
+    except (IOError, OSError) as e:
+      logger.warn('Could not write override file ' + self.path + ': ' + str(e))
@@ -0,0 +1,71 @@
+import datetime, logging, time, pytz
+
+logger = logging.getLogger('heating')
+
+class PollingPolicy(object):
+  '''Chooses how long each sensor can go before its next read.
+
+  Sensors are read every min_interval_seconds while the control loop is close
+  to a decision (a proportional switch or warm-up start is near, or the house
+  is near the desired temperature and this sensor sets the overall reading),
+  every max_interval_seconds while nothing is changing, and every
+  default_interval_seconds otherwise.
+  '''
+  def __init__(self, heating_settings, sensor_settings):
+    self.heating_settings = heating_settings
+    self.default_interval_seconds = heating_settings['update_temperature_interval_seconds']
+    self.min_interval_seconds = sensor_settings['min_poll_interval_seconds']
+    self.max_interval_seconds = sensor_settings['max_poll_interval_seconds']
+    self.near_target_degrees = sensor_settings['near_target_degrees']
+    self.stable_degrees = sensor_settings['stable_degrees']
+
+  def schedule(self, sensors, heating):
+    '''Sets poll_interval, poll_reason and next_read on each sensor.'''
+    now = pytz.utc.localize(datetime.datetime.utcnow())
+    urgent_reason = self._urgent_reason(heating, now)
+
+    near_target = False
+    try:
+      near_target = heating.current_temp is not None and \
+        abs(float(heating.desired_temp) - heating.current_temp) <= self.near_target_degrees
+    except (TypeError, ValueError):
+      pass
+
+    for sensor in sensors:
+      is_minimum = sensor.mac == heating.current_sensor
+      if urgent_reason is not None:
+        interval, reason = self.min_interval_seconds, urgent_reason
+      elif near_target and is_minimum:
+        interval, reason = self.min_interval_seconds, 'near desired temperature, minimum sensor'
+      elif near_target or is_minimum:
+        interval, reason = self.default_interval_seconds, 'near desired temperature' if near_target else 'minimum sensor'
+      elif sensor.previous_amb_temp is not None and sensor.amb_temp is not None and \
+          abs(sensor.amb_temp - sensor.previous_amb_temp) <= self.stable_degrees:
+        interval, reason = self.max_interval_seconds, 'stable'
+      else:
+        interval, reason = self.default_interval_seconds, 'changing'
+
+      if interval != sensor.poll_interval:
+        logger.debug('Polling ' + sensor.mac + ' every ' + str(interval) + 's: ' + reason)
+      sensor.poll_interval = interval
+      sensor.poll_reason = reason
+      sensor.next_read = sensor.last_read + interval
+
+  def _urgent_reason(self, heating, now):
+    horizon = datetime.timedelta(0, self.max_interval_seconds)
+
+    if heating.heating_trigger is not None and heating.heating_trigger.next_run_time is not None and \
+        now <= heating.heating_trigger.next_run_time <= now + horizon:
+      return 'proportional switch due'
+
+    #The same events process() sees, override included
+    for event in heating.overrides.apply(heating.horizon.index, now).starting_after(now):
+      if event['desired_temp'] in ('On', 'Preheat', 'Off'):
+        continue
+      temp_diff = event['desired_temp'] - (heating.current_temp if heating.current_temp is not None else event['desired_temp'])
+      #Same lead time process() uses to start warming up for an event
+      lead = datetime.timedelta(0, (max(0, temp_diff) * self.heating_settings['minutes_per_degree'] * 60) + \
+        (self.heating_settings['effect_delay_minutes'] * 60))
+      if event['start_date'] - lead - now <= horizon:
+        return 'warm-up imminent'
+    return None
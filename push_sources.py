@@ -0,0 +1,125 @@
+import logging, threading, time
+
+from sample_buffer import SampleBuffer
+from metrics import PUSH_READINGS
+
+logger = logging.getLogger('heating')
+
+class PushSource(object):
+  '''A temperature source that posts its readings instead of being polled.'''
+  def __init__(self, source_id, staleness_seconds, max_readings_per_minute, buffer_size, window_seconds):
+    self.source_id = source_id
+    self.staleness_seconds = staleness_seconds
+    self.rate = max_readings_per_minute / 60.0
+    self.capacity = float(max_readings_per_minute)
+    self.tokens = self.capacity
+    self.refilled = time.monotonic()
+    #Once the newest reading is older than staleness_seconds the source has no value
+    self.samples = SampleBuffer(buffer_size, window_seconds, staleness_seconds)
+
+  def take_token(self, now):
+    self.tokens = min(self.capacity, self.tokens + (now - self.refilled) * self.rate)
+    self.refilled = now
+    if self.tokens < 1:
+      return False
+    self.tokens -= 1
+    return True
+
+class PushSources(object):
+  '''Readings posted to /temperature, kept per source alongside the BLE sensors.
+
+  Only sources listed in config.json are accepted. Each has a token bucket
+  allowing max_readings_per_minute, and readings older than its
+  staleness_seconds, from the future, or older than what it already sent
+  are rejected.
+  '''
+  def __init__(self, sources, buffer_size, window_seconds, max_future_seconds):
+    self.max_future_seconds = max_future_seconds
+    self.sources = {}
+    for source_id, settings in sources.items():
+      self.sources[source_id] = PushSource(source_id, settings['staleness_seconds'], \
+        settings['max_readings_per_minute'], buffer_size, window_seconds)
+    self._updated = False
+    self._lock = threading.Lock()
+
+  def ingest(self, readings, now = None):
+    '''Stores a batch of {'source', 'temperature', 'timestamp'} readings.
+
+    Returns (accepted, rejected) where rejected maps reason to count.
+    '''
+    if now is None:
+      now = time.time()
+    accepted = 0
+    rejected = {}
+    valid = []
+    for reading in readings:
+      try:
+        source = self.sources.get(reading['source'])
+        temperature = float(reading['temperature'])
+        timestamp = float(reading.get('timestamp', now))
+      except (KeyError, TypeError, ValueError, AttributeError):
+        self._reject(rejected, None, 'invalid')
+        continue
+      if source is None:
+        self._reject(rejected, None, 'unknown_source')
+      elif temperature != temperature or temperature < -50 or temperature > 100:
+        self._reject(rejected, source, 'invalid')
+      elif timestamp > now + self.max_future_seconds:
+        self._reject(rejected, source, 'future')
+      elif timestamp < now - source.staleness_seconds:
+        self._reject(rejected, source, 'stale')
+      else:
+        valid.append((timestamp, source, temperature))
+
+    #Samples have to go into each buffer in time order
+    valid.sort(key = lambda reading: reading[0])
+    self._lock.acquire()
+    try:
+      monotonic_now = time.monotonic()
+      for timestamp, source, temperature in valid:
+        if source.samples.last_timestamp is not None and timestamp <= source.samples.last_timestamp:
+          self._reject(rejected, source, 'out_of_order')
+        elif not source.take_token(monotonic_now):
+          self._reject(rejected, source, 'rate_limited')
+        else:
+          source.samples.append(timestamp, temperature)
+          PUSH_READINGS.inc(source.source_id, 'accepted')
+          accepted += 1
+      if accepted:
+        self._updated = True
+    finally:
+      self._lock.release()
+    if rejected:
+      logger.info('Accepted ' + str(accepted) + ' pushed readings, rejected ' + str(rejected))
+    else:
+      logger.debug('Accepted ' + str(accepted) + ' pushed readings')
+    return accepted, rejected
+
+  def take_updated(self):
+    '''Returns whether any reading has arrived since the last call.'''
+    self._lock.acquire()
+    updated = self._updated
+    self._updated = False
+    self._lock.release()
+    return updated
+
+  def aggregates(self, method, now):
+    '''Returns source id to aggregated temperature for every source that isn't stale.'''
+    aggregates = {}
+    for source_id, source in self.sources.items():
+      value = source.samples.aggregate(method, now)
+      if value is not None:
+        aggregates[source_id] = value
+    return aggregates
+
+  def status(self, now):
+    status = {}
+    for source_id, source in self.sources.items():
+      last = source.samples.last_timestamp
+      status[source_id] = {'temperature': source.samples.last_value, 'timestamp': last, \
+        'stale': last is None or now - last > source.staleness_seconds}
+    return status
+
+  def _reject(self, rejected, source, reason):
+    rejected[reason] = rejected.get(reason, 0) + 1
+    PUSH_READINGS.inc(source.source_id if source is not None else '', reason)
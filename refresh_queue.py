@@ -0,0 +1,75 @@
+import logging, threading, time
+
+from metrics import WEBHOOK_NOTIFICATIONS
+
+logger = logging.getLogger('heating')
+
+class RefreshQueue(object):
+  '''Merges bursts of refresh requests into one call of action on a worker thread.
+
+  action runs debounce_seconds after the last request of a burst (trailing
+  edge), but no later than max_delay_seconds after the first, so a steady
+  stream of requests can't hold it off forever. Requests that arrive while
+  it runs are merged into the next call.
+  '''
+  def __init__(self, action, debounce_seconds, max_delay_seconds):
+    self.action = action
+    self.debounce_seconds = debounce_seconds
+    self.max_delay_seconds = max_delay_seconds
+    self._pending = 0
+    self._first = None
+    self._last = None
+    self._running = False
+    self._condition = threading.Condition()
+    self._thread = None
+
+  def start(self):
+    self._running = True
+    self._thread = threading.Thread(target = self._run, name = 'RefreshQueue')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    self._condition.acquire()
+    self._running = False
+    self._condition.notify()
+    self._condition.release()
+
+  def request(self):
+    self._condition.acquire()
+    now = time.monotonic()
+    if self._pending == 0:
+      self._first = now
+    self._pending += 1
+    self._last = now
+    self._condition.notify()
+    self._condition.release()
+
+  def _run(self):
+    while True:
+      self._condition.acquire()
+      try:
+        while self._running:
+          if self._pending:
+            now = time.monotonic()
+            due = min(self._last + self.debounce_seconds, self._first + self.max_delay_seconds)
+            if due <= now:
+              break
+            self._condition.wait(due - now)
+          else:
+            self._condition.wait()
+        if not self._running:
+          return
+        merged = self._pending
+        self._pending = 0
+      finally:
+        self._condition.release()
+
+      logger.info('Refreshing after ' + str(merged) + ' requests')
+      WEBHOOK_NOTIFICATIONS.inc('refreshed')
+      if merged > 1:
+        WEBHOOK_NOTIFICATIONS.inc('merged', amount = merged - 1)
+      try:
+        self.action()
+      except Exception as e:
+        logger.exception('Error in queued refresh')
@@ -0,0 +1,106 @@
+import collections, threading, time
+from array import array
+
+class SampleBuffer(object):
+  '''Fixed-size ring of timestamped temperature samples for one sensor.
+
+  Only samples from the last window_seconds count towards aggregate() and
+  recent(). If the window is empty the last sample stands in for it until it
+  is older than max_age_seconds, after which the sensor has no value. The
+  running sum and the minimum over the window are kept up to date as samples
+  arrive and expire, so the mean and minimum cost nothing to read back; the
+  median sorts the (bounded) window.
+  '''
+  def __init__(self, size, window_seconds, max_age_seconds):
+    self.size = size
+    self.window_seconds = min(window_seconds, max_age_seconds)
+    self.max_age_seconds = max_age_seconds
+    self.last_timestamp = None
+    self.last_value = None
+    self._times = array('d', [0.0] * size)
+    self._values = array('d', [0.0] * size)
+    #Sequence numbers: samples[_first:_next] are in the window
+    self._next = 0
+    self._first = 0
+    self._sum = 0.0
+    #Sequence numbers of the window's minimums, values increasing
+    self._minimums = collections.deque()
+    self._lock = threading.Lock()
+
+  def append(self, timestamp, value):
+    self._lock.acquire()
+    try:
+      self._append(timestamp, value)
+    finally:
+      self._lock.release()
+
+  def aggregate(self, method, now = None):
+    '''Returns the min, mean, median or latest value in the window, or None if it is empty.'''
+    self._lock.acquire()
+    try:
+      return self._aggregate(method, now)
+    finally:
+      self._lock.release()
+
+  def recent(self, now = None):
+    '''Returns the (timestamp, value) samples in the window, oldest first.'''
+    self._lock.acquire()
+    try:
+      self._expire(now)
+      return [(self._times[seq % self.size], self._values[seq % self.size]) for seq in range(self._first, self._next)]
+    finally:
+      self._lock.release()
+
+  def _append(self, timestamp, value):
+    if self._next - self._first == self.size:
+      #Full, the oldest sample is about to be overwritten
+      self._drop_oldest()
+    position = self._next % self.size
+    self._times[position] = timestamp
+    self._values[position] = value
+    self._sum += value
+    while self._minimums and self._values[self._minimums[-1] % self.size] >= value:
+      self._minimums.pop()
+    self._minimums.append(self._next)
+    self._next += 1
+    self.last_timestamp = timestamp
+    self.last_value = value
+
+  def _aggregate(self, method, now):
+    if now is None:
+      now = time.time()
+    self._expire(now)
+    count = self._next - self._first
+    if count == 0:
+      if self.last_timestamp is not None and now - self.last_timestamp <= self.max_age_seconds:
+        return self.last_value
+      return None
+    if method == 'latest':
+      return self._values[(self._next - 1) % self.size]
+    if method == 'min':
+      return self._values[self._minimums[0] % self.size]
+    if method == 'mean':
+      return self._sum / count
+    if method == 'median':
+      values = sorted(self._values[seq % self.size] for seq in range(self._first, self._next))
+      middle = count // 2
+      if count % 2:
+        return values[middle]
+      return (values[middle - 1] + values[middle]) / 2.0
+    raise ValueError('Unknown aggregate ' + str(method))
+
+  def _expire(self, now):
+    if now is None:
+      now = time.time()
+    cutoff = now - self.window_seconds
+    while self._first < self._next and self._times[self._first % self.size] < cutoff:
+      self._drop_oldest()
+
+  def _drop_oldest(self):
+    self._sum -= self._values[self._first % self.size]
+    if self._minimums and self._minimums[0] == self._first:
+      self._minimums.popleft()
+    self._first += 1
+    if self._first == self._next:
+      #Stop floating point error building up in the running sum
+      self._sum = 0.0
@@ -0,0 +1,229 @@
+import datetime, logging, os, re, pytz
+
+from dateutil import rrule
+from tzlocal import get_localzone
+
+logger = logging.getLogger('heating')
+
+def parse_summary(summary):
+  '''Returns the desired temperature, 'On' or 'Preheat' for an event summary, or None.'''
+  try:
+    return float(summary)
+  except ValueError:
+    if summary.lower() == 'on':
+      return 'On'
+    if summary.lower() == 'preheat':
+      return 'Preheat'
+  return None
+
+class ScheduleSource(object):
+  '''Where the heating's events come from.
+
+  events(until) returns {'start_date', 'end_date', 'desired_temp'} records,
+  soonest first, for every event that hasn't ended and starts before until.
+  changed() says whether the source should be read again without waiting
+  for the next scheduled refresh.
+  '''
+  name = None
+
+  def events(self, until):
+    pass
+
+  def changed(self):
+    return False
+
+  def _record(self, summary, start_date, end_date):
+    desired_temp = parse_summary(summary)
+    if desired_temp is None:
+      logger.warn('Ignoring event ' + summary + ' at ' + str(start_date.astimezone(get_localzone())))
+      return None
+    return {'start_date': start_date, 'end_date': end_date, 'desired_temp': desired_temp}
+
+class GoogleCalendarSource(ScheduleSource):
+  '''Events from Google Calendar through a CalendarSync.'''
+  name = 'calendar'
+
+  def __init__(self, calendar):
+    self.calendar = calendar
+
+  def events(self, until):
+    self.calendar.sync(until)
+    records = []
+    for event in self.calendar.upcoming(until):
+      record = self._record(event.get('summary', ''), self.calendar.event_time(event['start']), self.calendar.event_time(event['end']))
+      if record is not None:
+        records.append(record)
+    return records
+
+class IcsSource(ScheduleSource):
+  '''Events from a local iCalendar file.
+
+  The file is parsed again when its modification time changes. Recurring
+  events are expanded with dateutil's rrule, and the expanded instances are
+  kept and extended from where they got to as the horizon moves forward,
+  so each instance is only worked out once per load. EXDATE and
+  RECURRENCE-ID instance changes are honoured; RDATE is not. A changed
+  instance is left out of its rule's expansion and kept as a separate event
+  at its new time, so it shows up whether it was moved into or out of the
+  horizon.
+  '''
+  name = 'ics'
+  UNTIL = re.compile(r'UNTIL=(\d{8}T\d{6}Z)')
+  DURATION = re.compile(r'^([+-]?)P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$')
+
+  def __init__(self, path):
+    self.path = path
+    self._mtime = None
+    self._single = []
+    self._recurring = []
+
+  def changed(self):
+    try:
+      return os.stat(self.path).st_mtime != self._mtime
+    except OSError:
+      return False
+
+  def events(self, until):
+    if self.changed() or self._mtime is None:
+      self._load()
+    now = self._now()
+
+    records = [record for record in self._single if record['end_date'] >= now and record['start_date'] < until]
+    for recurring in self._recurring:
+      self._expand(recurring, until)
+      #Instances that have ended are no use any more
+      recurring['instances'] = [(start, record) for start, record in recurring['instances'] if record['end_date'] >= now]
+      records.extend(record for start, record in recurring['instances'] if record['start_date'] < until)
+    return sorted(records, key = lambda record: record['start_date'])
+
+  def _load(self):
+    mtime = os.stat(self.path).st_mtime
+    with open(self.path, encoding = 'UTF-8') as ics_file:
+      components = self._components(ics_file.read())
+
+    single = []
+    recurring = []
+    #(UID, original start) -> replacement instance, or None if it was cancelled
+    moved = {}
+    for properties in components:
+      if 'DTSTART' not in properties:
+        continue
+      start, timezone = self._time(properties['DTSTART'][0])
+      if 'DTEND' in properties:
+        end = self._time(properties['DTEND'][0])[0]
+      elif 'DURATION' in properties:
+        end = start + self._duration(properties['DURATION'][0][1])
+      else:
+        end = start + (datetime.timedelta(days = 1) if len(properties['DTSTART'][0][1]) == 8 else datetime.timedelta(0))
+      summary = properties.get('SUMMARY', [({}, '')])[0][1]
+      cancelled = properties.get('STATUS', [({}, '')])[0][1].upper() == 'CANCELLED'
+      uid = properties.get('UID', [({}, None)])[0][1]
+
+      if 'RECURRENCE-ID' in properties:
+        original = self._aware(*self._time(properties['RECURRENCE-ID'][0]))
+        moved[(uid, original)] = None if cancelled else self._record(summary, self._aware(start, timezone), self._aware(end, timezone))
+      elif cancelled:
+        continue
+      elif 'RRULE' in properties:
+        excluded = set()
+        for parameters, value in properties.get('EXDATE', []):
+          for exdate in value.split(','):
+            excluded.add(self._aware(*self._time((parameters, exdate))))
+        recurring.append({'uid': uid, 'summary': summary, 'timezone': timezone, 'length': end - start, \
+          'rule': rrule.rrulestr(self._local_until(properties['RRULE'][0][1], timezone), dtstart = start), \
+          'excluded': excluded, 'expanded_until': None, 'instances': []})
+      else:
+        record = self._record(summary, self._aware(start, timezone), self._aware(end, timezone))
+        if record is not None:
+          single.append(record)
+
+    for recurring_event in recurring:
+      recurring_event['excluded'].update(original for (uid, original) in moved if uid == recurring_event['uid'])
+    #Changed instances are events in their own right, at their new times
+    single.extend(record for record in moved.values() if record is not None)
+
+    self._single = single
+    self._recurring = recurring
+    self._mtime = mtime
+    logger.info('Loaded ' + str(len(single)) + ' events and ' + str(len(recurring)) + ' recurring events from ' + self.path)
+
+  def _expand(self, recurring, until):
+    '''Adds the instances that start between where expansion got to and until.'''
+    timezone = recurring['timezone']
+    local_until = until.astimezone(timezone).replace(tzinfo = None)
+    if recurring['expanded_until'] is None:
+      #Start far enough back to catch instances still going now
+      now = self._now()
+      start = (now - recurring['length']).astimezone(timezone).replace(tzinfo = None)
+      starts = recurring['rule'].between(start, local_until, inc = True)
+    elif local_until > recurring['expanded_until']:
+      starts = recurring['rule'].between(recurring['expanded_until'], local_until, inc = False)
+    else:
+      return
+    recurring['expanded_until'] = local_until
+
+    for start in starts:
+      #An instance exactly at the old limit was already added
+      if recurring['instances'] and start <= recurring['instances'][-1][0]:
+        continue
+      start_date = self._aware(start, timezone)
+      if start_date in recurring['excluded']:
+        continue
+      record = self._record(recurring['summary'], start_date, self._aware(start + recurring['length'], timezone))
+      if record is not None:
+        recurring['instances'].append((start, record))
+
+  def _now(self):
+    return pytz.utc.localize(datetime.datetime.utcnow())
+
+  def _components(self, text):
+    '''Returns a dict of property name to [(parameters, value)] for each VEVENT.'''
+    #Unfold continuation lines
+    lines = re.sub(r'\r?\n[ \t]', '', text).splitlines()
+    components = []
+    properties = None
+    for line in lines:
+      if line == 'BEGIN:VEVENT':
+        properties = {}
+      elif line == 'END:VEVENT':
+        if properties is not None:
+          components.append(properties)
+        properties = None
+      elif properties is not None and ':' in line:
+        name, value = line.split(':', 1)
+        parameters = name.split(';')
+        properties.setdefault(parameters[0].upper(), []).append( \
+          (dict(parameter.upper().split('=', 1) for parameter in parameters[1:] if '=' in parameter), value))
+    return components
+
+  def _time(self, property):
+    '''Returns the naive local time and its timezone for a DTSTART style property.'''
+    parameters, value = property
+    if value.endswith('Z'):
+      return datetime.datetime.strptime(value, '%Y%m%dT%H%M%SZ'), pytz.utc
+    timezone = pytz.timezone(parameters['TZID']) if 'TZID' in parameters else get_localzone()
+    if len(value) == 8:
+      return datetime.datetime.strptime(value, '%Y%m%d'), timezone
+    return datetime.datetime.strptime(value, '%Y%m%dT%H%M%S'), timezone
+
+  def _aware(self, local, timezone):
+    if hasattr(timezone, 'localize'):
+      return timezone.localize(local).astimezone(pytz.utc)
+    return local.replace(tzinfo = timezone).astimezone(pytz.utc)
+
+  def _local_until(self, rule, timezone):
+    '''Rewrites a UTC UNTIL in the rule as local time, as the rule is expanded in local time.'''
+    match = IcsSource.UNTIL.search(rule)
+    if match is None:
+      return rule
+    until = pytz.utc.localize(datetime.datetime.strptime(match.group(1), '%Y%m%dT%H%M%SZ')).astimezone(timezone)
+    return rule[:match.start(1)] + until.strftime('%Y%m%dT%H%M%S') + rule[match.end(1):]
+
+  def _duration(self, value):
+    match = IcsSource.DURATION.match(value)
+    if match is None:
+      raise ValueError('Bad DURATION ' + value)
+    sign, weeks, days, hours, minutes, seconds = match.groups()
+    duration = datetime.timedelta(weeks = int(weeks or 0), days = int(days or 0), hours = int(hours or 0), \
+      minutes = int(minutes or 0), seconds = int(seconds or 0))
+    return -duration if sign == '-' else duration
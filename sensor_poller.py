@@ -0,0 +1,101 @@
+import logging, threading, time, math
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from temp_sensor import NoTemperatureException
+from metrics import SENSOR_READ_SECONDS
+from tracing import TRACER
+
+logger = logging.getLogger('heating')
+
+class SensorPoller(object):
+  '''Reads every registered sensor concurrently, once per cycle.
+
+  Reads run on a private pool so a slow tag never ties up a scheduler worker.
+  At most max_concurrent_reads sensors are read at the same time and each read
+  has read_timeout_seconds from the moment it starts to produce a value.
+  '''
+  def __init__(self, max_concurrent_reads, read_timeout_seconds):
+    self.max_concurrent_reads = max_concurrent_reads
+    self.read_timeout_seconds = read_timeout_seconds
+    self._executor = ThreadPoolExecutor(max_workers=max_concurrent_reads, thread_name_prefix='SensorPoller')
+    #MAC -> future for reads that overran and are still holding a worker
+    self._in_flight = {}
+    self._lock = threading.Lock()
+
+  def poll(self, sensors):
+    '''Reads all the given sensors.
+
+    Returns:
+        (readings, failures) where readings maps MAC to temperature and failures
+        maps MAC to the exception raised by that sensor's read.
+    '''
+    readings = {}
+    failures = {}
+    futures = {}
+
+    trace = TRACER.current()
+    self._lock.acquire()
+    for sensor in sensors:
+      previous = self._in_flight.get(sensor.mac)
+      if previous is not None and not previous.done():
+        logger.warn('Previous read of ' + sensor.mac + ' still running, skipping this cycle')
+        failures[sensor.mac] = ReadTimeoutException('Read of ' + sensor.mac + ' still running')
+        continue
+      future = self._executor.submit(self._traced_read, sensor, trace)
+      futures[future] = sensor
+      self._in_flight[sensor.mac] = future
+    self._lock.release()
+
+    if not futures:
+      return readings, failures
+
+    #Reads queue behind the concurrency cap so allow enough rounds for all of them
+    rounds = math.ceil(len(futures) / float(self.max_concurrent_reads))
+    done, not_done = wait(list(futures.keys()), timeout = rounds * self.read_timeout_seconds)
+
+    for future in done:
+      sensor = futures[future]
+      try:
+        readings[sensor.mac] = future.result()
+      except Exception as e:
+        failures[sensor.mac] = e
+
+    for future in not_done:
+      sensor = futures[future]
+      logger.warn('Timed out reading ' + sensor.mac)
+      failures[sensor.mac] = ReadTimeoutException('Timed out reading ' + sensor.mac)
+
+    self._lock.acquire()
+    for future, sensor in futures.items():
+      if future.done() and self._in_flight.get(sensor.mac) is future:
+        del self._in_flight[sensor.mac]
+    self._lock.release()
+
+    logger.debug('Polled ' + str(len(futures)) + ' sensors: ' + str(readings) + \
+      (', failed ' + str(list(failures.keys())) if failures else ''))
+    return readings, failures
+
+  def _traced_read(self, sensor, trace):
+    with TRACER.activate(trace), TRACER.span('sensor_read', mac = sensor.mac):
+      return self._read(sensor)
+
+  def _read(self, sensor):
+    started = time.monotonic()
+    try:
+      sensor.get_ambient_temp()
+    finally:
+      sensor.last_read_seconds = time.monotonic() - started
+      SENSOR_READ_SECONDS.observe(sensor.last_read_seconds, type(sensor).__name__)
+    if sensor.last_read_seconds > self.read_timeout_seconds:
+      #poll() has already stopped waiting if this overran its round, but the value is still good
+      logger.warn('Read of ' + sensor.mac + ' took ' + str(round(sensor.last_read_seconds, 2)) + \
+        's, longer than ' + str(self.read_timeout_seconds) + 's')
+    if sensor.amb_temp is None:
+      raise NoTemperatureException('Could not get temperature from ' + sensor.mac)
+    return sensor.amb_temp
+
+  def shutdown(self):
+    self._executor.shutdown(wait = False)
+
+class ReadTimeoutException(Exception):
+  pass
@@ -0,0 +1,53 @@
+import hashlib, json, threading
+
+class StateSnapshot(object):
+  '''One published copy of the heating state, already encoded for sending.'''
+  __slots__ = ('data', 'body', 'etag', 'version', 'changed')
+
+  def __init__(self, data, body, etag, version, changed):
+    self.data = data
+    self.body = body
+    self.etag = etag
+    self.version = version
+    #Watched keys that differ from the previous snapshot
+    self.changed = changed
+
+class StatePublisher(object):
+  '''Holds the latest StateSnapshot.
+
+  Publishing builds a new snapshot and swaps the reference, so readers just
+  take whatever current points at without locking. Publishing state that
+  encodes the same as the current snapshot is a no-op.
+
+  The comparison with the previous snapshot and on_change both happen under
+  the lock, so concurrent publishers see every change exactly once and in
+  order.
+  '''
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.current = self._snapshot({}, 0)
+
+  def publish(self, data, watched = (), on_change = None):
+    '''Publishes new state and returns the snapshot if it changed, otherwise None.
+
+    If any of the watched keys changed, on_change is called with the new
+    snapshot before the lock is released.
+    '''
+    self._lock.acquire()
+    try:
+      body = json.dumps(data, sort_keys = True).encode('UTF-8')
+      if body == self.current.body:
+        return None
+      previous = self.current.data
+      changed = [key for key in watched if previous.get(key) != data.get(key)]
+      self.current = self._snapshot(data, self.current.version + 1, body, changed)
+      if changed and on_change is not None:
+        on_change(self.current)
+      return self.current
+    finally:
+      self._lock.release()
+
+  def _snapshot(self, data, version, body = None, changed = None):
+    if body is None:
+      body = json.dumps(data, sort_keys = True).encode('UTF-8')
+    return StateSnapshot(data, body, '"' + hashlib.sha1(body).hexdigest()[:20] + '"', version, changed or [])
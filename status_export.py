@@ -0,0 +1,74 @@
+import logging, mmap, os, struct, threading, time
+
+logger = logging.getLogger('heating')
+
+class StatusExport(object):
+  '''Fixed-layout status record in a memory-mapped file for local readers.
+
+  The file is a header followed by one record and room for MAX_SENSORS
+  sensor entries. The header's sequence number is odd while the record is
+  being rewritten, so a reader that sees the same even number before and
+  after copying the record knows the copy is whole. See status_reader.py.
+
+  Unknown values are NaN. desired_mode is the index in MODES, with the
+  temperature in desired_temp when it is 0.
+  '''
+  HEADER = struct.Struct('<4sIQ')
+  RECORD = struct.Struct('<ddddddddBBH4x')
+  SENSOR = struct.Struct('<6s2xdd')
+  MAGIC = b'HST1'
+  LAYOUT = 1
+  MAX_SENSORS = 16
+  SIZE = HEADER.size + RECORD.size + MAX_SENSORS * SENSOR.size
+  SEQUENCE_OFFSET = 8
+  FIELDS = ('updated_at', 'current_temp', 'desired_temp', 'proportional_time', 'time_on', 'time_off', \
+    'outside_temp', 'outside_apparent_temp', 'flags', 'desired_mode', 'sensor_count')
+  MODES = ('temperature', 'On', 'Preheat', 'Off')
+  HEATING_ON = 1
+  PREHEAT_ON = 2
+  OVERRIDE = 4
+
+  def __init__(self, path):
+    self.path = path
+    self._lock = threading.Lock()
+    fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+      if os.fstat(fd).st_size != StatusExport.SIZE:
+        os.ftruncate(fd, StatusExport.SIZE)
+      self._map = mmap.mmap(fd, StatusExport.SIZE)
+    finally:
+      os.close(fd)
+    magic, layout, sequence = StatusExport.HEADER.unpack_from(self._map, 0)
+    if magic != StatusExport.MAGIC or layout != StatusExport.LAYOUT:
+      sequence = 0
+    #Carry on from the previous run's number so readers never see it go back to a value they've seen
+    self._sequence = sequence + (sequence & 1)
+    StatusExport.HEADER.pack_into(self._map, 0, StatusExport.MAGIC, StatusExport.LAYOUT, self._sequence)
+    logger.debug('Exporting status to ' + self.path)
+
+  def write(self, values, sensors):
+    '''Rewrites the record from values, keyed by FIELDS, and (mac, temperature, last_seen) sensors.'''
+    record = [values.get(field, float('nan')) for field in StatusExport.FIELDS]
+    record[0] = time.time()
+    sensors = sensors[:StatusExport.MAX_SENSORS]
+    record[-1] = len(sensors)
+    record = StatusExport.RECORD.pack(*[float('nan') if value is None else value for value in record])
+    entries = b''.join(StatusExport.SENSOR.pack(bytes.fromhex(mac.replace(':', '')), \
+      float('nan') if temperature is None else temperature, last_seen or float('nan')) for mac, temperature, last_seen in sensors)
+
+    self._lock.acquire()
+    try:
+      self._sequence += 1
+      struct.pack_into('<Q', self._map, StatusExport.SEQUENCE_OFFSET, self._sequence)
+      self._map[StatusExport.HEADER.size:StatusExport.HEADER.size + len(record)] = record
+      offset = StatusExport.HEADER.size + StatusExport.RECORD.size
+      self._map[offset:offset + len(entries)] = entries
+      self._sequence += 1
+      struct.pack_into('<Q', self._map, StatusExport.SEQUENCE_OFFSET, self._sequence)
+    finally:
+      self._lock.release()
+
+  def close(self):
+    self._lock.acquire()
+    self._map.close()
+    self._lock.release()
@@ -0,0 +1,68 @@
+#!/usr/bin/python
+'''Reads the status record written by status_export.StatusExport.
+
+  import status_reader
+  status = status_reader.read_status('/dev/shm/heating-status')
+  print(status['current_temp'], status['heating_on'])
+
+Only needs the standard library, so collectd and conky scripts can use it.
+'''
+import json, mmap, struct, sys, time
+
+from status_export import StatusExport
+
+class StatusReader(object):
+  '''Keeps the status file mapped for readers that poll it often.'''
+  def __init__(self, path):
+    with open(path, 'rb') as status_file:
+      self._map = mmap.mmap(status_file.fileno(), StatusExport.SIZE, access = mmap.ACCESS_READ)
+    magic, layout, sequence = StatusExport.HEADER.unpack_from(self._map, 0)
+    if magic != StatusExport.MAGIC or layout != StatusExport.LAYOUT:
+      raise Exception('Not a heating status file: ' + path)
+
+  def read(self, retries = 1000):
+    '''Returns the status as a dict, retrying while the record is being written.'''
+    for attempt in range(retries):
+      before = struct.unpack_from('<Q', self._map, StatusExport.SEQUENCE_OFFSET)[0]
+      if before & 1:
+        time.sleep(0)
+        continue
+      data = self._map[StatusExport.HEADER.size:StatusExport.SIZE]
+      if struct.unpack_from('<Q', self._map, StatusExport.SEQUENCE_OFFSET)[0] == before:
+        return self._decode(data, before)
+    raise Exception('Status record kept changing while being read')
+
+  def close(self):
+    self._map.close()
+
+  def _decode(self, data, sequence):
+    status = dict(zip(StatusExport.FIELDS, StatusExport.RECORD.unpack_from(data, 0)))
+    for field in StatusExport.FIELDS[:8]:
+      if status[field] != status[field]:
+        status[field] = None
+    mode = StatusExport.MODES[status['desired_mode']] if status['desired_mode'] < len(StatusExport.MODES) else None
+    if mode != 'temperature':
+      status['desired_temp'] = mode
+    status['heating_on'] = bool(status['flags'] & StatusExport.HEATING_ON)
+    status['preheat_on'] = bool(status['flags'] & StatusExport.PREHEAT_ON)
+    status['override'] = bool(status['flags'] & StatusExport.OVERRIDE)
+    status['sequence'] = sequence
+
+    sensors = {}
+    for index in range(min(status['sensor_count'], StatusExport.MAX_SENSORS)):
+      mac, temperature, last_seen = StatusExport.SENSOR.unpack_from(data, StatusExport.RECORD.size + index * StatusExport.SENSOR.size)
+      sensors[':'.join('%02x' % byte for byte in mac)] = { \
+        'temperature': None if temperature != temperature else temperature, \
+        'last_seen': None if last_seen != last_seen else last_seen}
+    status['sensors'] = sensors
+    return status
+
+def read_status(path):
+  reader = StatusReader(path)
+  try:
+    return reader.read()
+  finally:
+    reader.close()
+
+if __name__ == '__main__':
+  print(json.dumps(read_status(sys.argv[1] if len(sys.argv) > 1 else '/dev/shm/heating-status'), indent = 2, sort_keys = True))
@@ -1,105 +1,269 @@
-import struct, time, logging, threading
+import struct, time, logging, threading, collections
 import dbus
 
-from bluepy.btle import Scanner, DefaultDelegate, Peripheral, BTLEException
+from bluepy.btle import Scanner, DefaultDelegate, Peripheral, BTLEException, BTLEGattError
 from bluepy import btle
 
+from ble_connection import BLEConnection, DisconnectedException
+from sample_buffer import SampleBuffer
+from metrics import acquire, SCAN_SECONDS
+
 logger = logging.getLogger('heating')
 
 class TempSensor(object):
   _scanning_lock = threading.Lock()
+  #Set from config; persists UUID to handle maps across reconnects and restarts
+  handle_cache = None
+  sample_buffer_size = 256
+  sample_window_seconds = 300
+  max_sample_age_seconds = 900
 
-  def __init__(self, peripheral):
+  def __init__(self, peripheral, adapter = None):
     self.mac = peripheral.addr
+    self.adapter = adapter if adapter is not None else peripheral.iface
     self.sent_alert = False
     self.amb_temp = None
-    self.temp_job_id = None
-    self.peripheral = Peripheral(peripheral)
-    self.characteristics = {}
+    #When amb_temp was measured, which for notified or logged readings is before it was read
+    self.amb_temp_time = None
+    #(time, value) measurements not yet taken by take_samples()
+    self.new_samples = collections.deque(maxlen = TempSensor.sample_buffer_size)
+    self.rssi = peripheral.rssi
+    self.last_seen = time.time()
+    self.previous_amb_temp = None
+    self.amb_temp_at_last_poll = None
+    self.samples = SampleBuffer(TempSensor.sample_buffer_size, TempSensor.sample_window_seconds, TempSensor.max_sample_age_seconds)
+    #Adaptive polling state, see PollingPolicy
+    self.last_read = 0
+    self.next_read = 0
+    self.poll_interval = None
+    self.poll_reason = None
+    self.last_read_seconds = None
+    self.connection = BLEConnection(peripheral.addr, peripheral.addrType, self.adapter, on_connect = self._on_connect)
+    self.handles = {}
+
+  @property
+  def peripheral(self):
+    return self.connection.get()
 
   def connect(self):
-    self.tag.connect()
+    self.connection.get()
 
   def disconnect(self):
-    self.tag.disconnect()
+    self.connection.close()
+
+  def move_to_adapter(self, adapter):
+    self.adapter = adapter
+    self.connection.move_to(adapter)
+
+  def _on_connect(self):
+    if TempSensor.handle_cache is None:
+      return
+
+    cached = TempSensor.handle_cache.get(self.mac)
+    try:
+      if cached is not None and cached['firmware_handle'] is not None:
+        firmware = self.peripheral.readCharacteristic(cached['firmware_handle']).decode(errors = 'replace')
+        if firmware == cached['firmware']:
+          logger.debug('Using cached GATT handles for ' + self.mac + ' firmware ' + firmware)
+          self.handles = cached['handles']
+          return
+        logger.info('Firmware on ' + self.mac + ' is now ' + firmware + ', rediscovering GATT handles')
+
+      self.handles = {}
+      firmware = ''
+      firmware_handle = None
+      #Firmware Revision String
+      characteristics = self.peripheral.getCharacteristics(uuid='00002a26-0000-1000-8000-00805f9b34fb')
+      if characteristics:
+        firmware_handle = characteristics[0].getHandle()
+        firmware = characteristics[0].read().decode(errors = 'replace')
+      TempSensor.handle_cache.reset(self.mac, firmware, firmware_handle)
+    except BTLEException as e:
+      logger.warn('Could not check firmware on ' + self.mac + ': ' + str(e))
+      #Only a GATT error says anything about the handles; a dropped link checks again on reconnect
+      if isinstance(e, BTLEGattError):
+        self.handles = {}
+        TempSensor.handle_cache.invalidate(self.mac)
 
   def get_ambient_temp(self):
     pass
 
-  def _write_uuid(self, uuid, data):
-    try:
-      if not uuid in self.characteristics:
-        self.characteristics[uuid] = self.peripheral.getCharacteristics(uuid=uuid)[0]
+  def take_samples(self):
+    '''Returns the measurements made since the last call, oldest first.'''
+    samples = []
+    while self.new_samples:
+      samples.append(self.new_samples.popleft())
+    return sorted(samples)
+
+  def _measured(self, value, timestamp):
+    self.amb_temp = value
+    self.amb_temp_time = timestamp
+    self.new_samples.append((timestamp, value))
+
+  def _characteristic_handle(self, uuid):
+    if not uuid in self.handles:
+      characteristics = self.peripheral.getCharacteristics(uuid=uuid)
 
       #If there's still no characteristic, error
-      if not uuid in self.characteristics:
+      if not characteristics:
         raise Exception('UUID ' + str(uuid) + ' not found on device ' + self.mac)
 
-      self.characteristics[uuid].write(data)
+      self._remember_handle(uuid, characteristics[0].getHandle())
+    return self.handles[uuid]
+
+  def _descriptor_handle(self, uuid, descriptor_uuid):
+    key = uuid + '/' + descriptor_uuid
+    if not key in self.handles:
+      characteristic = self.peripheral.getCharacteristics(uuid=uuid)[0]
+      self._remember_handle(uuid, characteristic.getHandle())
+      self._remember_handle(key, characteristic.getDescriptors(forUUID=descriptor_uuid)[0].handle)
+    return self.handles[key]
+
+  def _remember_handle(self, key, handle):
+    self.handles[key] = handle
+    if TempSensor.handle_cache is not None:
+      TempSensor.handle_cache.store(self.mac, key, handle)
+
+  def _handle_failed(self, e):
+    #A GATT error such as an invalid handle means the handles are stale, so rediscover
+    #after reconnecting; a plain dropped link keeps them
+    if isinstance(e, BTLEGattError):
+      self.handles = {}
+      if TempSensor.handle_cache is not None:
+        TempSensor.handle_cache.invalidate(self.mac)
+    self.connection.lost()
+    raise DisconnectedException(str(e))
+
+  def _write_uuid(self, uuid, data):
+    try:
+      self.peripheral.writeCharacteristic(self._characteristic_handle(uuid), data)
     except BTLEException as e:
-      logger.warn(self.mac + ' disconnected. Try to reconnect.')
-      raise DisconnectedException(e.message)
+      self._handle_failed(e)
 
   def _read_uuid(self, uuid):
     try:
-      if not uuid in self.characteristics:
-        self.characteristics[uuid] = self.peripheral.getCharacteristics(uuid=uuid)[0]
-
-      #If there's still no characteristic, error
-      if not uuid in self.characteristics:
-        raise Exception('UUID ' + str(uuid) + ' not found on device ' + self.mac)
-
-      return self.characteristics[uuid].read()
+      return self.peripheral.readCharacteristic(self._characteristic_handle(uuid))
     except BTLEException as e:
-      logger.warn(self.mac + ' disconnected. Try to reconnect.')
-      raise DisconnectedException(e.message)
+      self._handle_failed(e)
 
   @staticmethod
-  def find_temp_sensors(sensors):
-    TempSensor._scanning_lock.acquire()
-    logger.debug('Scanning for devices')
-    scanner = Scanner().withDelegate(ScanDelegate())
-    try:
-      devices = scanner.scan(10.0)
-      if sensors is None:
-        sensors = {}
-      for device in devices:
-        if device.addr in sensors:
-          continue
-        name = ''
-        if device.getValueText(9):
-          name = device.getValueText(9)
-        elif device.getValueText(8):
-          name = device.getValueText(8)
-        logger.debug('Device name: ' + name)
-        if 'SensorTag' in name:
-          logger.info('Found SensorTag with address: ' + device.addr)
-          sensors[device.addr] = SensorTag(device)
-        elif 'MetaWear' in name:
-          logger.info('Found MetaWear with address: ' + device.addr)
-          sensors[device.addr] = MetaWear(device)
-      logger.debug('Finished scanning for devices')
-      TempSensor._scanning_lock.release()
-      if len(sensors) == 0:
-        raise NoTagsFoundException('No sensors found!')
-    except BTLEException as e:
-      scanner.stop()
-      logger.warn('Got exception ' + e.message)
-      TempSensor._scanning_lock.release()
-    return sensors
+  def from_scan_entry(device, adapter = None):
+    '''Returns a sensor for an advertising device, or None if it isn't one we know.'''
+    name = ''
+    if device.getValueText(9):
+      name = device.getValueText(9)
+    elif device.getValueText(8):
+      name = device.getValueText(8)
+    if 'SensorTag' in name:
+      logger.info('Found SensorTag with address: ' + device.addr)
+      return SensorTag(device, adapter)
+    elif 'MetaWear' in name:
+      logger.info('Found MetaWear with address: ' + device.addr)
+      return MetaWear(device, adapter)
+    return None
 
 class ScanDelegate(DefaultDelegate):
-  def __init__(self):
+  def __init__(self, sensor_scanner = None):
     DefaultDelegate.__init__(self)
+    self.sensor_scanner = sensor_scanner
 
   def handleDiscovery(self, dev, isNewDev, isNewData):
-    pass
+    if self.sensor_scanner is not None:
+      self.sensor_scanner.discovered(dev, isNewDev, isNewData)
+
+class SensorScanner(object):
+  '''Long-lived background scanner that registers sensors as they advertise.
+
+  Scans for window_seconds out of every interval_seconds and holds
+  TempSensor._scanning_lock only while scanning, so sensor reads which take the
+  same lock get the adapter to themselves. Until at least one sensor is known
+  it scans back to back.
+
+  Sensors are recognised by name, which is usually only in the scan response
+  that a passive scan never asks for. With passive set, scans are still
+  active until a sensor is known and every ACTIVE_SCAN_EVERY scans after
+  that, and the passive ones only refresh the RSSI of known sensors.
+  '''
+  ACTIVE_SCAN_EVERY = 10
+
+  def __init__(self, sensors, window_seconds, interval_seconds, passive, adapter = 0, placement = None):
+    self.sensors = sensors
+    self.placement = placement
+    self.window_seconds = window_seconds
+    self.interval_seconds = interval_seconds
+    self.passive = passive
+    self._scanner = Scanner(adapter).withDelegate(ScanDelegate(self))
+    self._stop_event = threading.Event()
+    self._thread = None
+    self._scans = 0
+
+  def start(self):
+    self._thread = threading.Thread(target=self._run, name='SensorScanner')
+    self._thread.setDaemon(True)
+    self._thread.start()
+
+  def stop(self):
+    self._stop_event.set()
+
+  def discovered(self, dev, isNewDev, isNewData):
+    sensor = self.sensors.get(dev.addr)
+    if sensor is None and (isNewDev or isNewData):
+      sensor = TempSensor.from_scan_entry(dev)
+      if sensor is None:
+        return
+      if self.placement is not None:
+        #Not connected yet, so this only picks the adapter the first connection uses
+        sensor.move_to_adapter(self.placement.place(dev.addr))
+      self.sensors[dev.addr] = sensor
+    if sensor is not None:
+      sensor.rssi = dev.rssi
+      sensor.last_seen = time.time()
+
+  def _run(self):
+    while not self._stop_event.is_set():
+      acquire(TempSensor._scanning_lock, 'scanning')
+      try:
+        with SCAN_SECONDS.time():
+          self._scanner.clear()
+          self._scanner.start(passive = self._scan_passively())
+          self._scanner.process(self.window_seconds)
+      except BTLEException as e:
+        logger.warn('Got exception while scanning: ' + str(e))
+      finally:
+        try:
+          self._scanner.stop()
+        except BTLEException as e:
+          pass
+        TempSensor._scanning_lock.release()
+
+      if self.sensors:
+        self._stop_event.wait(max(0, self.interval_seconds - self.window_seconds))
+
+  def _scan_passively(self):
+    passive = self.passive and bool(self.sensors) and self._scans % SensorScanner.ACTIVE_SCAN_EVERY != 0
+    self._scans += 1
+    return passive
 
 class SensorTag(TempSensor):
-  def __init__(self, peripheral):
-    TempSensor.__init__(self, peripheral)
+  #Set from config; when enabled the tag pushes readings instead of being polled
+  use_notifications = False
+  notification_period_ms = 1000
+
+  def __init__(self, peripheral, adapter = None):
+    TempSensor.__init__(self, peripheral, adapter)
+    self.subscribed = False
+    self.last_notification = None
+
+  def _on_connect(self):
+    TempSensor._on_connect(self)
+    #Notifications don't survive a reconnect
+    self.subscribed = False
 
   def get_ambient_temp(self):
+    if SensorTag.use_notifications:
+      self._get_notified_temp()
+      return
+
     tAmb = 0
     failures = 0
     while tAmb == 0 and failures < 4:
@@ -134,19 +298,98 @@ class SensorTag(TempSensor):
           failures = 0
 
       except DisconnectedException as e:
-        raise NoTemperatureException(e.message)
+        raise NoTemperatureException(str(e))
 
     if tAmb == 0:
       self.amb_temp = None
       raise NoTemperatureException('Could not get temperature from ' + self.mac)
     logger.info('Got temperature ' + str(tAmb) + ' from ' + self.mac)
-    self.amb_temp = tAmb
+    self._measured(tAmb, time.time())
+
+  def _subscribe(self):
+    logger.info('Subscribing to temperature notifications from ' + self.mac)
+    handle = self._characteristic_handle('f000aa01-0451-4000-b000-000000000000')
+    cccd_handle = self._descriptor_handle('f000aa01-0451-4000-b000-000000000000', '00002902-0000-1000-8000-00805f9b34fb')
+    self.peripheral.withDelegate(SensorTagDelegate(self, handle))
+
+    #Measurement period is in units of 10ms, 300ms to 2.55s
+    period = max(30, min(255, int(SensorTag.notification_period_ms / 10)))
+    self._write_uuid('f000aa03-0451-4000-b000-000000000000', bytes([period]))
+
+    #Turn temperature sensor on and leave it on
+    self._write_uuid('f000aa02-0451-4000-b000-000000000000', b'\x01')
+
+    self.peripheral.writeCharacteristic(cccd_handle, b'\x01\x00', withResponse=True)
+    self.subscribed = True
+
+  def _get_notified_temp(self):
+    period = max(0.3, SensorTag.notification_period_ms / 1000.0)
+    try:
+      if not self.subscribed:
+        self._subscribe()
+
+      #bluepy hands queued notifications to the delegate while it waits on the link
+      while self.peripheral.waitForNotifications(0):
+        pass
+
+      if self.last_notification is None or time.time() - self.last_notification > period * 2:
+        self.peripheral.waitForNotifications(period * 2)
+    except BTLEException as e:
+      self.connection.lost()
+      raise NoTemperatureException(str(e))
+    except DisconnectedException as e:
+      raise NoTemperatureException(str(e))
+
+    if self.last_notification is None or time.time() - self.last_notification > period * 4:
+      #Notifications have stopped, subscribe again next time
+      self.subscribed = False
+      self.amb_temp = None
+      raise NoTemperatureException('No temperature notifications from ' + self.mac)
+    logger.info('Got temperature ' + str(self.amb_temp) + ' from ' + self.mac)
+
+class SensorTagDelegate(DefaultDelegate):
+  def __init__(self, sensor, handle):
+    DefaultDelegate.__init__(self)
+    self.sensor = sensor
+    self.handle = handle
+
+  def handleNotification(self, cHandle, data):
+    if cHandle != self.handle:
+      return
+    (rawVobj, rawTamb) = struct.unpack('<hh', data)
+    tAmb = rawTamb / 128.0
+    if tAmb != 0:
+      self.sensor.last_notification = time.time()
+      self.sensor._measured(tAmb, self.sensor.last_notification)
 
 class MetaWear(TempSensor):
-  def __init__(self, peripheral):
-    TempSensor.__init__(self, peripheral)
+  #Set from config; when enabled the board logs temperature itself and is only
+  #connected to every download_interval_seconds to fetch the buffered samples
+  use_logging = False
+  log_period_seconds = 10
+  download_interval_seconds = 600
+
+  #Seconds per tick of the logger's timestamp counter
+  TICK_SECONDS = 48.0 / 32768.0
+
+  def __init__(self, peripheral, adapter = None):
+    TempSensor.__init__(self, peripheral, adapter)
+    self.logging_set_up = False
+    self.log_id = None
+    self.reference_tick = None
+    self.reference_time = None
+    self.last_download = None
+    #(time, value) of the newest logged sample
+    self.last_logged = None
+    #A download can bring back many more samples than a read would
+    self.new_samples = collections.deque(maxlen = 4096)
+    self._responses = []
 
   def get_ambient_temp(self):
+    if MetaWear.use_logging:
+      self._get_logged_temp()
+      return
+
     self.connect()
     tAmb = 0
     failures = 0
@@ -170,7 +413,7 @@ class MetaWear(TempSensor):
           count += 1
           time.sleep(0.2)
           result = self._read_uuid('326a9006-85cb-9195-d9dd-464cfbbae75a')
-          (rawTamb,) = struct.unpack('<xxxh', str(result))
+          (rawTamb,) = struct.unpack('<xxxh', result)
           tAmb = rawTamb / 8.0
 
         if count == 8:
@@ -179,19 +422,149 @@ class MetaWear(TempSensor):
           failures = 0
 
       except DisconnectedException as e:
-        raise NoTemperatureException(e.message)
+        raise NoTemperatureException(str(e))
 
     if tAmb == 0:
       self.amb_temp = None
       raise NoTemperatureException('Could not get temperature from ' + self.mac)
     logger.info('Got temperature ' + str(tAmb) + ' from ' + self.mac)
+    self._measured(tAmb, time.time())
+
+  def _get_logged_temp(self):
+    if self.last_download is not None and time.time() - self.last_download < MetaWear.download_interval_seconds:
+      if self.amb_temp is None:
+        raise NoTemperatureException('No logged temperature from ' + self.mac + ' yet')
+      self._check_logged_age(self.last_logged[0])
+      return
+
+    try:
+      self._enable_notifications()
+      if not self.logging_set_up:
+        self._set_up_logging()
+      self._download_log()
+    except BTLEException as e:
+      self.logging_set_up = False
+      self.connection.lost()
+      raise NoTemperatureException(str(e))
+    except DisconnectedException as e:
+      raise NoTemperatureException(str(e))
+    finally:
+      #Stay off the air until the next download
+      self.disconnect()
+
+    self.last_download = time.time()
+    if self.last_logged is None:
+      self.amb_temp = None
+      raise NoTemperatureException('Could not get temperature from ' + self.mac)
+    (sample_time, tAmb) = self.last_logged
+    self._check_logged_age(sample_time)
+    logger.info('Got temperature ' + str(tAmb) + ' from ' + self.mac + ' logged at ' + time.ctime(sample_time))
     self.amb_temp = tAmb
+    self.amb_temp_time = sample_time
 
-class NoTagsFoundException(Exception):
-  pass
+  def _check_logged_age(self, sample_time):
+    #Nothing new has been logged if the board was reset or its logger stopped,
+    #so set logging up again on the next download rather than repeat an old value
+    if time.time() - sample_time > 2 * MetaWear.download_interval_seconds:
+      self.amb_temp = None
+      self.logging_set_up = False
+      self.last_download = None
+      raise NoTemperatureException('Last logged temperature from ' + self.mac + ' was at ' + time.ctime(sample_time) + \
+        ', setting up logging again')
+
+  def _enable_notifications(self):
+    handle = self._characteristic_handle('326a9006-85cb-9195-d9dd-464cfbbae75a')
+    cccd_handle = self._descriptor_handle('326a9006-85cb-9195-d9dd-464cfbbae75a', '00002902-0000-1000-8000-00805f9b34fb')
+    self.peripheral.withDelegate(MetaWearDelegate(self, handle))
+    self.peripheral.writeCharacteristic(cccd_handle, b'\x01\x00', withResponse=True)
+
+  def _command(self, data, response = None, timeout = 5.0):
+    '''Writes a command and, if a response header is given, returns the matching response.'''
+    self._responses = []
+    self._write_uuid('326a9001-85cb-9195-d9dd-464cfbbae75a', data)
+    if response is None:
+      return None
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+      for received in self._responses:
+        if received[:len(response)] == response:
+          return received[len(response):]
+      self.peripheral.waitForNotifications(deadline - time.time())
+    raise NoTemperatureException('No response to ' + data.hex() + ' from ' + self.mac)
+
+  def _set_up_logging(self):
+    logger.info('Setting up temperature logging on ' + self.mac + ' every ' + str(MetaWear.log_period_seconds) + 's')
+    #Stop logging and throw away anything left from a previous run
+    self._command(b'\x0b\x01\x00')
+    self._command(b'\x0b\x09' + struct.pack('<I', 0xffffffff))
+
+    #Log every temperature reading from channel 1
+    self.log_id = self._command(b'\x0b\x02\x04\x81\x01\x01', b'\x0b\x02')[0]
+
+    #Timer that fires forever, and an event that reads the temperature each time it does
+    timer_id = self._command(b'\x0c\x02' + struct.pack('<IHB', int(MetaWear.log_period_seconds * 1000), 0xffff, 0), b'\x0c\x02')[0]
+    self._command(bytes([0x0a, 0x02, 0x0c, 0x06, timer_id, 0x04, 0x81, 0x01]), b'\x0a\x02')
+    self._command(b'\x0a\x03\x01')
+
+    #Pair logger ticks with wall clock time so samples can be timestamped
+    result = self._command(b'\x0b\x84', b'\x0b\x84')
+    (self.reference_tick,) = struct.unpack('<I', result[:4])
+    self.reference_time = time.time()
+
+    self._command(b'\x0b\x01\x01')
+    self._command(bytes([0x0c, 0x03, timer_id]))
+    self.logging_set_up = True
+
+  def _download_log(self):
+    (entries,) = struct.unpack('<I', self._command(b'\x0b\x85', b'\x0b\x85')[:4])
+    logger.debug('Downloading ' + str(entries) + ' log entries from ' + self.mac)
+    if entries == 0:
+      return
+
+    #Stream everything in one go with no progress notifications
+    self._command(b'\x0b\x06' + struct.pack('<II', entries, 0))
+    deadline = time.time() + 30
+    finished = False
+    samples = []
+    while not finished and time.time() < deadline:
+      self.peripheral.waitForNotifications(1.0)
+      for received in self._responses:
+        if received[:2] == b'\x0b\x07':
+          samples.extend(self._decode_entries(received[2:]))
+        elif received[:2] == b'\x0b\x08':
+          finished = True
+      self._responses = []
+    if not finished:
+      #The entries stay on the board for the next download
+      raise NoTemperatureException('Log download from ' + self.mac + ' did not finish')
+
+    self._command(b'\x0b\x09' + struct.pack('<I', entries))
+    samples.sort()
+    self.new_samples.extend(samples)
+    if samples:
+      self.last_logged = samples[-1]
+
+  def _decode_entries(self, data):
+    '''Returns the (time, value) temperature samples in a chunk of log entries.'''
+    samples = []
+    #Each entry is log id, uint32 tick and four bytes of data
+    for offset in range(0, len(data) - 8, 9):
+      (entry_id, tick, rawTamb) = struct.unpack('<BIh2x', data[offset:offset + 9])
+      if entry_id & 0x1f != self.log_id:
+        continue
+      sample_time = self.reference_time + (tick - self.reference_tick) * MetaWear.TICK_SECONDS
+      samples.append((sample_time, rawTamb / 8.0))
+    return samples
+
+class MetaWearDelegate(DefaultDelegate):
+  def __init__(self, sensor, handle):
+    DefaultDelegate.__init__(self)
+    self.sensor = sensor
+    self.handle = handle
 
-class DisconnectedException(Exception):
-  pass
+  def handleNotification(self, cHandle, data):
+    if cHandle == self.handle:
+      self.sensor._responses.append(data)
 
 class NoTemperatureException(Exception):
   pass
@@ -0,0 +1,70 @@
+import unittest
+
+from adapter_placement import AdapterPlacement, FakeAdapterBackend
+
+class FakeSensor(object):
+  def __init__(self, mac, adapter, rssi = -60):
+    self.mac = mac
+    self.adapter = adapter
+    self.rssi = rssi
+    self.moves = []
+
+  def move_to_adapter(self, adapter):
+    self.adapter = adapter
+    self.moves.append(adapter)
+
+class AdapterPlacementTest(unittest.TestCase):
+  def placement(self, count = 2, cooldown = 600):
+    return AdapterPlacement(FakeAdapterBackend(count), degraded_latency_seconds = 8, degraded_rssi = -90, \
+      max_failures = 3, move_cooldown_seconds = cooldown, scan_adapter = 0)
+
+  def test_spreads_new_sensors(self):
+    placement = self.placement(count = 3)
+    adapters = [placement.place('00:00:00:00:00:0' + str(index)) for index in range(3)]
+    self.assertEqual(sorted(adapters), [0, 1, 2])
+
+  def test_weak_rssi_moves_once(self):
+    placement = self.placement()
+    sensor = FakeSensor('00:00:00:00:00:01', placement.place('00:00:00:00:00:01'), rssi = -95)
+    self.assertEqual(sensor.adapter, 0)
+    for index in range(5):
+      placement.record_read(sensor, 1.0, True)
+    #The scanner's RSSI says nothing about the link once the sensor is off the scan adapter
+    self.assertEqual(sensor.moves, [1])
+
+  def test_cooldown_after_move(self):
+    placement = self.placement()
+    sensor = FakeSensor('00:00:00:00:00:01', placement.place('00:00:00:00:00:01'))
+    for index in range(6):
+      placement.record_read(sensor, 1.0, False)
+    self.assertEqual(sensor.moves, [1])
+
+    placement = self.placement(cooldown = 0)
+    sensor = FakeSensor('00:00:00:00:00:01', placement.place('00:00:00:00:00:01'))
+    for index in range(6):
+      placement.record_read(sensor, 1.0, False)
+    self.assertEqual(sensor.moves, [1, 0])
+
+  def test_backoff_waits_are_not_failures(self):
+    placement = self.placement()
+    sensor = FakeSensor('00:00:00:00:00:01', placement.place('00:00:00:00:00:01'))
+    placement.record_read(sensor, 1.0, False)
+    for index in range(10):
+      placement.record_read(sensor, 0.0, False, attempted = False)
+    placement.record_read(sensor, 1.0, False)
+    self.assertEqual(sensor.moves, [])
+    placement.record_read(sensor, 1.0, False)
+    self.assertEqual(sensor.moves, [1])
+
+  def test_slow_reads_move_to_least_loaded(self):
+    placement = self.placement(count = 3)
+    fast = FakeSensor('00:00:00:00:00:01', placement.place('00:00:00:00:00:01'))
+    placement.record_read(fast, 2.0, True)
+    slow = FakeSensor('00:00:00:00:00:02', placement.place('00:00:00:00:00:02'))
+    other = FakeSensor('00:00:00:00:00:03', placement.place('00:00:00:00:00:03'))
+    placement.record_read(other, 1.0, True)
+    placement.record_read(slow, 9.0, True)
+    self.assertEqual(slow.moves, [2])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,130 @@
+import datetime, os, random, shutil, tempfile, unittest, pytz
+
+from event_horizon import EventHorizon, EventIndex
+
+BASE = pytz.utc.localize(datetime.datetime(2026, 1, 1))
+
+def at(minutes):
+  return BASE + datetime.timedelta(minutes = minutes)
+
+def numeric(event):
+  return event['desired_temp'] not in ('On', 'Preheat', 'Off')
+
+class EventIndexTest(unittest.TestCase):
+  def random_events(self, generator, count):
+    events = []
+    for index in range(count):
+      start = generator.randint(0, 1000)
+      events.append({'start_date': at(start), 'end_date': at(start + generator.randint(0, 300)), \
+        'desired_temp': generator.choice([18.0, 20.5, 'On', 'Preheat', 'Off'])})
+    return events
+
+  def test_matches_brute_force(self):
+    generator = random.Random(23)
+    for round in range(200):
+      events = self.random_events(generator, generator.randint(0, 30))
+      index = EventIndex(events)
+      ordered = sorted(events, key = lambda event: event['start_date'])
+      for check in range(20):
+        now = at(generator.randint(-50, 1350))
+        self.assertEqual(index.active(now), \
+          [event for event in ordered if event['start_date'] < now and event['end_date'] >= now])
+        unfinished = [event for event in ordered if event['end_date'] >= now and numeric(event)]
+        self.assertIs(index.first_unfinished(now, numeric), unfinished[0] if unfinished else None)
+        self.assertEqual(index.starting_after(now), [event for event in ordered if event['start_date'] > now])
+
+class EventHorizonTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'events.json')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_reloads_unfinished_events(self):
+    now = pytz.utc.localize(datetime.datetime.utcnow())
+    finished = {'start_date': now - datetime.timedelta(hours = 2), 'end_date': now - datetime.timedelta(hours = 1), 'desired_temp': 19.0}
+    current = {'start_date': now - datetime.timedelta(hours = 1), 'end_date': now + datetime.timedelta(hours = 1), 'desired_temp': 'On'}
+    future = {'start_date': now + datetime.timedelta(hours = 2), 'end_date': now + datetime.timedelta(hours = 3), 'desired_temp': 20.5}
+    EventHorizon(self.path).replace([future, finished, current])
+    self.assertEqual(list(EventHorizon(self.path).index), [current, future])
+
+  def test_ignores_unreadable_file(self):
+    with open(self.path, 'w') as json_data:
+      json_data.write('[{"start_date": ')
+    self.assertEqual(len(EventHorizon(self.path).index), 0)
+
+class ProcessTest(unittest.TestCase):
+  '''Runs Heating._process over a horizon, with the relays and scheduler left out.'''
+  def setUp(self):
+    #Heating reads config.json from the working directory
+    self.cwd = os.getcwd()
+    os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    self.directory = tempfile.mkdtemp()
+    from heating import Heating
+    from history import History
+    from overrides import Overrides
+
+    class FakeRelay(object):
+      def __init__(self):
+        self._status = 0
+
+      def on(self):
+        self._status = 1
+
+      def off(self):
+        self._status = 0
+
+    class FakeRelays(object):
+      def all_status(self):
+        return []
+
+    class TestHeating(Heating):
+      def set_heating_trigger(self, proportion, on):
+        self.proportional_time = proportion
+
+      def set_preheat_trigger(self, time_off):
+        pass
+
+    self.heating = TestHeating()
+    self.heating.horizon = EventHorizon(os.path.join(self.directory, 'events.json'))
+    self.heating.overrides = Overrides(os.path.join(self.directory, 'overrides.json'))
+    self.heating.history = History(os.path.join(self.directory, 'history'))
+    self.heating.relays = FakeRelays()
+    self.heating.relays_heating = FakeRelay()
+    self.heating.relays_preheat = FakeRelay()
+    self.now = pytz.utc.localize(datetime.datetime.utcnow())
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    shutil.rmtree(self.directory)
+
+  def event(self, start_minutes, end_minutes, desired_temp):
+    return {'start_date': self.now + datetime.timedelta(minutes = start_minutes), \
+      'end_date': self.now + datetime.timedelta(minutes = end_minutes), 'desired_temp': desired_temp}
+
+  def test_heats_for_current_event(self):
+    self.heating.horizon.replace([self.event(-30, 60, 20.0), self.event(120, 180, 18.0)])
+    self.heating.current_temp = 15.0
+    self.heating._process()
+    self.assertEqual(self.heating.desired_temp, '20.0')
+    self.assertEqual(self.heating.relays_heating._status, 1)
+
+  def test_forced_off_and_preheat(self):
+    self.heating.horizon.replace([self.event(-30, 60, 20.0), self.event(-10, 30, 'Off'), self.event(-5, 20, 'Preheat')])
+    self.heating.relays_heating._status = 1
+    self.heating.current_temp = 15.0
+    self.heating._process()
+    self.assertEqual(self.heating.desired_temp, 'Off')
+    self.assertEqual(self.heating.relays_heating._status, 0)
+    self.assertEqual(self.heating.relays_preheat._status, 1)
+
+  def test_no_events(self):
+    self.heating.horizon.replace([self.event(-120, -60, 20.0)])
+    self.heating.relays_heating._status = 1
+    self.heating.current_temp = 15.0
+    self.heating._process()
+    self.assertEqual(self.heating.relays_heating._status, 0)
+
+if __name__ == '__main__':
+  unittest.main()
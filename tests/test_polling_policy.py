@@ -0,0 +1,74 @@
+import datetime, os, shutil, tempfile, unittest, pytz
+
+from event_horizon import EventHorizon
+from overrides import Overrides
+from polling_policy import PollingPolicy
+
+HEATING_SETTINGS = {'update_temperature_interval_seconds': 60, 'minutes_per_degree': 20, 'effect_delay_minutes': 8}
+SENSOR_SETTINGS = {'min_poll_interval_seconds': 15, 'max_poll_interval_seconds': 300, \
+  'near_target_degrees': 0.5, 'stable_degrees': 0.1}
+
+class FakeSensor(object):
+  def __init__(self, mac):
+    self.mac = mac
+    self.last_read = 1000.0
+    self.next_read = 0
+    self.poll_interval = None
+    self.poll_reason = None
+    self.amb_temp = 15.0
+    self.previous_amb_temp = 15.0
+
+class FakeHeating(object):
+  '''Just the parts of Heating that PollingPolicy reads.'''
+  def __init__(self, directory):
+    self.heating_trigger = None
+    self.current_temp = 15.0
+    self.desired_temp = '9'
+    self.current_sensor = None
+    self.horizon = EventHorizon(os.path.join(directory, 'events.json'))
+    self.overrides = Overrides(os.path.join(directory, 'overrides.json'))
+
+class PollingPolicyTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.heating = FakeHeating(self.directory)
+    self.policy = PollingPolicy(HEATING_SETTINGS, SENSOR_SETTINGS)
+    self.sensor = FakeSensor('00:00:00:00:00:01')
+    self.now = pytz.utc.localize(datetime.datetime.utcnow())
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def event(self, start_minutes, desired_temp):
+    return {'start_date': self.now + datetime.timedelta(minutes = start_minutes), \
+      'end_date': self.now + datetime.timedelta(minutes = start_minutes + 60), 'desired_temp': desired_temp}
+
+  def test_stable_without_events(self):
+    self.policy.schedule([self.sensor], self.heating)
+    self.assertEqual((self.sensor.poll_interval, self.sensor.poll_reason), (300, 'stable'))
+    self.assertEqual(self.sensor.next_read, 1300.0)
+
+  def test_warm_up_imminent(self):
+    #5 degrees needs 108 minutes of warm-up, so starting within 113 minutes is urgent
+    self.heating.horizon.replace([self.event(110, 20.0)])
+    self.policy.schedule([self.sensor], self.heating)
+    self.assertEqual((self.sensor.poll_interval, self.sensor.poll_reason), (15, 'warm-up imminent'))
+
+  def test_warm_up_not_due(self):
+    self.heating.horizon.replace([self.event(180, 20.0)])
+    self.policy.schedule([self.sensor], self.heating)
+    self.assertEqual(self.sensor.poll_reason, 'stable')
+
+  def test_ignores_switch_events(self):
+    self.heating.horizon.replace([self.event(5, 'On'), self.event(5, 'Preheat'), self.event(5, 'Off')])
+    self.policy.schedule([self.sensor], self.heating)
+    self.assertEqual(self.sensor.poll_reason, 'stable')
+
+  def test_override_hides_events(self):
+    self.heating.horizon.replace([self.event(30, 20.0)])
+    self.heating.overrides.set('off', 'Off', self.now + datetime.timedelta(hours = 3))
+    self.policy.schedule([self.sensor], self.heating)
+    self.assertEqual(self.sensor.poll_reason, 'stable')
+
+if __name__ == '__main__':
+  unittest.main()
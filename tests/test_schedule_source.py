@@ -0,0 +1,52 @@
+import datetime, os, unittest, pytz
+
+from schedule_source import IcsSource
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures', 'schedule.ics')
+
+def utc(*args):
+  return pytz.utc.localize(datetime.datetime(*args))
+
+class FixedIcsSource(IcsSource):
+  '''IcsSource with the clock set by the test.'''
+  def __init__(self, path, now):
+    IcsSource.__init__(self, path)
+    self.now = now
+
+  def _now(self):
+    return self.now
+
+class IcsSourceTest(unittest.TestCase):
+  def events(self, source, until):
+    return [(event['start_date'], event['end_date'], event['desired_temp']) for event in source.events(until)]
+
+  def test_expands_offline(self):
+    source = FixedIcsSource(FIXTURE, utc(2026, 3, 1))
+    self.assertEqual(self.events(source, utc(2026, 4, 1)), [
+      (utc(2026, 3, 1, 7), utc(2026, 3, 1, 9), 20.5),
+      (utc(2026, 3, 5, 6), utc(2026, 3, 5, 6, 30), 'Preheat'),
+      (utc(2026, 3, 6, 6), utc(2026, 3, 6, 7), 'On'),
+      (utc(2026, 3, 8, 7), utc(2026, 3, 8, 9), 20.5),
+      #Moved in from beyond the horizon
+      (utc(2026, 3, 10, 18), utc(2026, 3, 10, 20), 21.0),
+      #15th is excluded, 22nd is moved out, and the clocks have gone forward by the 29th
+      (utc(2026, 3, 29, 6), utc(2026, 3, 29, 8), 20.5)])
+
+  def test_extends_horizon(self):
+    source = FixedIcsSource(FIXTURE, utc(2026, 3, 1))
+    self.events(source, utc(2026, 4, 1))
+    source.now = utc(2026, 3, 28)
+    self.assertEqual(self.events(source, utc(2026, 5, 1)), [
+      (utc(2026, 3, 29, 6), utc(2026, 3, 29, 8), 20.5),
+      (utc(2026, 4, 5, 6), utc(2026, 4, 5, 8), 20.5),
+      (utc(2026, 4, 12, 6), utc(2026, 4, 12, 8), 20.5),
+      (utc(2026, 4, 19, 6), utc(2026, 4, 19, 8), 20.5),
+      #Moved out of the first horizon, and the 26th it came from is gone
+      (utc(2026, 4, 20, 6), utc(2026, 4, 20, 8), 20.5)])
+
+  def test_in_progress_instance(self):
+    source = FixedIcsSource(FIXTURE, utc(2026, 3, 8, 8))
+    self.assertEqual(self.events(source, utc(2026, 3, 9)), [(utc(2026, 3, 8, 7), utc(2026, 3, 8, 9), 20.5)])
+
+if __name__ == '__main__':
+  unittest.main()
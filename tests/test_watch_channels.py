@@ -0,0 +1,70 @@
+import os, shutil, tempfile, time, unittest
+
+from watch_channels import FakeWatchBackend, WatchChannels
+
+ADDRESS = 'https://example.com/heating/events'
+
+class WatchChannelsTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.state_file = os.path.join(self.directory, 'watch_channel.json')
+    self.backend = FakeWatchBackend()
+    self.now = time.time()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def channels(self, backend = None):
+    return WatchChannels(backend or self.backend, 'calendar', ADDRESS, ttl_seconds = 24 * 60 * 60, \
+      renew_before_seconds = 600, retry_seconds = 300, state_file = self.state_file)
+
+  def test_renews_before_expiry(self):
+    channels = self.channels()
+    renew_at = channels.ensure(self.now)
+    first = channels.channel['id']
+    self.assertAlmostEqual(renew_at, self.now + 24 * 60 * 60 - 600, delta = 1)
+
+    #Not due yet, so nothing changes
+    self.assertEqual(channels.ensure(renew_at - 1), renew_at)
+    self.assertEqual(channels.channel['id'], first)
+
+    channels.ensure(renew_at + 1)
+    self.assertNotEqual(channels.channel['id'], first)
+
+  def test_stops_superseded_channel(self):
+    channels = self.channels()
+    renew_at = channels.ensure(self.now)
+    first = channels.channel
+    channels.ensure(renew_at + 1)
+    self.assertEqual(list(self.backend.channels.keys()), [channels.channel['id']])
+    self.assertFalse(channels.is_current(first['id']))
+
+    #A notification from the old channel after it was stopped doesn't stop it again
+    channels.stop_stray(first['id'], first['resource_id'])
+    self.backend.channels['stray'] = ('resource-calendar', 0)
+    channels.stop_stray('stray', 'resource-calendar')
+    self.assertEqual(list(self.backend.channels.keys()), [channels.channel['id']])
+
+  def test_reloads_from_state_file(self):
+    channels = self.channels()
+    renew_at = channels.ensure(self.now)
+    reloaded = self.channels()
+    self.assertEqual(reloaded.channel, channels.channel)
+    self.assertEqual(reloaded.ensure(self.now + 60), renew_at)
+    self.assertEqual(len(self.backend.channels), 1)
+
+  def test_retries_after_failure(self):
+    self.backend.fail = True
+    channels = self.channels()
+    self.assertEqual(channels.ensure(self.now), self.now + 300)
+    self.assertIsNone(channels.channel)
+    self.assertIsNotNone(channels.status()['last_error'])
+
+    self.backend.fail = False
+    renew_at = channels.ensure(self.now + 300)
+    self.assertIsNotNone(channels.channel)
+    self.assertIsNone(channels.status()['last_error'])
+    self.assertAlmostEqual(renew_at, self.now + 300 + 24 * 60 * 60 - 600, delta = 1)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,60 @@
+import json, os, shutil, tempfile, time, unittest
+
+from weather import CachedHttpClient, FileWeatherProvider, Weather, WeatherProvider
+
+class OfflineProvider(WeatherProvider):
+  '''Fails the test if anything tries to fetch.'''
+  name = 'offline'
+
+  def fetch(self):
+    raise AssertionError('Fetched weather')
+
+class BrokenProvider(WeatherProvider):
+  name = 'broken'
+
+  def fetch(self):
+    raise RuntimeError('Bug')
+
+class WeatherTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.weather_file = os.path.join(self.directory, 'weather.json')
+    self.cache_file = os.path.join(self.directory, 'weather_cache.json')
+    self.now = time.time()
+    with open(self.weather_file, 'w') as json_data:
+      json.dump({'temperature': 5.0, 'apparent_temperature': 2.0, \
+        'hourly': [[self.now + 3600, 7.0], [self.now, 5.0], [self.now + 7200, 4.0]]}, json_data)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_forecast_from_file(self):
+    weather = Weather(FileWeatherProvider(CachedHttpClient(1), self.weather_file), self.cache_file)
+    self.assertTrue(weather.update())
+    self.assertEqual(weather.temperature, 5.0)
+    self.assertEqual(weather.forecast(self.now + 3600), 7.0)
+    self.assertAlmostEqual(weather.forecast(self.now + 5400), 5.5)
+    self.assertIsNone(weather.forecast(self.now - 60))
+    self.assertIsNone(weather.forecast(self.now + 10800))
+
+  def test_forecast_offline_after_restart(self):
+    Weather(FileWeatherProvider(CachedHttpClient(1), self.weather_file), self.cache_file).update()
+    weather = Weather(OfflineProvider(), self.cache_file)
+    self.assertEqual(weather.temperature, 5.0)
+    self.assertAlmostEqual(weather.forecast(self.now + 1800), 6.0)
+    self.assertLess(weather.age(), 60)
+
+  def test_failed_update_keeps_weather(self):
+    weather = Weather(FileWeatherProvider(CachedHttpClient(1), self.weather_file), self.cache_file)
+    weather.update()
+    weather.provider = FileWeatherProvider(CachedHttpClient(1), os.path.join(self.directory, 'missing.json'))
+    self.assertFalse(weather.update())
+    self.assertEqual(weather.temperature, 5.0)
+    self.assertIn('FileNotFoundError', weather.status()['last_error'])
+
+  def test_unexpected_errors_propagate(self):
+    weather = Weather(BrokenProvider(), self.cache_file)
+    self.assertRaises(RuntimeError, weather.update)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,137 @@
+import collections, json, logging, threading, time, uuid
+
+logger = logging.getLogger('heating')
+
+class Trace(object):
+  def __init__(self, name):
+    self.trace_id = uuid.uuid4().hex[:16]
+    self.name = name
+    self.start = time.time()
+    self.end = None
+    self.spans = []
+
+  def first(self, name, field):
+    times = [span[field] for span in self.spans if span['name'] == name]
+    return min(times) if times else None
+
+  def as_dict(self):
+    return {'trace_id': self.trace_id, 'name': self.name, 'start': self.start, 'end': self.end, \
+      'spans': sorted(self.spans, key = lambda span: span['start'])}
+
+class Span(object):
+  def __init__(self, tracer, name, attributes):
+    self.tracer = tracer
+    self.name = name
+    self.attributes = attributes
+    self.root = False
+
+  def __enter__(self):
+    self.trace = self.tracer.current()
+    if self.trace is None:
+      #Whatever starts outside a trace becomes the start of a new one
+      self.trace = Trace(self.name)
+      self.root = True
+      self.tracer._local.trace = self.trace
+    self.start = time.time()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    span = {'name': self.name, 'start': self.start, 'end': time.time(), 'thread': threading.current_thread().name}
+    if self.attributes:
+      span['attributes'] = self.attributes
+    if exc_type is not None:
+      span['error'] = exc_type.__name__
+    self.trace.spans.append(span)
+    if self.root:
+      self.tracer._local.trace = None
+      self.trace.end = span['end']
+      self.tracer._finish(self.trace)
+    return False
+
+class Activation(object):
+  def __init__(self, tracer, trace):
+    self.tracer = tracer
+    self.trace = trace
+
+  def __enter__(self):
+    self.previous = self.tracer.current()
+    self.tracer._local.trace = self.trace
+    return self.trace
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.tracer._local.trace = self.previous
+    return False
+
+class Tracer(object):
+  '''Times the stages of each control cycle, from sensor read to relay write.
+
+  Spans opened on a thread with no current trace start a new trace, and spans
+  opened inside it are added to it. Work handed to other threads joins the
+  trace through activate(). Finished traces are kept in a bounded buffer and
+  optionally appended to a file as JSON lines.
+  '''
+  def __init__(self, size = 200, path = None):
+    self._local = threading.local()
+    self._lock = threading.Lock()
+    self.configure(size, path)
+
+  def configure(self, size, path):
+    self._lock.acquire()
+    self._traces = collections.deque(maxlen = size)
+    self.path = path
+    self._lock.release()
+
+  def span(self, name, **attributes):
+    return Span(self, name, attributes)
+
+  def current(self):
+    return getattr(self._local, 'trace', None)
+
+  def activate(self, trace):
+    '''Makes another thread's trace current on this thread for the duration.'''
+    return Activation(self, trace)
+
+  def recent(self, count):
+    self._lock.acquire()
+    traces = list(self._traces)[-count:]
+    self._lock.release()
+    return [trace.as_dict() for trace in reversed(traces)]
+
+  def get(self, trace_id):
+    self._lock.acquire()
+    found = [trace for trace in self._traces if trace.trace_id == trace_id]
+    self._lock.release()
+    return found[0].as_dict() if found else None
+
+  def actuation_latency(self):
+    '''Returns percentiles of the time from a sensor sample to the relay write it caused.'''
+    self._lock.acquire()
+    traces = list(self._traces)
+    self._lock.release()
+    latencies = []
+    for trace in traces:
+      sampled = trace.first('sensor_read', 'end')
+      actuated = trace.first('relay_transfer', 'end')
+      if sampled is not None and actuated is not None:
+        latencies.append(actuated - sampled)
+    latencies.sort()
+    result = {'count': len(latencies)}
+    for percentile in (50, 90, 99):
+      if latencies:
+        result['p' + str(percentile)] = latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100.0))]
+    return result
+
+  def _finish(self, trace):
+    self._lock.acquire()
+    self._traces.append(trace)
+    path = self.path
+    self._lock.release()
+    logger.debug('Trace ' + trace.trace_id + ' ' + trace.name + ' took ' + str(round(trace.end - trace.start, 3)) + 's')
+    if path:
+      try:
+        with open(path, 'a') as trace_file:
+          trace_file.write(json.dumps(trace.as_dict()) + '\n')
+      except (IOError, OSError) as e:
+        logger.warn('Could not write trace to ' + path + ': ' + str(e))
+
+TRACER = Tracer()
@@ -1,5 +1,7 @@
 import usb, logging
 from relay import Relay
+from metrics import RELAY_TRANSFER_SECONDS, RELAY_SWITCHES
+from tracing import TRACER
 
 logger = logging.getLogger('heating')
 
@@ -24,16 +26,19 @@ class SingleRelay():
     self.off()
 
   def __sendmsg(self,data):
-    self._hid_device.ctrl_transfer(0x21,0x09,0x0300,0x00,bytes(data),1000)
+    with RELAY_TRANSFER_SECONDS.time(), TRACER.span('relay_transfer'):
+      self._hid_device.ctrl_transfer(0x21,0x09,0x0300,0x00,bytes(data),1000)
 
   def on(self):
     self.__sendmsg([0xFE, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
     logger.info("Relay " + str(self._hid_device.address) + " on")
+    RELAY_SWITCHES.inc(str(self.port_numbers), 'on')
     self._status = True
 
   def off(self):
     self.__sendmsg([0xFC, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
     logger.info("Relay " + str(self._hid_device.address) + " off")
+    RELAY_SWITCHES.inc(str(self.port_numbers), 'off')
     self._status = False
 
   @property
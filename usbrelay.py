@@ -1,5 +1,7 @@
 import usb, logging
 from relay import Relay
+from metrics import RELAY_TRANSFER_SECONDS, RELAY_SWITCHES
+from tracing import TRACER
 
 logger = logging.getLogger('heating')
 
@@ -24,7 +26,8 @@ class USBRelay(Relay):
     self.all_off()
 
   def __sendmsg(self,data):
-    self._hid_device.ctrl_transfer(0x21,0x09,0x0300,0x00,bytes(data),1000)
+    with RELAY_TRANSFER_SECONDS.time(), TRACER.span('relay_transfer'):
+      self._hid_device.ctrl_transfer(0x21,0x09,0x0300,0x00,bytes(data),1000)
 
   def all_status(self):
     return self._status
@@ -37,24 +40,28 @@ class USBRelay(Relay):
       logger.debug("Relay all on")
       self.__sendmsg([0xFE, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
       self._status = [1,1,1,1,1,1,1,1]
+      RELAY_SWITCHES.inc('all', 'on')
 
   def all_off(self):
     if not self._status == [0,0,0,0,0,0,0,0]:
       logger.debug("Relay all off")
       self.__sendmsg([0xFC, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
       self._status = [0,0,0,0,0,0,0,0]
+      RELAY_SWITCHES.inc('all', 'off')
 
   def one_on(self,relay_num):
     if self._status[relay_num-1] == 0 and relay_num > 0 and relay_num <= 8:
       logger.debug("Relay " + str(relay_num) + " on")
       self.__sendmsg([0xFF, relay_num, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
       self._status[relay_num-1] = 1
+      RELAY_SWITCHES.inc(str(relay_num), 'on')
 
   def one_off(self,relay_num):
     if self._status[relay_num-1] == 1 and relay_num > 0 and relay_num <= 8:
       logger.debug("Relay " + str(relay_num) + " off")
       self.__sendmsg([0xFD, relay_num, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
       self._status[relay_num-1] = 0
+      RELAY_SWITCHES.inc(str(relay_num), 'off')
 
   @staticmethod
   def find_relay():
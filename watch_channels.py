@@ -0,0 +1,150 @@
+import json, logging, os, threading, time, uuid
+
+logger = logging.getLogger('heating')
+
+class CalendarWatchBackend(object):
+  '''Creates and stops push notification channels through the Calendar API.'''
+  def __init__(self, calendar):
+    self.calendar = calendar
+
+  def watch(self, calendar_id, body):
+    '''Returns the channel's resource ID and expiration in milliseconds.'''
+    response = self.calendar.service().events().watch(calendarId = calendar_id, body = body).execute()
+    logger.debug('Got response ' + str(response) + ' from watch call')
+    return response['resourceId'], int(response['expiration'])
+
+  def stop(self, channel_id, resource_id):
+    self.calendar.service().channels().stop(body = {'id': channel_id, 'resourceId': resource_id}).execute()
+
+class FakeWatchBackend(object):
+  '''Stand-in for the Calendar API that keeps channels in memory, for running without Google.'''
+  def __init__(self, max_ttl_seconds = 7 * 24 * 60 * 60):
+    self.max_ttl_seconds = max_ttl_seconds
+    #Channel ID -> (resource ID, expiration in milliseconds)
+    self.channels = {}
+    self.fail = False
+
+  def watch(self, calendar_id, body):
+    if self.fail:
+      raise IOError('Watch failed')
+    expiration = min(int(body['expiration']), int((time.time() + self.max_ttl_seconds) * 1000))
+    resource_id = 'resource-' + calendar_id
+    self.channels[body['id']] = (resource_id, expiration)
+    return resource_id, expiration
+
+  def stop(self, channel_id, resource_id):
+    if channel_id not in self.channels:
+      raise IOError('Channel ' + channel_id + ' not found')
+    del self.channels[channel_id]
+
+class WatchChannels(object):
+  '''Keeps exactly one live push notification channel on the calendar.
+
+  The channel is replaced renew_before_seconds before it expires, and the
+  one it replaces is stopped so Google stops sending notifications for it.
+  The live channel is saved to state_file so a restart carries on with it
+  rather than opening another. Notifications for any other channel are
+  answered by stopping that channel.
+  '''
+  def __init__(self, backend, calendar_id, address, ttl_seconds, renew_before_seconds, retry_seconds, state_file):
+    self.backend = backend
+    self.calendar_id = calendar_id
+    self.address = address
+    self.ttl_seconds = ttl_seconds
+    self.renew_before_seconds = renew_before_seconds
+    self.retry_seconds = retry_seconds
+    self.state_file = state_file
+    self.channel = None
+    self.last_error = None
+    self.retry_at = None
+    self._stopped = set()
+    self._lock = threading.Lock()
+    if os.path.exists(self.state_file):
+      try:
+        with open(self.state_file) as json_data:
+          self.channel = json.load(json_data)
+        logger.info('Loaded calendar watch channel ' + str(self.channel) + ' from ' + self.state_file)
+      except (IOError, ValueError) as e:
+        logger.warn('Ignoring unreadable watch channel file ' + self.state_file + ': ' + str(e))
+
+  def ensure(self, now = None):
+    '''Opens a new channel if there is none or it is about to expire, returning when to check again.'''
+    if now is None:
+      now = time.time()
+    self._lock.acquire()
+    try:
+      channel = self.channel
+      if channel is not None and channel['address'] == self.address and \
+          channel['expiration'] / 1000.0 - self.renew_before_seconds > now:
+        return self.renew_at()
+
+      new_channel = {'id': str(uuid.uuid4()), 'address': self.address}
+      body = {'id': new_channel['id'], 'type': 'web_hook', 'address': self.address, \
+        'expiration': int((now + self.ttl_seconds) * 1000)}
+      logger.debug('Sending watch request: ' + str(body))
+      try:
+        new_channel['resource_id'], new_channel['expiration'] = self.backend.watch(self.calendar_id, body)
+      except Exception as e:
+        #httplib2 DNS failures and OAuth token refresh errors aren't IOErrors, and any
+        #failure has to come back here so the caller still schedules a retry
+        logger.error('Could not open calendar watch channel: ' + type(e).__name__ + ': ' + str(e))
+        self.last_error = str(e)
+        self.retry_at = now + self.retry_seconds
+        return self.retry_at
+
+      logger.info('Opened calendar watch channel ' + new_channel['id'] + ' until ' + \
+        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(new_channel['expiration'] / 1000.0)))
+      self.channel = new_channel
+      self.last_error = None
+      self.retry_at = None
+      self._save()
+      if channel is not None:
+        self._stop(channel['id'], channel['resource_id'])
+      return self.renew_at()
+    finally:
+      self._lock.release()
+
+  def is_current(self, channel_id):
+    channel = self.channel
+    return channel is not None and channel_id == channel['id']
+
+  def stop_stray(self, channel_id, resource_id):
+    '''Stops a channel that notified us but isn't the live one.'''
+    self._lock.acquire()
+    try:
+      if self.is_current(channel_id) or channel_id in self._stopped:
+        return
+      logger.info('Notification from superseded calendar watch channel ' + str(channel_id) + ', stopping it')
+      self._stop(channel_id, resource_id)
+    finally:
+      self._lock.release()
+
+  def renew_at(self):
+    if self.retry_at is not None:
+      return self.retry_at
+    return self.channel['expiration'] / 1000.0 - self.renew_before_seconds
+
+  def status(self):
+    channel = self.channel
+    return {'channel': channel, 'renew_at': self.renew_at() if channel is not None or self.retry_at is not None else None, \
+      'last_error': self.last_error, 'stopped': len(self._stopped)}
+
+  def _stop(self, channel_id, resource_id):
+    if len(self._stopped) > 1000:
+      self._stopped.clear()
+    self._stopped.add(channel_id)
+    try:
+      self.backend.stop(channel_id, resource_id)
+      logger.info('Stopped calendar watch channel ' + channel_id)
+    except Exception as e:
+      #Most likely it had already expired
+      logger.warn('Could not stop calendar watch channel ' + channel_id + ': ' + str(e))
+
+  def _save(self):
+    temp_path = self.state_file + '.tmp'
+    try:
+      with open(temp_path, 'w') as json_data:
+        json.dump(self.channel, json_data)
+      os.replace(temp_path, self.state_file)
+    except (IOError, OSError) as e:
+      logger.warn('Could not write watch channel file ' + self.state_file + ': ' + str(e))
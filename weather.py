@@ -0,0 +1,185 @@
+import bisect, json, logging, os, socket, threading, time, urllib.error, urllib.parse, urllib.request
+
+logger = logging.getLogger('heating')
+
+class CachedHttpClient(object):
+  '''Fetches JSON with a timeout, revalidating with ETag and Last-Modified.
+
+  A 304 Not Modified answer returns the body kept from the last 200.
+  '''
+  def __init__(self, timeout_seconds, user_agent = 'heating'):
+    self.timeout_seconds = timeout_seconds
+    self.user_agent = user_agent
+    #URL -> (ETag, Last-Modified, body)
+    self._cache = {}
+    self._lock = threading.Lock()
+
+  def get_json(self, url):
+    self._lock.acquire()
+    cached = self._cache.get(url)
+    self._lock.release()
+
+    request = urllib.request.Request(url, headers = {'User-Agent': self.user_agent, 'Accept': 'application/json'})
+    if cached is not None:
+      if cached[0]:
+        request.add_header('If-None-Match', cached[0])
+      if cached[1]:
+        request.add_header('If-Modified-Since', cached[1])
+    try:
+      with urllib.request.urlopen(request, timeout = self.timeout_seconds) as response:
+        body = response.read()
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+    except urllib.error.HTTPError as e:
+      if e.code != 304 or cached is None:
+        raise
+      logger.debug('Not modified: ' + url)
+      return json.loads(cached[2].decode('UTF-8'))
+
+    if etag or last_modified:
+      self._lock.acquire()
+      self._cache[url] = (etag, last_modified, body)
+      self._lock.release()
+    return json.loads(body.decode('UTF-8'))
+
+class WeatherProvider(object):
+  '''Source of outside temperatures.
+
+  fetch() returns {'temperature', 'apparent_temperature', 'hourly'}, where
+  hourly is a list of [timestamp, temperature] pairs in time order.
+  '''
+  name = None
+
+  def fetch(self):
+    pass
+
+class OpenMeteoProvider(WeatherProvider):
+  '''Current conditions and hourly forecast from Open-Meteo, which needs no API key.'''
+  name = 'open-meteo'
+  URL = 'https://api.open-meteo.com/v1/forecast'
+
+  def __init__(self, client, latitude, longitude, forecast_hours):
+    self.client = client
+    self.url = OpenMeteoProvider.URL + '?' + urllib.parse.urlencode({'latitude': latitude, 'longitude': longitude, \
+      'current': 'temperature_2m,apparent_temperature', 'hourly': 'temperature_2m', \
+      'forecast_hours': forecast_hours, 'timeformat': 'unixtime'})
+
+  def fetch(self):
+    data = self.client.get_json(self.url)
+    return {'temperature': data['current']['temperature_2m'], \
+      'apparent_temperature': data['current']['apparent_temperature'], \
+      'hourly': [[timestamp, temperature] for timestamp, temperature in \
+        zip(data['hourly']['time'], data['hourly']['temperature_2m']) if temperature is not None]}
+
+class FileWeatherProvider(WeatherProvider):
+  '''Stand-in provider reading weather in fetch()'s own format from a file or URL, for testing.'''
+  name = 'file'
+
+  def __init__(self, client, location):
+    self.client = client
+    self.location = location
+
+  def fetch(self):
+    if urllib.parse.urlparse(self.location).scheme in ('http', 'https'):
+      return self.client.get_json(self.location)
+    with open(self.location) as json_data:
+      return json.load(json_data)
+
+class Weather(object):
+  '''Latest outside temperature and an hourly forecast from a WeatherProvider.
+
+  The forecast is kept in memory and on disk so warm-up planning can read
+  it with forecast() without touching the network, including after a
+  restart.
+  '''
+  def __init__(self, provider, cache_file):
+    self.provider = provider
+    self.cache_file = cache_file
+    self.temperature = None
+    self.apparent_temperature = None
+    self.updated = None
+    self.latency_seconds = None
+    self.last_error = None
+    self._hourly = []
+    self._times = []
+    self._lock = threading.Lock()
+    if os.path.exists(self.cache_file):
+      try:
+        with open(self.cache_file) as json_data:
+          cached = json.load(json_data)
+        self._set(cached, cached['updated'])
+        logger.debug('Loaded weather from ' + self.cache_file + ', ' + str(round(self.age(), 0)) + 's old')
+      except (IOError, ValueError, KeyError, TypeError) as e:
+        logger.warn('Ignoring unreadable weather cache ' + self.cache_file + ': ' + str(e))
+
+  def update(self):
+    '''Fetches new weather, returning whether it worked.
+
+    Network, timeout and malformed response errors are logged and leave the
+    previous weather in place; anything else is a bug and is raised.
+    '''
+    started = time.monotonic()
+    try:
+      data = self.provider.fetch()
+      data = {'temperature': data['temperature'], 'apparent_temperature': data['apparent_temperature'], \
+        'hourly': sorted([float(timestamp), float(temperature)] for timestamp, temperature in data.get('hourly', []))}
+    except (urllib.error.URLError, socket.timeout, OSError, ValueError, KeyError, TypeError) as e:
+      self.latency_seconds = time.monotonic() - started
+      self.last_error = type(e).__name__ + ': ' + str(e)
+      logger.warn('Could not get weather from ' + self.provider.name + ': ' + self.last_error)
+      return False
+    self.latency_seconds = time.monotonic() - started
+    self.last_error = None
+    self._set(data, time.time())
+    self._save(data)
+    logger.info('Got outside temperature ' + str(self.temperature) + ', apparent ' + str(self.apparent_temperature) + \
+      ' and ' + str(len(data['hourly'])) + ' forecast hours from ' + self.provider.name + ' in ' + str(round(self.latency_seconds, 2)) + 's')
+    return True
+
+  def age(self):
+    '''Seconds since the last successful fetch, or None if there hasn't been one.'''
+    if self.updated is None:
+      return None
+    return time.time() - self.updated
+
+  def forecast(self, timestamp):
+    '''Returns the forecast temperature at a time, interpolated between hours, or None if it isn't covered.'''
+    self._lock.acquire()
+    hourly = self._hourly
+    times = self._times
+    self._lock.release()
+    index = bisect.bisect_left(times, timestamp)
+    if index < len(times) and times[index] == timestamp:
+      return hourly[index][1]
+    if index == 0 or index == len(times):
+      return None
+    (before_time, before), (after_time, after) = hourly[index - 1], hourly[index]
+    return before + (after - before) * (timestamp - before_time) / (after_time - before_time)
+
+  def status(self):
+    self._lock.acquire()
+    hourly = list(self._hourly)
+    self._lock.release()
+    return {'provider': self.provider.name, 'temperature': self.temperature, 'apparent_temperature': self.apparent_temperature, \
+      'updated': self.updated, 'age_seconds': self.age(), 'latency_seconds': self.latency_seconds, \
+      'last_error': self.last_error, 'hourly': hourly}
+
+  def _set(self, data, updated):
+    self._lock.acquire()
+    self.temperature = data['temperature']
+    self.apparent_temperature = data['apparent_temperature']
+    self._hourly = data['hourly']
+    self._times = [timestamp for timestamp, temperature in self._hourly]
+    self.updated = updated
+    self._lock.release()
+
+  def _save(self, data):
+    temp_path = self.cache_file + '.tmp'
+    try:
+      with open(temp_path, 'w') as json_data:
+        json.dump(dict(data, updated = self.updated), json_data)
+        json_data.flush()
+        os.fsync(json_data.fileno())
+      os.replace(temp_path, self.cache_file)
+    except (IOError, OSError) as e:
+      logger.warn('Could not write weather cache ' + self.cache_file + ': ' + str(e))